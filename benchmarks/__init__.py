@@ -0,0 +1,54 @@
+"""
+Micro-benchmarks for hot paths of the library, run them like `python -m benchmarks.dispatch`
+Frames below are real notifications captured from Move Hub, the same ones unit tests use
+"""
+import timeit
+from binascii import unhexlify
+
+FRAMES_HEX = [
+    '0f0004020125000000001000000010',
+    '0f0004030126000000001000000010',
+    '090004100227003738',
+    '0f00043a0128000000000100000001',
+    '12000101064c45474f204d6f766520487562',
+    '0b00010d06001653a0d1d4',
+    '060001060600',
+    '0600030104ff',
+    '0500056105',
+    '050082030a',
+    '0a004702080100000001',
+    '08004502ff0aff00',
+    '0800450200000000',
+    '0600453ba400',
+    '0600453c9907',
+    '0700453afd0140',
+    '0800453a00000000',
+]
+
+FRAMES = [bytes(unhexlify(x.replace(' ', ''))) for x in FRAMES_HEX]
+
+# port value notifications only, these dominate traffic when sensors stream
+VALUE_FRAMES = [x for x in FRAMES if x[2:3] == b'\x45']
+
+
+class ConnectionStub(object):
+    """Lets Hub be created without Bluetooth, nothing is sent anywhere"""
+
+    def set_notify_handler(self, handler):
+        pass
+
+    def enable_notifications(self):
+        pass
+
+    def is_alive(self):
+        return False
+
+
+def measure(func, number=100000, repeat=5):
+    """Returns best time per call in nanoseconds"""
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best * 1e9 / number
+
+
+def report(name, before, after):
+    print("%-40s before: %8.1f ns   after: %8.1f ns   x%.2f" % (name, before, after, before / after))
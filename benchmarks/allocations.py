@@ -0,0 +1,40 @@
+"""
+Measures memory spent on port value messages with tracemalloc: bytes newly allocated per decoded sample,
+with and without recycling messages through pool
+"""
+import tracemalloc
+
+from benchmarks import VALUE_FRAMES, measure
+from pylgbst.messages import MsgPortValueSingle
+
+SAMPLES = 10000
+
+
+def decode_samples():
+    return [MsgPortValueSingle.decode(VALUE_FRAMES[i % len(VALUE_FRAMES)]) for i in range(SAMPLES)]
+
+
+def bytes_per_sample():
+    for msg in decode_samples():  # warm up pool, if it is enabled
+        msg.release()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = decode_samples()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(x.size_diff for x in after.compare_to(before, 'filename'))
+    for msg in kept:
+        msg.release()
+    return float(size) / SAMPLES
+
+
+def ns_per_sample():
+    frame = VALUE_FRAMES[0]
+    return measure(lambda: MsgPortValueSingle.decode(frame).release())
+
+
+if __name__ == '__main__':
+    print("no pool: %6.1f bytes, %6.1f ns per sample" % (bytes_per_sample(), ns_per_sample()))
+    MsgPortValueSingle.enable_pool(SAMPLES)
+    print("pooled:  %6.1f bytes, %6.1f ns per sample" % (bytes_per_sample(), ns_per_sample()))
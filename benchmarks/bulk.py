@@ -0,0 +1,60 @@
+"""
+Compares decoding of recorded port values one message at a time with vectorized `pylgbst.bulk`
+"""
+import time
+
+from benchmarks import FRAMES, ConnectionStub
+from pylgbst.bulk import decode_port_values
+from pylgbst.hub import Hub
+from pylgbst.messages import MsgPortInputFmtSingle, MsgPortValueSingle
+from pylgbst.peripherals import EncodedMotor, VisionSensor, Voltage, TiltSensor
+
+PORT_MODES = {
+    0x01: (EncodedMotor, EncodedMotor.SENSOR_ANGLE),
+    0x02: (VisionSensor, VisionSensor.COLOR_DISTANCE_FLOAT),
+    0x3a: (TiltSensor, TiltSensor.MODE_3AXIS_ACCEL),
+    0x3c: (Voltage, Voltage.VOLTAGE_L),
+}
+
+RECORDED_HEX = ['08004501b4000000', '08004502ff0aff00', '0700453afd0140', '0600453c9907']
+
+
+def make_peripheral(cls, port, mode):
+    dev = cls.__new__(cls)  # no port data thread, decoding only
+    dev.port = port
+    dev._port_mode = MsgPortInputFmtSingle(port, mode, True, 1)
+    return dev
+
+
+def decode_one_by_one(data, hub, peripherals):
+    values = []
+    offset = 0
+    while offset < len(data):
+        frame = data[offset:offset + ord(data[offset:offset + 1])]
+        offset += len(frame)
+        msg = hub._get_upstream_msg(frame)
+        if isinstance(msg, MsgPortValueSingle) and msg.port in peripherals:
+            values.append(peripherals[msg.port]._decode_port_data(msg))
+    return values
+
+
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        spent = time.time() - start
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+if __name__ == '__main__':
+    hub = Hub(ConnectionStub())
+    peripherals = dict((port, make_peripheral(cls, port, mode)) for port, (cls, mode) in PORT_MODES.items())
+    recorded = b"".join(bytes(bytearray.fromhex(x)) for x in RECORDED_HEX) * 250000
+    recorded += b"".join(FRAMES)  # other messages are skipped by both
+    count = 4 * 250000
+
+    before = best_of(lambda: decode_one_by_one(recorded, hub, peripherals), 1)
+    after = best_of(lambda: decode_port_values(recorded, PORT_MODES))
+    print("%d frames   per message: %.2f s   bulk: %.2f s   x%.1f" % (count, before, after, before / after))
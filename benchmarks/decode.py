@@ -0,0 +1,15 @@
+"""
+Measures decoding time of upstream messages, per message class, over real frames
+"""
+from benchmarks import FRAMES, measure
+from pylgbst.messages import UPSTREAM_DECODERS
+from pylgbst.utilities import usbyte
+
+if __name__ == '__main__':
+    total = 0
+    for frame in FRAMES:
+        msg_class = UPSTREAM_DECODERS[usbyte(frame, 2)]
+        spent = measure(lambda: msg_class.decode(frame), 20000)
+        total += spent
+        print("%-25s %3d bytes: %8.1f ns" % (msg_class.__name__, len(frame), spent))
+    print("%-25s %9s: %8.1f ns" % ("average", "", total / len(FRAMES)))
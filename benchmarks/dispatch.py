@@ -0,0 +1,33 @@
+"""
+Compares linear scan over UPSTREAM_MSGS with indexed UPSTREAM_DECODERS lookup
+"""
+from benchmarks import FRAMES, measure, report
+from pylgbst.messages import UPSTREAM_MSGS, UPSTREAM_DECODERS
+from pylgbst.utilities import usbyte
+
+
+def lookup_linear(data):
+    msg_type = usbyte(data, 2)
+    for msg_kind in UPSTREAM_MSGS:
+        if msg_type == msg_kind.TYPE:
+            return msg_kind
+    return None
+
+
+def lookup_indexed(data):
+    return UPSTREAM_DECODERS[usbyte(data, 2)]
+
+
+def run_all(lookup):
+    for frame in FRAMES:
+        lookup(frame)
+
+
+if __name__ == '__main__':
+    before = measure(lambda: run_all(lookup_linear), 10000) / len(FRAMES)
+    after = measure(lambda: run_all(lookup_indexed), 10000) / len(FRAMES)
+    report("decoder lookup per frame", before, after)
+
+    feedback = FRAMES[9]  # MsgPortOutputFeedback, the last one in UPSTREAM_MSGS
+    report("decoder lookup, worst case", measure(lambda: lookup_linear(feedback)),
+           measure(lambda: lookup_indexed(feedback)))
@@ -0,0 +1,38 @@
+"""
+Measures encoding of repeated port output commands, from peripheral method call to frame bytes
+"""
+from benchmarks import measure
+from pylgbst.hub import MoveHub
+from pylgbst.peripherals import EncodedMotor, LEDRGB, COLOR_RED
+
+
+class HubStub(object):
+    def send(self, msg):
+        msg.bytes()
+
+
+class NoThreadMixin(object):
+    def __init__(self, parent, port):  # skips port data thread, it is not needed here
+        self.virtual_ports = ()
+        self.hub = parent
+        self.port = port
+        self.is_buffered = False
+
+
+class MotorStub(NoThreadMixin, EncodedMotor):
+    pass
+
+
+class LEDStub(NoThreadMixin, LEDRGB):
+    def set_port_mode(self, mode, send_updates=None, update_delta=None):
+        pass
+
+
+if __name__ == '__main__':
+    hub = HubStub()
+    motor = MotorStub(hub, MoveHub.PORT_A)
+    led = LEDStub(hub, MoveHub.PORT_LED)
+    print("start_power: %8.1f ns" % measure(lambda: motor.start_power(0.5)))
+    print("stop:        %8.1f ns" % measure(lambda: motor.stop()))
+    print("angled:      %8.1f ns" % measure(lambda: motor.angled(90, 0.5)))
+    print("set_color:   %8.1f ns" % measure(lambda: led.set_color(COLOR_RED)))
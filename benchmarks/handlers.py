@@ -0,0 +1,30 @@
+"""
+Measures message handler dispatch as handlers are added: isinstance scan over all of them
+versus handlers indexed by concrete message class
+"""
+from benchmarks import ConnectionStub, measure, report
+from pylgbst.hub import Hub
+from pylgbst.messages import MsgHubAlert, MsgHubAttachedIO, MsgHubProperties, MsgPortInfo, MsgPortModeInfo
+
+
+def dispatch_linear(hub, msg):
+    for msg_class, handler in hub._msg_handlers:
+        if isinstance(msg, msg_class):
+            handler(msg)
+
+
+def dispatch_indexed(hub, msg):
+    for handler in hub._handlers_for(type(msg)):
+        handler(msg)
+
+
+if __name__ == '__main__':
+    msg = MsgHubProperties.decode(b'\x06\x00\x01\x06\x06\x00')
+    for extra in (0, 10, 50):
+        hub = Hub(ConnectionStub())
+        hub.add_message_handler(MsgHubProperties, lambda x: None)
+        for num in range(extra):
+            hub.add_message_handler((MsgHubAlert, MsgHubAttachedIO, MsgPortInfo, MsgPortModeInfo)[num % 4],
+                                    lambda x: None)
+        report("dispatch with %d other handlers" % extra,
+               measure(lambda: dispatch_linear(hub, msg)), measure(lambda: dispatch_indexed(hub, msg)))
@@ -0,0 +1,46 @@
+"""
+Measures motor command throughput with simulated round trip latency, for one thread per port
+"""
+import threading
+import time
+
+from benchmarks import ConnectionStub
+from pylgbst.hub import Hub
+from pylgbst.messages import MsgPortOutput
+
+LATENCY = 0.02  # typical BLE connection interval is 7.5-30 ms
+COMMANDS = 25
+
+
+class LatencyConnection(ConnectionStub):
+    """Answers each command with completed feedback after LATENCY"""
+
+    def set_notify_handler(self, handler):
+        self.handler = handler
+
+    def write(self, handle, data):
+        if data[2:3] == b"\x81":
+            feedback = b"\x05\x00\x82" + data[3:4] + b"\x0a"
+            threading.Timer(LATENCY, self.handler, (handle, feedback)).start()
+
+
+def run(ports):
+    hub = Hub(LatencyConnection())
+
+    def commands(port):
+        for _ in range(COMMANDS):
+            hub.send(MsgPortOutput(port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64"))
+
+    threads = [threading.Thread(target=commands, args=(port,)) for port in ports]
+    start = time.time()
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    return len(ports) * COMMANDS / (time.time() - start)
+
+
+if __name__ == '__main__':
+    for ports in ([0x00], [0x00, 0x01], [0x00, 0x01, 0x02, 0x03]):
+        print("%d ports: %6.1f commands/s" % (len(ports), run(ports)))
+    print("same port from 2 threads: %6.1f commands/s" % run([0x00, 0x00]))
@@ -0,0 +1,31 @@
+"""
+Measures time spent in connection callback per notification: handling everything in place
+versus only enqueueing it for dispatcher thread
+"""
+import logging
+
+from benchmarks import FRAMES, ConnectionStub, measure, report
+from pylgbst.hub import Hub
+from pylgbst.messages import UpstreamMsg
+
+
+# attachments would create new peripheral each time
+NOTIFICATIONS = [x for x in FRAMES if x[2:3] != b'\x04']
+
+
+def run_all(hub):
+    for frame in NOTIFICATIONS:
+        hub._notify(0x0e, frame)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)  # frames are replayed without devices and requests, hub complains about it
+    hub = Hub(ConnectionStub())
+    hub.add_message_handler(UpstreamMsg, lambda msg: sum(range(100)))  # some application work
+    before = measure(lambda: run_all(hub), 2000) / len(NOTIFICATIONS)
+
+    dispatcher = hub.enable_dispatcher(size=len(NOTIFICATIONS) * 2000 * 5)
+    after = measure(lambda: run_all(hub), 2000) / len(NOTIFICATIONS)
+    hub.disable_dispatcher()
+    report("callback time per notification", before, after)
+    print("dispatcher stats: %s" % dispatcher.stats())
@@ -0,0 +1,30 @@
+"""
+Measures hub-side handling of port value notifications: decoding into message objects in notification thread
+versus passing raw bytes to peripheral
+"""
+from benchmarks import VALUE_FRAMES, ConnectionStub, measure, report
+from pylgbst.hub import Hub
+from pylgbst.messages import MsgPortValueSingle
+
+
+class PeripheralStub(object):
+    def queue_port_data(self, msg):
+        pass
+
+
+def run_all(hub):
+    for frame in VALUE_FRAMES:
+        hub._handle_frame(frame)
+
+
+if __name__ == '__main__':
+    fast = Hub(ConnectionStub())
+    slow = Hub(ConnectionStub())
+    slow.add_message_handler(MsgPortValueSingle, lambda msg: None)  # generic handler forces message objects
+    for hub in (fast, slow):
+        for port in (0x02, 0x3a, 0x3b, 0x3c):
+            hub.peripherals[port] = PeripheralStub()
+
+    before = measure(lambda: run_all(slow), 20000) / len(VALUE_FRAMES)
+    after = measure(lambda: run_all(fast), 20000) / len(VALUE_FRAMES)
+    report("port value per frame", before, after)
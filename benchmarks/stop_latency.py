@@ -0,0 +1,76 @@
+"""
+Measures time from stop command to its write into connection, while two motors get streamed commands
+through write scheduler and each command waits 10 ms for feedback. Compares regular and priority stop
+"""
+import logging
+import threading
+import time
+
+from benchmarks import ConnectionStub
+from pylgbst.hub import Hub
+from pylgbst.peripherals import EncodedMotor
+from pylgbst.utilities import monotonic
+
+
+class BusyHubStub(ConnectionStub):
+    def __init__(self):
+        self.handler = None
+        self.watched = None
+        self.seen = threading.Event()
+
+    def set_notify_handler(self, handler):
+        self.handler = handler
+
+    def write(self, handle, data):
+        if data == self.watched:
+            self.seen.set()
+        if data[2:3] == b'\x81' and ord(data[4:5]) & 0x10:
+            feedback = b'\x05\x00\x82' + data[3:4] + b'\x0a'
+            threading.Timer(0.01, self.handler, (handle, feedback)).start()
+
+
+def stream(motors, stopped):
+    num = 0
+    while not stopped.is_set():
+        for motor in motors:
+            motor.start_speed_async((num % 100) / 100.0)
+        num += 1
+        time.sleep(0.002)
+
+
+def measure_stop(conn, hub, motor, priority, trials=30):
+    latencies = []
+    for _ in range(trials):
+        msg = motor._stop_msg()
+        msg.priority = priority
+        conn.watched = msg.bytes()
+        conn.seen.clear()
+        start = monotonic()
+        hub.send_async(msg)
+        conn.seen.wait(5)
+        latencies.append(monotonic() - start)
+        time.sleep(0.02)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[-1]
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    conn = BusyHubStub()
+    hub = Hub(conn)
+    motors = [EncodedMotor(hub, port) for port in (0x00, 0x01)]
+    for motor in motors:
+        hub.peripherals[motor.port] = motor
+    hub.enable_write_scheduler(rate=100)
+
+    stopped = threading.Event()
+    threading.Thread(target=stream, args=(motors, stopped)).start()
+    time.sleep(0.2)
+    try:
+        for priority in (False, True):
+            median, worst = measure_stop(conn, hub, motors[0], priority)
+            print("%-20s median: %8.3f ms   worst: %8.3f ms" % ("priority stop" if priority else "regular stop",
+                                                                 median * 1000, worst * 1000))
+    finally:
+        stopped.set()
+        hub.disable_write_scheduler()
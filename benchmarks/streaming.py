@@ -0,0 +1,65 @@
+"""
+Simulates joystick streaming motor power at 1 kHz into hub that executes 200 commands per second
+and has buffer for 8 of them, compares direct writes with write scheduler
+"""
+import logging
+import time
+
+from benchmarks import ConnectionStub
+from pylgbst.hub import Hub
+from pylgbst.messages import MsgPortOutput
+from pylgbst.utilities import monotonic
+
+OVERFLOW = b"\x05\x00\x05\x81\x03"
+
+
+class BufferedHubStub(ConnectionStub):
+    def __init__(self, rate=200.0, capacity=8):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = 0.0
+        self.updated = monotonic()
+        self.accepted = 0
+        self.rejected = 0
+        self.handler = None
+
+    def set_notify_handler(self, handler):
+        self.handler = handler
+
+    def write(self, handle, data):
+        now = monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.rate)
+        self.updated = now
+        if self.level + 1 > self.capacity:
+            self.rejected += 1
+            self.handler(handle, OVERFLOW)
+        else:
+            self.level += 1
+            self.accepted += 1
+
+
+def stream(hub, seconds=1.0, frequency=1000):
+    end = monotonic() + seconds
+    num = 0
+    while monotonic() < end:
+        for port in (0x00, 0x01):
+            msg = MsgPortOutput(port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, bytes(bytearray([0x00, num % 100])))
+            msg.do_feedback = False
+            hub.send(msg)
+        num += 1
+        time.sleep(1.0 / frequency)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    for with_scheduler in (False, True):
+        conn = BufferedHubStub()
+        hub = Hub(conn)
+        if with_scheduler:
+            hub.enable_write_scheduler()
+        stream(hub)
+        if with_scheduler:
+            print("scheduler stats: %s" % hub.scheduler.stats())
+            hub.disable_write_scheduler()
+        print("%-20s accepted: %5d   overflow errors: %5d" % ("scheduler" if with_scheduler else "direct writes",
+                                                                 conn.accepted, conn.rejected))
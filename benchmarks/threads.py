@@ -0,0 +1,90 @@
+"""
+Compares threads and memory per hub: port data thread for each peripheral versus shared pool of workers
+"""
+import logging
+import threading
+import tracemalloc
+from binascii import unhexlify
+
+from benchmarks import ConnectionStub
+from pylgbst.dispatcher import PortDataPool
+from pylgbst.hub import Hub
+from pylgbst.peripherals import Button
+from pylgbst.utilities import queue
+
+HUBS = 20
+
+# Move Hub builtin devices, plus motor and sensor on ports C and D
+ATTACHMENTS = [bytes(unhexlify(x.replace(' ', ''))) for x in (
+    '0f00 04 00 0127000100000001000000', '0f00 04 01 0127000100000001000000', '0900 04 10 0227003738',
+    '0f00 04 32 0117000100000001000000', '0f00 04 3a 0128000000000100000001', '0f00 04 3b 0115000200000002000000',
+    '0f00 04 3c 0114000200000002000000', '0f00 04 02 0125000000001000000010', '0f00 04 03 0126000000001000000010',
+)]
+
+
+class ThreadPerPeripheral(object):
+    """How it was: each peripheral reads its own queue in own thread"""
+
+    def mailbox(self, handler, policy=None, discard=None):
+        return QueueReader(handler, 1)
+
+
+class QueueReader(object):
+    def __init__(self, handler, size):
+        self._queue = queue.Queue(size)
+        self._handler = handler
+        thr = threading.Thread(target=self._read)
+        thr.daemon = True
+        thr.start()
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def _read(self):
+        while True:
+            self._handler(self._queue.get())
+
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as fhd:
+            for line in fhd:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def make_hubs(pool):
+    threads, rss = threading.active_count(), rss_kb()
+    tracemalloc.start()
+    hubs = []
+    for _ in range(HUBS):
+        hub = Hub(ConnectionStub())
+        hub.port_data_pool = pool
+        for frame in ATTACHMENTS:
+            hub._notify(0x0e, frame)
+        Button(hub)
+        hubs.append(hub)
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return hubs, threading.active_count() - threads, rss_kb() - rss, traced
+
+
+def report_hubs(name, threads, rss, traced):
+    print("%-25s threads per hub: %5.1f   RSS per hub: %7.1f KiB   Python heap per hub: %7.1f KiB"
+          % (name, float(threads) / HUBS, float(rss) / HUBS, traced / 1024.0 / HUBS))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    pool = PortDataPool(workers=4)  # its threads serve all hubs, so they are not counted per hub
+    hubs, threads, rss, traced = make_hubs(pool)
+    report_hubs("shared pool (4 workers)", threads, rss, traced)
+    hubs, threads, rss, traced = make_hubs(ThreadPerPeripheral())
+    report_hubs("thread per peripheral", threads, rss, traced)
@@ -0,0 +1,29 @@
+"""
+Measures per-notification cost of debug logging with DEBUG level off, and of recording into trace buffer
+"""
+import logging
+
+from benchmarks import FRAMES, measure, report
+from pylgbst.trace import TraceBuffer
+from pylgbst.utilities import str2hex
+
+log = logging.getLogger('hub')
+log.setLevel(logging.INFO)
+
+frame = FRAMES[11]
+
+
+def eager():
+    log.debug("Notification on %s: %s", 0x0e, str2hex(frame))
+
+
+def guarded():
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Notification on %s: %s", 0x0e, str2hex(frame))
+
+
+if __name__ == '__main__':
+    report("debug log, level INFO", measure(eager), measure(guarded))
+
+    trace = TraceBuffer()
+    print("trace record: %8.1f ns" % measure(lambda: trace.record(TraceBuffer.IN, 0x0e, frame)))
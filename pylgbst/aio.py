@@ -0,0 +1,217 @@
+"""
+Hubs for asyncio programs, many hubs can run on single event loop. Needs Python 3.5+::
+
+    hub = await AsyncMoveHub.create()
+    await asyncio.gather(hub.motor_A.angled_async(90), hub.motor_B.angled_async(-90))
+    async for distance in hub.vision_sensor.stream(VisionSensor.DISTANCE_INCHES):
+        ...
+
+Notifications are handled in the loop, so message handlers and subscriber callbacks run there too and should not block.
+Blocking methods of peripherals can't be used with these hubs, use their `*_async` commands and `stream()` instead
+"""
+import asyncio
+import logging
+from collections import deque
+
+from pylgbst import get_connection_auto
+from pylgbst.hub import Hub, MoveHub, RequestTimeout
+from pylgbst.messages import MsgHubAction, MsgHubAttachedIO
+
+log = logging.getLogger('aio')
+
+
+class AsyncHub(Hub):
+    """
+    Hub with awaitable `send()`. Its `send_async()` returns asyncio future,
+    so `*_async` commands of peripherals become awaitable too
+    """
+    port_data_threads = False  # values come to subscribers right in the loop
+    auto_reconnect = False  # `reconnect()` blocks, call it from executor
+
+    def __init__(self, connection=None, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        super(AsyncHub, self).__init__(connection)
+
+    @classmethod
+    async def create(cls, connection=None, loop=None, **kwargs):
+        """
+        Makes hub without blocking the loop, prefer it to calling constructor from coroutines
+        """
+        loop = loop or asyncio.get_event_loop()
+        if connection is None:
+            connection = await loop.run_in_executor(None, get_connection_auto)
+        hub = cls(connection, loop, **kwargs)
+        await hub._prepare()
+        return hub
+
+    async def _prepare(self):
+        pass
+
+    def _notify(self, handle, data):
+        # connection calls it from own thread, all the handling happens in the loop
+        self._loop.call_soon_threadsafe(super(AsyncHub, self)._notify, handle, data)
+
+    def send_async(self, msg):
+        """
+        :rtype: asyncio.Future
+        """
+        return asyncio.wrap_future(super(AsyncHub, self).send_async(msg), loop=self._loop)
+
+    async def send(self, msg, timeout=None, retry=None):
+        """
+        Same as `Hub.send()`, but waits for reply without blocking the loop
+        """
+        timeout = self.timeout if timeout is None else timeout
+        retry = self.retry_policy if retry is None else retry
+        attempt = 1
+        while True:
+            try:
+                return await asyncio.wait_for(self.send_async(msg), timeout)
+            except asyncio.TimeoutError:
+                if retry is None or not retry.should_retry(msg, attempt):
+                    raise RequestTimeout(msg, timeout)
+                log.warning("Retrying %r after timeout, attempt %s", msg, attempt)
+                await asyncio.sleep(retry.delay(attempt))
+                attempt += 1
+
+    async def disconnect(self):
+        self._disconnecting = True
+        await self.send(MsgHubAction(MsgHubAction.DISCONNECT))
+        self._frames.reset()
+
+    async def switch_off(self):
+        self._disconnecting = True
+        await self.send(MsgHubAction(MsgHubAction.SWITCH_OFF))
+
+
+class AsyncMoveHub(AsyncHub, MoveHub):
+    """
+    Move Hub for asyncio programs, make it with `await AsyncMoveHub.create()` to have builtin devices ready
+    """
+
+    def __init__(self, connection=None, loop=None, report_status=True, profiles=None):
+        self._report_status_enabled = report_status
+        super(AsyncMoveHub, self).__init__(connection, loop)
+        self.profiles = profiles  # used in `_prepare()`
+
+    def _startup(self, report_status):
+        pass  # the work is done in `_prepare()`
+
+    async def _prepare(self, timeout=10.0):
+        cached = self._apply_profile()
+        changed = asyncio.Event()
+        signal = lambda msg: changed.set()
+        self.add_message_handler(MsgHubAttachedIO, signal)
+        try:
+            if not await self._wait_for_change(changed, lambda: all(self._builtin_devices()), timeout):
+                log.warning("Got only these devices: %s", self._builtin_devices())
+
+            if self._report_status_enabled and not cached:
+                # different replies, so requests go together
+                self._log_status(*await asyncio.gather(*[self.send(msg) for msg in self._status_requests()]))
+
+            await self._wait_for_change(changed, lambda: not self._unconfirmed_ports(), self.confirm_timeout)
+        finally:
+            self.remove_message_handler(MsgHubAttachedIO, signal)
+
+        self._drop_unconfirmed()
+        self._started = True
+        self._save_profile()
+
+
+    async def _wait_for_change(self, changed, condition, timeout):
+        """
+        :return: False if condition has not come true in time
+        """
+        deadline = self._loop.time() + timeout
+        while True:
+            changed.clear()
+            if condition():
+                return True
+            try:
+                await asyncio.wait_for(changed.wait(), deadline - self._loop.time())
+            except asyncio.TimeoutError:
+                return condition()
+
+
+class PortStream(object):
+    """
+    Async iterator of peripheral values, made by `Peripheral.stream()`.
+    Value is a tuple for modes with several values, or the value itself.
+    Keeps last `maxsize` values when consumer is slow, number of dropped ones is in `dropped` field.
+    Use it as async context manager or call `aclose()` to unsubscribe::
+
+        async with hub.voltage.stream() as volts:
+            async for value in volts:
+                ...
+    """
+
+    def __init__(self, peripheral, mode=0x00, granularity=1, maxsize=16):
+        """
+        :type peripheral: pylgbst.peripherals.Peripheral
+        """
+        self.peripheral = peripheral
+        self.mode = mode
+        self.granularity = granularity
+        self.dropped = 0
+        self._values = deque(maxlen=maxsize)
+        self._has_values = asyncio.Event()
+        self._subscribed = False
+        self._closed = False
+
+    def _on_values(self, *values):
+        if len(self._values) == self._values.maxlen:
+            self.dropped += 1
+        self._values.append(values[0] if len(values) == 1 else values)
+        self._has_values.set()
+
+    async def open(self):
+        if self._subscribed:
+            return
+
+        dev = self.peripheral
+        if dev._subscribers and (dev._combined or dev._port_mode.mode != self.mode):
+            raise ValueError("Port is in active mode %r, unsubscribe all subscribers first" % dev._port_mode)
+
+        msg = dev._port_mode_msg(self.mode, True, self.granularity)
+        if msg is not None:
+            dev._port_mode_changed(await dev.hub.send(msg))
+        dev._subscribers.add(self._on_values)
+        self._subscribed = True
+        self._closed = False
+
+    async def aclose(self):
+        if not self._subscribed:
+            return
+
+        dev = self.peripheral
+        dev._subscribers.discard(self._on_values)
+        self._subscribed = False
+        self._closed = True
+        self._has_values.set()  # wake up consumer, it stops after remaining values
+
+        if not dev._subscribers:
+            msg = dev._port_mode_msg(dev._port_mode.mode, False, None)
+            if msg is not None:
+                dev._port_mode_changed(await dev.hub.send(msg))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._subscribed and not self._closed:
+            await self.open()
+
+        while not self._values:
+            if self._closed:
+                raise StopAsyncIteration
+            self._has_values.clear()
+            await self._has_values.wait()
+        return self._values.popleft()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
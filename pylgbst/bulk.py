@@ -0,0 +1,161 @@
+"""
+Vectorized decoding of recorded notifications, for offline analysis of large logs.
+Needs numpy, install it with `pip install pylgbst[bulk]`
+
+Port value messages do not carry sensor mode, so caller tells which peripheral and mode each port was in::
+
+    values = decode_port_values(recorded, {0x02: (VisionSensor, VisionSensor.COLOR_DISTANCE_FLOAT)})
+    distances = values[(MsgPortValueSingle.TYPE, 0x02, VisionSensor.COLOR_DISTANCE_FLOAT)]['distance']
+"""
+import logging
+
+import numpy
+
+from pylgbst.messages import MSG_LEN_EXTENDED, MsgPortValueSingle
+from pylgbst.peripherals import EncodedMotor, TiltSensor, VisionSensor, Voltage, Current
+
+log = logging.getLogger('bulk')
+
+
+def _color_distance(raw):
+    distance = raw['distance'].astype(numpy.float64)
+    partial = raw['partial']
+    nonzero = partial != 0
+    distance[nonzero] += 1.0 / partial[nonzero]
+    return {'color': raw['color'], 'distance': distance}
+
+
+def _rgb(raw):
+    return dict((name, (255 * raw[name] / 1023.0).astype(numpy.int64)) for name in ('red', 'green', 'blue'))
+
+
+def _volts(raw):
+    return {'volts': 9600.0 * raw['volts'] / 3893.0 / 1000.0}
+
+
+def _milliampers(raw):
+    return {'milliampers': 2444 * raw['milliampers'] / 4095.0}
+
+
+# (peripheral class, mode) => (payload layout, conversion into output columns)
+# conversions are the same as in `_decode_port_data` of peripheral classes, None means raw fields as they are
+DECODERS = {
+    (EncodedMotor, EncodedMotor.SENSOR_ANGLE): ([('angle', '<i4')], None),
+    (EncodedMotor, EncodedMotor.SENSOR_SPEED): ([('speed', '<i1')], None),
+
+    (TiltSensor, TiltSensor.MODE_2AXIS_ANGLE): ([('roll', '<i1'), ('pitch', '<i1')], None),
+    (TiltSensor, TiltSensor.MODE_2AXIS_SIMPLE): ([('state', '<u1')], None),
+    (TiltSensor, TiltSensor.MODE_3AXIS_SIMPLE): ([('state', '<u1')], None),
+    (TiltSensor, TiltSensor.MODE_IMPACT_COUNT): ([('count', '<u4')], None),
+    (TiltSensor, TiltSensor.MODE_3AXIS_ACCEL): ([('roll', '<i1'), ('pitch', '<i1'), ('yaw', '<i1')], None),
+    (TiltSensor, TiltSensor.MODE_ORIENT_CF): ([('state', '<u1')], None),
+    (TiltSensor, TiltSensor.MODE_IMPACT_CF): ([('state', '<u1')], None),
+    (TiltSensor, TiltSensor.MODE_CALIBRATION): ([('x', '<u1'), ('y', '<u1'), ('z', '<u1')], None),
+
+    (VisionSensor, VisionSensor.COLOR_INDEX): ([('color', '<u1')], None),
+    (VisionSensor, VisionSensor.COLOR_DISTANCE_FLOAT): (
+        [('color', '<u1'), ('distance', '<u1'), ('unused', '<u1'), ('partial', '<u1')], _color_distance),
+    (VisionSensor, VisionSensor.DISTANCE_INCHES): ([('distance', '<u1')], None),
+    (VisionSensor, VisionSensor.DISTANCE_REFLECTED): (
+        [('reflected', '<u1')], lambda raw: {'reflected': raw['reflected'] / 100.0}),
+    (VisionSensor, VisionSensor.AMBIENT_LIGHT): (
+        [('luminosity', '<u1')], lambda raw: {'luminosity': raw['luminosity'] / 100.0}),
+    (VisionSensor, VisionSensor.COUNT_2INCH): ([('count', '<u4')], None),
+    (VisionSensor, VisionSensor.COLOR_RGB): ([('red', '<u2'), ('green', '<u2'), ('blue', '<u2')], _rgb),
+    (VisionSensor, VisionSensor.DEBUG): (
+        [('val1', '<u2'), ('val2', '<u2')], lambda raw: {'val1': 10 * raw['val1'] / 1023.0,
+                                                         'val2': 10 * raw['val2'] / 1023.0}),
+    (VisionSensor, VisionSensor.CALIBRATE): ([('val%d' % x, '<u2') for x in range(8)], None),
+
+    (Voltage, Voltage.VOLTAGE_L): ([('volts', '<u2')], _volts),
+    (Voltage, Voltage.VOLTAGE_S): ([('volts', '<u2')], _volts),
+    (Current, Current.CURRENT_L): ([('milliampers', '<u2')], _milliampers),
+    (Current, Current.CURRENT_S): ([('milliampers', '<u2')], _milliampers),
+}
+
+
+def split_frames(data):
+    """
+    Finds message boundaries in buffer of messages that follow each other
+
+    :return: numpy arrays of message offsets, lengths, and lengths of their length headers
+    """
+    data = bytearray(data)
+    offsets = []
+    lengths = []
+    headers = []
+    offset = 0
+    size = len(data)
+    while offset < size:
+        msglen = data[offset]
+        header_len = 1
+        if msglen & MSG_LEN_EXTENDED:
+            if offset + 1 >= size:
+                break
+            msglen = (msglen & 0x7F) | (data[offset + 1] << 7)
+            header_len = 2
+
+        if msglen < header_len + 2 or offset + msglen > size:
+            log.warning("Stopped at broken or incomplete message at offset %d", offset)
+            break
+
+        offsets.append(offset)
+        lengths.append(msglen)
+        headers.append(header_len)
+        offset += msglen
+
+    return tuple(numpy.array(x, dtype=numpy.int64) for x in (offsets, lengths, headers))
+
+
+def _find_decoder(peripheral_class, mode):
+    for klass in peripheral_class.__mro__:
+        if (klass, mode) in DECODERS:
+            return DECODERS[(klass, mode)]
+    raise ValueError("No bulk decoder for %s in mode %s" % (peripheral_class.__name__, mode))
+
+
+def decode_port_values(data, port_modes):
+    """
+    Decodes all single port value messages in buffer at once, other messages are skipped
+
+    :param data: bytes of messages that follow each other, like concatenated notifications
+    :param port_modes: dict of port => (peripheral class, mode)
+    :return: dict of (message type, port, mode) => numpy structured array,
+             it has `frame` column with message number in buffer, then the values
+    """
+    buf = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    offsets, msglens, headers = split_frames(data)
+    if not len(offsets):
+        return {}
+
+    starts = offsets + headers  # hub id, type, port follow length
+    types = buf[starts + 1]
+    ports = buf[starts + 2]
+    frame_numbers = numpy.arange(len(offsets))
+
+    result = {}
+    for port, (peripheral_class, mode) in port_modes.items():
+        layout, convert = _find_decoder(peripheral_class, mode)
+        raw_dtype = numpy.dtype(layout)
+
+        selected = (types == MsgPortValueSingle.TYPE) & (ports == port)
+        payload_starts = starts[selected] + 3
+        short = payload_starts + raw_dtype.itemsize > offsets[selected] + msglens[selected]
+        if short.any():
+            log.warning("Skipped %d port 0x%x values that are too short for mode %s", short.sum(), port, mode)
+            payload_starts = payload_starts[~short]
+
+        gathered = buf[payload_starts[:, None] + numpy.arange(raw_dtype.itemsize)]
+        raw = numpy.ascontiguousarray(gathered).view(raw_dtype).reshape(-1)
+        columns = convert(raw) if convert else dict((name, raw[name]) for name in raw_dtype.names)
+
+        names = [name for name, _ in layout if name in columns]
+        out_dtype = [('frame', numpy.int64)] + [(name, columns[name].dtype) for name in names]
+        values = numpy.empty(len(raw), dtype=out_dtype)
+        values['frame'] = frame_numbers[selected][~short]
+        for name in names:
+            values[name] = columns[name]
+
+        result[(MsgPortValueSingle.TYPE, port, mode)] = values
+
+    return result
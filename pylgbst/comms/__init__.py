@@ -25,6 +25,8 @@ MOVE_HUB_HARDWARE_HANDLE = 0x0E
 
 
 class Connection(object):
+    hub_mac = None  # address of connected hub, when connection knows it
+
     def connect(self, hub_mac=None):
         pass
 
@@ -58,6 +60,7 @@ class Connection(object):
 
             if matched:
                 log.info("Found %s at %s", name, address)
+                self.hub_mac = address
 
         return matched
 
@@ -101,7 +104,8 @@ class DebugServer(object):
         self.sock.close()
 
     def _notify_dummy(self, handle, data):
-        log.debug("Dropped notification from handle %s: %s", handle, binascii.hexlify(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Dropped notification from handle %s: %s", handle, binascii.hexlify(data))
         self._check_shutdown(data)
 
     def _notify(self, conn, handle, data):
@@ -108,10 +108,13 @@ class BluepyConnection(Connection):
         return self
 
     def disconnect(self):
-        self._peripheral.disconnect()
+        peripheral, self._peripheral = self._peripheral, None  # so `connect()` can find hub again
+        if peripheral:
+            peripheral.disconnect()
 
     def write(self, handle, data):
-        log.debug("Writing to handle %s: %s", handle, str2hex(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Writing to handle %s: %s", handle, str2hex(data))
         self._peripheral.write(handle, data)
 
     def set_notify_handler(self, handler):
@@ -31,7 +31,8 @@ class CustomDevice(gatt.Device, object):
             raise exc
 
     def write(self, data):
-        log.debug("Writing to handle: %s", str2hex(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Writing to handle: %s", str2hex(data))
         return self._handle.write_value(data)
 
     def enable_notifications(self):
@@ -59,7 +60,8 @@ class CustomDevice(gatt.Device, object):
 
     def characteristic_value_updated(self, characteristic, value):
         value = self._fix_weird_bug(value)
-        log.debug('Notification in GattDevice: %s', str2hex(value))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Notification in GattDevice: %s', str2hex(value))
         self._notify_callback(MOVE_HUB_HARDWARE_HANDLE, value)
 
     def _fix_weird_bug(self, value):
@@ -32,7 +32,8 @@ class Requester(GATTRequester):
         self._notify_queue.put((handle, data))
 
     def on_indication(self, handle, data):
-        log.debug("Indication on handle %s: %s", handle, str2hex(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Indication on handle %s: %s", handle, str2hex(data))
 
     def _dispatch_notifications(self):
         while True:
@@ -87,7 +88,8 @@ class GattLibConnection(Connection):
             raise RuntimeError("No requester available")
 
     def write(self, handle, data):
-        log.debug("Writing to %s: %s", handle, str2hex(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Writing to %s: %s", handle, str2hex(data))
         return self.requester.write_by_handle(handle, data)
 
     def is_alive(self):
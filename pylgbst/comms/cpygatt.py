@@ -43,10 +43,13 @@ class GattoolConnection(Connection):
         return self
 
     def disconnect(self):
-        self._conn_hnd.disconnect()
+        conn_hnd, self._conn_hnd = self._conn_hnd, None  # so `connect()` can find hub again
+        if conn_hnd:
+            conn_hnd.disconnect()
 
     def write(self, handle, data):
-        log.debug("Writing to handle %s: %s", handle, str2hex(data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Writing to handle %s: %s", handle, str2hex(data))
         return self._conn_hnd.char_write_handle(handle, bytearray(data))
 
     def set_notify_handler(self, handler):
@@ -0,0 +1,315 @@
+"""
+Moves handling of notifications out of connection callback thread, see `Hub.enable_dispatcher()`,
+and port values out of notification handling, see `Hub.port_data_pool`
+"""
+import logging
+import traceback
+from collections import deque
+from threading import Thread, Event, Condition, Lock
+
+from pylgbst.utilities import monotonic
+
+log = logging.getLogger('dispatcher')
+
+
+class NotificationDispatcher(object):
+    """
+    Bounded ring of raw notifications with own thread that passes them to handler.
+    Connection callback only timestamps and appends data, so slow message handlers do not delay BLE reception.
+    When ring is full, the oldest notification is dropped
+    """
+
+    def __init__(self, handler, size=1024):
+        """
+        :param handler: callable(handle, data), called in dispatcher thread
+        """
+        self.size = size
+        self._handler = handler
+        self._ring = deque(maxlen=size)
+        self._wakeup = Event()
+        self._running = True
+
+        self.dispatched = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.lag = 0.0  # seconds between reception and handling of the last notification
+        self.max_lag = 0.0
+
+        self._thread = Thread(target=self._loop)
+        self._thread.setDaemon(True)
+        self._thread.setName("Notification dispatcher")
+        self._thread.start()
+
+    def put(self, handle, data):
+        depth = len(self._ring) + 1
+        if depth > self.size:
+            self.dropped += 1
+        elif depth > self.max_depth:
+            self.max_depth = depth
+        self._ring.append((monotonic(), handle, data))
+        self._wakeup.set()
+
+    @property
+    def depth(self):
+        return len(self._ring)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
+
+    def stop(self, timeout=1.0):
+        """
+        Stops the thread after it handles notifications already in ring
+        """
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+    def _loop(self):
+        ring = self._ring
+        while self._running or ring:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while ring:
+                stamp, handle, data = ring.popleft()
+                self.lag = monotonic() - stamp
+                if self.lag > self.max_lag:
+                    self.max_lag = self.lag
+                try:
+                    self._handler(handle, data)
+                except BaseException:
+                    log.warning("%s", traceback.format_exc())
+                    log.warning("Failed to handle notification on %s", handle)
+                self.dispatched += 1
+
+
+class PortDataPool(object):
+    """
+    Worker threads shared by peripherals of all hubs, they pass port values to subscribers.
+    Values of one port are handled in order, never by two workers at once.
+    Subscriber callback that blocks holds its worker, so have more workers than such callbacks
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._ready = deque()  # mailboxes that have values and are not taken by worker
+        self._cond = Condition()
+
+        self.handled = 0
+        self.dropped = 0
+
+        for num in range(workers):
+            thr = Thread(target=self._loop)
+            thr.setDaemon(True)
+            thr.setName("Port data worker %s" % num)
+            thr.start()
+
+    def mailbox(self, handler, policy=None, discard=None):
+        """
+        :param handler: callable(item), called in worker thread
+        :param policy: what to do when items come faster than handler takes them, `FifoPolicy(1)` by default
+        :param discard: callable(item) for items that were dropped or conflated
+        :rtype: PortMailbox
+        """
+        return PortMailbox(self, handler, policy or DEFAULT_POLICY, discard)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "ready": len(self._ready),
+            "handled": self.handled,
+            "dropped": self.dropped,
+        }
+
+    def _loop(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._ready:
+                    cond.wait()
+                mailbox = self._ready.popleft()
+                item = mailbox.items.popleft()
+                if mailbox.blocked:
+                    cond.notify_all()  # there is room for producer now
+
+            try:
+                mailbox.handler(item)
+            except BaseException:
+                log.warning("%s", traceback.format_exc())
+                log.warning("Failed to handle %r", item)
+
+            with cond:
+                self.handled += 1
+                mailbox.delivered += 1
+                if mailbox.items:
+                    self._ready.append(mailbox)  # behind other ports, so busy port does not starve them
+                    cond.notify()
+                else:
+                    mailbox.scheduled = False
+
+
+class PortMailbox(object):
+    """
+    Items of one peripheral waiting for `PortDataPool` worker, `policy` decides what happens when they pile up
+    """
+
+    def __init__(self, pool, handler, policy, discard=None):
+        self.pool = pool
+        self.handler = handler
+        self.policy = policy
+        self.discard = discard
+        self.items = deque()
+        self.scheduled = False  # in ready queue of pool or handled by worker
+        self.blocked = 0  # producers waiting for room
+
+        self.delivered = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.received = 0
+
+    def put(self, item):
+        """
+        :return: False if item was dropped
+        """
+        pool = self.pool
+        with pool._cond:
+            self.received += 1
+            if not self.policy.offer(self, item):
+                self._drop(item)
+                return False
+
+            if not self.scheduled:
+                self.scheduled = True
+                pool._ready.append(self)
+                pool._cond.notify()
+        return True
+
+    def stats(self):
+        return {
+            "waiting": len(self.items),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+        }
+
+    def _drop(self, item):
+        self.dropped += 1
+        self.pool.dropped += 1
+        if self.discard is not None:
+            self.discard(item)
+
+    def _conflate(self):
+        item = self.items.popleft()
+        self.conflated += 1
+        if self.discard is not None:
+            self.discard(item)
+
+
+class _Policy(object):
+    """
+    Policies of the same type and parameters are equal, so subscribers may pass their own instances
+    """
+
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), tuple(sorted(vars(self).items()))))
+
+
+class FifoPolicy(_Policy):
+    """
+    Keeps up to `size` items in order, newer items are dropped when it is full
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+
+    def offer(self, mailbox, item):
+        if len(mailbox.items) >= self.size:
+            return False
+        mailbox.items.append(item)
+        return True
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.size)
+
+
+class ConflatePolicy(_Policy):
+    """
+    Latest wins: only the newest item waits, it replaces older one that was not taken yet
+    """
+
+    def offer(self, mailbox, item):
+        while mailbox.items:
+            mailbox._conflate()
+        mailbox.items.append(item)
+        return True
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+
+class BlockPolicy(FifoPolicy):
+    """
+    Loses nothing: when `size` items wait, producer waits for room. Producer is notification handling thread,
+    so while it waits, nothing else comes from hub, including replies that subscriber may wait for
+    """
+
+    def __init__(self, size=64):
+        super(BlockPolicy, self).__init__(size)
+
+    def offer(self, mailbox, item):
+        mailbox.blocked += 1
+        try:
+            while len(mailbox.items) >= self.size:
+                mailbox.pool._cond.wait()
+        finally:
+            mailbox.blocked -= 1
+        mailbox.items.append(item)
+        return True
+
+
+class SamplePolicy(FifoPolicy):
+    """
+    Takes every `every`-th item and drops the rest, taken ones wait as in `FifoPolicy(size)`
+    """
+
+    def __init__(self, every=2, size=1):
+        super(SamplePolicy, self).__init__(size)
+        self.every = every
+
+    def offer(self, mailbox, item):
+        if (mailbox.received - 1) % self.every:
+            return False
+        return super(SamplePolicy, self).offer(mailbox, item)
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.every, self.size)
+
+
+DEFAULT_POLICY = FifoPolicy(1)  # what peripherals always did: newest value is lost while subscriber is busy
+
+_shared_pool = None
+_shared_pool_lock = Lock()
+
+
+def shared_port_data_pool():
+    """
+    :return: pool used by hubs which have no own `port_data_pool`, made on first call
+    :rtype: PortDataPool
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = PortDataPool()
+        return _shared_pool
@@ -1,11 +1,16 @@
+import itertools
 import threading
 import time
+import traceback
+from collections import deque
 
 from pylgbst import get_connection_auto
+from pylgbst.dispatcher import NotificationDispatcher
 from pylgbst.messages import *
 from pylgbst.peripherals import *
-from pylgbst.utilities import str2hex, usbyte, ushort
-from pylgbst.utilities import queue
+from pylgbst.scheduler import WriteScheduler
+from pylgbst.trace import TraceBuffer
+from pylgbst.utilities import str2hex, usbyte, ushort, monotonic, Future
 
 log = logging.getLogger('hub')
 
@@ -26,17 +31,40 @@ class Hub(object):
     """
     :type connection: pylgbst.comms.Connection
     :type peripherals: dict[int,Peripheral]
+    :type trace: TraceBuffer
+    :type dispatcher: NotificationDispatcher
+    :type scheduler: WriteScheduler
+    :type retry_policy: RetryPolicy
     """
     HUB_HARDWARE_HANDLE = 0x0E
+    port_data_threads = True  # peripherals handle their port values in worker threads
+    port_data_pool = None  # PortDataPool for peripherals of this hub, None means the shared one
+    auto_reconnect = True  # reconnect when hub drops connection not asked by `disconnect()`
 
     def __init__(self, connection=None):
-        self._msg_handlers = []
+        self.attached_io = {}  # port => type and revisions or virtual ports of attached IO, as hub reported it
+        self.generations = {}  # port => number of device changes on it
+        self._attach_lock = threading.RLock()
+        self._device_handlers = []
+        self._msg_handlers = []  # (msg class, handler) in order of adding, replaced as whole on change
+        self._dispatch = {}  # concrete msg class => handlers for it, rebuilt lazily
+        self._value_handlers = 0  # handlers besides ours that want to see MsgPortValueSingle objects
         self.peripherals = {}
-        self._sync_request = None
-        self._sync_replies = queue.Queue(1)
+        self._pending = {}  # reply key => deque of PendingRequest, only the first one is sent
         self._sync_lock = threading.Lock()
+        self.timeout = None  # default seconds to wait for reply, None means forever
+        self.retry_policy = None  # default for idempotent requests that timed out
+        self._frames = FrameAssembler()
+        self.trace = None
+        self.dispatcher = None
+        self.scheduler = None
+        self.reconnect_stats = {"reconnects": 0, "failures": 0, "duration": None, "data_gap": None}
+        self._disconnecting = False
+        self._data_gap_start = None  # when port data stopped because of disconnect
 
+        self._devices_changed = threading.Condition()
         self.add_message_handler(MsgHubAttachedIO, self._handle_device_change)
+        self.add_message_handler(MsgHubAttachedIO, self._signal_device_change)  # after subclasses update fields
         self.add_message_handler(MsgPortValueSingle, self._handle_sensor_data)
         self.add_message_handler(MsgPortValueCombined, self._handle_sensor_data)
         self.add_message_handler(MsgGenericError, self._handle_error)
@@ -53,65 +81,439 @@ class Hub(object):
             self.connection.disconnect()
 
     def add_message_handler(self, classname, callback):
-        self._msg_handlers.append((classname, callback))
+        if issubclass(MsgPortValueSingle, classname) and callback != self._handle_sensor_data:
+            self._value_handlers += 1
+        self._msg_handlers = self._msg_handlers + [(classname, callback)]
+        self._dispatch = {}
 
-    def send(self, msg):
+    def remove_message_handler(self, classname, callback):
+        if (classname, callback) not in self._msg_handlers:
+            log.debug("Handler %s for %s is not registered", callback, classname)
+            return
+
+        handlers = list(self._msg_handlers)
+        handlers.remove((classname, callback))
+        if issubclass(MsgPortValueSingle, classname) and callback != self._handle_sensor_data:
+            self._value_handlers -= 1
+        self._msg_handlers = handlers
+        self._dispatch = {}
+
+    def add_device_handler(self, callback):
+        """
+        Makes hub call `callback(event)` with `DeviceEvent` each time device gets attached to or detached from port.
+        Callback runs in notification handling thread and should not block
+        """
+        self._device_handlers = self._device_handlers + [callback]
+
+    def remove_device_handler(self, callback):
+        if callback not in self._device_handlers:
+            log.debug("Device handler %s is not registered", callback)
+            return
+
+        handlers = list(self._device_handlers)
+        handlers.remove(callback)
+        self._device_handlers = handlers
+
+    def _handlers_for(self, msg_class):
+        dispatch = self._dispatch
+        handlers = dispatch.get(msg_class)
+        if handlers is None:
+            handlers = tuple(handler for classname, handler in self._msg_handlers if issubclass(msg_class, classname))
+            dispatch[msg_class] = handlers
+        return handlers
+
+    def enable_trace(self, records=4096, max_data=64):
+        """
+        Starts recording all notifications and writes into ring buffer, keeping last `records` of them
+
+        :rtype: TraceBuffer
+        """
+        self.trace = TraceBuffer(records, max_data)
+        return self.trace
+
+    def disable_trace(self):
+        self.trace = None
+
+    def enable_dispatcher(self, size=1024):
+        """
+        Makes connection callback only enqueue notifications, decoding and message handlers run in separate thread
+
+        :param size: how many notifications can wait for handling, the oldest are dropped when more come
+        :rtype: NotificationDispatcher
+        """
+        if self.dispatcher is None:
+            self.dispatcher = NotificationDispatcher(self._handle_notification, size)
+        return self.dispatcher
+
+    def disable_dispatcher(self):
+        dispatcher, self.dispatcher = self.dispatcher, None
+        if dispatcher is not None:
+            dispatcher.stop()
+
+    def enable_write_scheduler(self, rate=None, max_interval=0.5):
+        """
+        Makes writes go through queue with pause between them, that grows when hub reports buffer overflow.
+        Unsent set-point commands, like motor power, are replaced by newer ones for the same port
+
+        :param rate: max writes per second, None means no limit until overflow happens
+        :param max_interval: longest pause between writes after overflows, seconds
+        :rtype: WriteScheduler
+        """
+        if self.scheduler is None:
+            self.scheduler = WriteScheduler(self._write_now, rate, max_interval)
+        return self.scheduler
+
+    def disable_write_scheduler(self):
+        scheduler, self.scheduler = self.scheduler, None
+        if scheduler is not None:
+            scheduler.stop()
+
+    def dump_trace(self, stream):
+        """
+        Writes recorded trace as text, see `enable_trace()`
+        """
+        if self.trace is None:
+            raise RuntimeError("Trace is not enabled")
+        self.trace.dump(stream)
+
+    def send(self, msg, timeout=None, retry=None):
         """
         :type msg: pylgbst.messages.DownstreamMsg
+        :param timeout: seconds to wait for reply, including wait for other requests with the same reply key,
+                        default is `self.timeout`
+        :type retry: RetryPolicy
+        :param retry: how to retry idempotent request after timeout, default is `self.retry_policy`
         :rtype: pylgbst.messages.UpstreamMsg
+        :raises RequestTimeout: reply did not come in time
+        :raises RequestCancelled: see `cancel_requests()`
         """
         log.debug("Send message: %r", msg)
         msgbytes = msg.bytes()
-        if msg.needs_reply:
-            with self._sync_lock:
-                assert not self._sync_request, "Pending request %r while trying to put %r" % (self._sync_request, msg)
-                self._sync_request = msg
-                log.debug("Waiting for sync reply to %r...", msg)
-
-            self.connection.write(self.HUB_HARDWARE_HANDLE, msgbytes)
-            resp = self._sync_replies.get()
-            log.debug("Fetched sync reply: %r", resp)
-            if isinstance(resp, MsgGenericError):
-                raise RuntimeError(resp.message())
-            return resp
-        else:
-            self.connection.write(self.HUB_HARDWARE_HANDLE, msgbytes)
+        if not msg.needs_reply:
+            self._write(msgbytes, msg.coalesce_key(), msg.priority)
             return None
 
+        timeout = self.timeout if timeout is None else timeout
+        retry = self.retry_policy if retry is None else retry
+        attempt = 1
+        while True:
+            try:
+                resp = self._send_sync(msg, msgbytes, timeout)
+                break
+            except RequestTimeout:
+                if retry is None or not retry.should_retry(msg, attempt):
+                    raise
+                log.warning("Retrying %r after timeout, attempt %s", msg, attempt)
+                retry.pause(attempt)
+                attempt += 1
+
+        log.debug("Fetched sync reply: %r", resp)
+        if isinstance(resp, MsgGenericError):
+            raise RuntimeError(resp.message())
+        return resp
+
+    def send_async(self, msg):
+        """
+        Sends message without waiting for reply. Requests with the same reply key still go one after another,
+        so it is like `send()` from separate thread
+
+        :type msg: pylgbst.messages.DownstreamMsg
+        :rtype: concurrent.futures.Future
+        :return: future of the reply, its result is None for messages that need no reply.
+                 Cancelling the future releases pending request
+        """
+        if Future is None:
+            raise RuntimeError("Async sending needs `futures` package on Python 2")
+
+        log.debug("Send message async: %r", msg)
+        msgbytes = msg.bytes()
+        future = Future()
+        if not msg.needs_reply:
+            self._write(msgbytes, msg.coalesce_key(), msg.priority)
+            future.set_running_or_notify_cancel()
+            future.set_result(None)
+            return future
+
+        request = PendingRequest(msg, msgbytes, future)
+        key = msg.reply_key()
+        future.add_done_callback(lambda _: future.cancelled() and self._cancel_request(key, request))
+        self._enqueue_request(key, request)
+        return future
+
+    def _send_sync(self, msg, msgbytes, timeout):
+        request = PendingRequest(msg, msgbytes)
+        self._enqueue_request(msg.reply_key(), request)
+        return self._wait_sync(request, timeout)
+
+    def _send_together(self, msgs):
+        """
+        Sync way to send requests with different reply keys together, when there are no futures.
+        All of them are pending before the first reply comes, so replies that come together are not lost
+
+        :return: replies in order of requests
+        """
+        requests = [PendingRequest(msg, msg.bytes()) for msg in msgs]
+        for request in requests:
+            self._enqueue_request(request.msg.reply_key(), request)
+
+        for request in requests:
+            if request.turn.is_set() and not request.sent and not request.done.is_set():
+                request.sent = True
+                self._write(request.msgbytes)
+
+        try:
+            replies = [self._wait_sync(request, self.timeout) for request in requests]
+        except BaseException:
+            for request in requests:
+                self._cancel_request(request.msg.reply_key(), request)
+            raise
+
+        for reply in replies:
+            if isinstance(reply, MsgGenericError):
+                raise RuntimeError(reply.message())
+        return replies
+
+    def _wait_sync(self, request, timeout):
+        msg, key = request.msg, request.msg.reply_key()
+        deadline = None if timeout is None else monotonic() + timeout
+        if not request.turn.is_set():
+            log.debug("Waiting for turn to send %r", msg)
+            if not request.turn.wait(self._time_left(deadline)) and self._cancel_request(key, request):
+                raise RequestTimeout(msg, timeout)
+
+        if not request.done.is_set():
+            if not request.sent:
+                request.sent = True
+                self._write(request.msgbytes)
+            log.debug("Waiting for sync reply to %r...", msg)
+            if not request.done.wait(self._time_left(deadline)) and self._cancel_request(key, request):
+                raise RequestTimeout(msg, timeout)
+
+        if request.error:
+            raise request.error
+        return request.reply
+
+    @staticmethod
+    def _time_left(deadline):
+        return None if deadline is None else max(0.0, deadline - monotonic())
+
+    def _enqueue_request(self, key, request):
+        with self._sync_lock:
+            queued = self._pending.setdefault(key, deque())
+            if request.msg.priority:
+                # goes right after the requests already sent, and is sent now
+                in_flight = sum(1 for x in queued if x.sent)
+                queued.rotate(-in_flight)
+                queued.appendleft(request)
+                queued.rotate(in_flight)
+                request.sent = True
+            elif self.scheduler is not None and len(queued) > 1 and request.replaces(queued[-1]):
+                request.superseded.append(queued.pop())
+                queued.append(request)
+            else:
+                queued.append(request)
+            is_first = len(queued) == 1
+
+        if request.msg.priority:
+            self._write_now(request.msgbytes)
+        elif is_first:
+            self._give_turn(request)
+
+    def _give_turn(self, request):
+        """
+        Sync request is sent by its waiting thread, async one is sent right away
+        """
+        if request.future is None:
+            request.turn.set()
+        elif not request.done.is_set() and not request.sent:
+            request.sent = True
+            self._write(request.msgbytes)
+
+    def _pop_request(self, key):
+        """
+        Removes the first request of key, must be called under `_sync_lock`
+
+        :return: removed request and the next one to give turn to, if any
+        """
+        queued = self._pending[key]
+        request = queued.popleft()
+        if queued:
+            return request, queued[0]
+        del self._pending[key]
+        return request, None
+
+    def _complete_requests(self, select, reply):
+        """
+        Passes reply to the first requests of keys chosen by `select(pending)`, and lets the next ones go
+        """
+        with self._sync_lock:
+            completed = [self._pop_request(key) for key in select(self._pending)]
+
+        for request, next_request in completed:
+            log.debug("Reply to %r: %r", request.msg, reply)
+            reply.retain()
+            request.resolve(reply)
+            if next_request is not None:
+                self._give_turn(next_request)
+
+    def _cancel_request(self, key, request):
+        """
+        Removes request from pending, letting the next one with the same key go
+
+        :return: False if request got its reply meanwhile
+        """
+        with self._sync_lock:
+            if request.done.is_set():
+                return False
+
+            request.done.set()
+            queued = self._pending.get(key, ())
+            next_request = None
+            if request not in queued:
+                pass  # superseded by newer request
+            elif queued[0] is request:
+                request, next_request = self._pop_request(key)
+            else:
+                queued.remove(request)
+
+        if next_request is not None:
+            self._give_turn(next_request)
+        return True
+
+    def cancel_requests(self, reason="Requests cancelled"):
+        """
+        Makes all waiting `send()` calls raise RequestCancelled and fails futures of `send_async()` with it,
+        useful when connection is lost
+        """
+        with self._sync_lock:
+            pending, self._pending = self._pending, {}
+
+        for queued in pending.values():
+            for request in queued:
+                request.resolve(error=RequestCancelled(request.msg, reason))
+
+    def _write(self, data, coalesce_key=None, priority=False):
+        scheduler = self.scheduler
+        if scheduler is not None and not priority:
+            scheduler.submit(data, coalesce_key)
+        else:
+            self._write_now(data)
+
+    def _write_now(self, data):
+        if self.trace is not None:
+            self.trace.record(TraceBuffer.OUT, self.HUB_HARDWARE_HANDLE, data)
+        self.connection.write(self.HUB_HARDWARE_HANDLE, data)
+
     def _notify(self, handle, data):
-        log.debug("Notification on %s: %s", handle, str2hex(data))
+        if self.trace is not None:
+            self.trace.record(TraceBuffer.IN, handle, data)
+
+        dispatcher = self.dispatcher
+        if dispatcher is not None:
+            dispatcher.put(handle, data)
+        else:
+            self._handle_notification(handle, data)
+
+    def _handle_notification(self, handle, data):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Notification on %s: %s", handle, str2hex(data))
+        for frame in self._frames.feed(data):
+            self._handle_frame(frame)
+
+    def _handle_frame(self, data):
+        if self._route_port_value(data):
+            return
 
         msg = self._get_upstream_msg(data)
+        if msg is None:
+            return
 
-        with self._sync_lock:
-            if self._sync_request:
-                if self._sync_request.is_reply(msg):
-                    log.debug("Found matching upstream msg: %r", msg)
-                    self._sync_replies.put(msg)
-                    self._sync_request = None
-
-        for msg_class, handler in self._msg_handlers:
-            if isinstance(msg, msg_class):
-                log.debug("Handling msg with %s: %r", handler, msg)
+        if self._pending:
+            # one message may complete several requests, like output feedback for several ports
+            self._complete_requests(lambda pending: [k for k, reqs in pending.items() if reqs[0].is_reply(msg)], msg)
+
+        for handler in self._handlers_for(type(msg)):
+            try:
                 handler(msg)
+            except BaseException:
+                log.warning("%s", traceback.format_exc())
+                log.warning("Failed to handle %r by %s", msg, handler)
+
+        msg.release()  # peripherals and sync waiter hold their own references
+
+    def _route_port_value(self, data):
+        """
+        Fast path for the most frequent notification: single port value is passed to its peripheral as raw bytes,
+        message object is built only if pending sync request or some generic handler may need it
+
+        :return: True if data was taken by peripheral
+        """
+        # short frame has no extended length byte, so type and port are at fixed offsets
+        if len(data) < 5 or len(data) >= 0x80 or data[2:3] != self._PORT_VALUE_TYPE or self._value_handlers:
+            return False
+
+        port = ord(data[3:4])
+        if self._pending and (MsgPortValueSingle.TYPE, port) in self._pending:
+            return False
+
+        device = self.peripherals.get(port)
+        if device is None:
+            return False
+
+        if self._data_gap_start is not None:
+            self._end_data_gap()
+        device.queue_port_data(data)
+        return True
+
+    _PORT_VALUE_TYPE = pack("<B", MsgPortValueSingle.TYPE)
 
     def _get_upstream_msg(self, data):
-        msg_type = usbyte(data, 2)
-        msg = None
-        for msg_kind in UPSTREAM_MSGS:
-            if msg_type == msg_kind.TYPE:
-                msg = msg_kind.decode(data)
-                log.debug("Decoded message: %r", msg)
-                break
-        assert msg
+        msg_type = get_msg_type(data)
+        if msg_type is None:
+            log.warning("Dropped malformed message: %s", str2hex(data))
+            return None
+
+        msg = UPSTREAM_DECODERS[msg_type].decode(data)
+        if isinstance(msg, MsgUnknown):
+            log.warning("Unknown message type 0x%x: %r", msg.msg_type, msg)
+        else:
+            log.debug("Decoded message: %r", msg)
         return msg
 
     def _handle_error(self, msg):
         log.warning("Command error: %s", msg.message())
+        scheduler = self.scheduler
+        if scheduler is not None and msg.err == MsgGenericError.ERR_BUFFER_OVERFLOW:
+            scheduler.overflow()
+            if self._resend_overflowed(msg, scheduler):
+                return
+        self._complete_requests(lambda pending: self._failed_request_key(pending, msg), msg)
+
+    def _resend_overflowed(self, error, scheduler):
+        """
+        Hub dropped the command because of overflow, so it is safe to write it again
+
+        :return: False if there is no such request or it was resent too many times
+        """
         with self._sync_lock:
-            if self._sync_request:
-                self._sync_request = None
-                self._sync_replies.put(msg)
+            keys = self._failed_request_key(self._pending, error)
+            request = self._pending[keys[0]][0] if keys else None
+            if request is None or request.resends >= scheduler.resends:
+                return False
+            request.resends += 1
+
+        log.debug("Resending %r after overflow", request.msg)
+        scheduler.submit(request.msgbytes)
+        return True
+
+    @staticmethod
+    def _failed_request_key(pending, error):
+        """
+        Error tells only the type of failed command, the oldest sent request of that type gets it
+        """
+        failed = [(queued[0].seq, key) for key, queued in pending.items()
+                  if queued[0].sent and queued[0].msg.TYPE == error.cmd]
+        return [min(failed)[1]] if failed else []
 
     def _handle_action(self, msg):
         """
@@ -119,36 +521,101 @@ class Hub(object):
         """
         if msg.action == MsgHubAction.UPSTREAM_DISCONNECT:
             log.warning("Hub disconnects")
+            self._data_gap_start = monotonic()
             self.connection.disconnect()
+            self._frames.reset()
+            self.cancel_requests("Hub disconnected")
+            if self.auto_reconnect and not self._disconnecting:
+                thr = threading.Thread(target=self._reconnect_in_background)
+                thr.setDaemon(True)
+                thr.setName("Hub reconnect")
+                thr.start()
         elif msg.action == MsgHubAction.UPSTREAM_SHUTDOWN:
             log.warning("Hub switches off")
             self.connection.disconnect()
+            self._frames.reset()
+            self.cancel_requests("Hub switched off")
 
     def _handle_device_change(self, msg):
         if msg.event == MsgHubAttachedIO.EVENT_DETACHED:
-            log.debug("Detaching peripheral: %s", self.peripherals[msg.port])
-            self.peripherals.pop(msg.port)
+            self._detach_io(msg.port)
             return
 
         assert msg.event in (msg.EVENT_ATTACHED, msg.EVENT_ATTACHED_VIRTUAL)
-        port = msg.port
-        dev_type = ushort(msg.payload, 0)
+        io = {"type": ushort(msg.payload, 0)}
+        if msg.event == msg.EVENT_ATTACHED:
+            io["hw_revision"] = list(reversed([usbyte(msg.payload, x) for x in range(2, 6)]))
+            io["sw_revision"] = list(reversed([usbyte(msg.payload, x) for x in range(6, 10)]))
+        elif msg.event == msg.EVENT_ATTACHED_VIRTUAL:
+            io["virtual_ports"] = [usbyte(msg.payload, 2), usbyte(msg.payload, 3)]
+        self._attach_io(msg.port, io)
 
-        if dev_type in PERIPHERAL_TYPES:
-            self.peripherals[port] = PERIPHERAL_TYPES[dev_type](self, port)
-        else:
-            log.warning("Have not dedicated class for peripheral type 0x%x on port 0x%x", dev_type, port)
-            self.peripherals[port] = Peripheral(self, port)
+    def _attach_io(self, port, io):
+        """
+        Makes peripheral for attached IO. Peripheral of the same type stays as it is,
+        that happens when hub confirms what was taken from profile cache
 
-        log.info("Attached peripheral: %s", self.peripherals[msg.port])
+        :param io: record for `attached_io`
+        """
+        with self._attach_lock:
+            known = self.attached_io.get(port)
+            self.attached_io[port] = io
+            if known is not None and known["type"] == io["type"] and port in self.peripherals:
+                log.debug("Confirmed peripheral: %s", self.peripherals[port])
+                return
 
-        if msg.event == msg.EVENT_ATTACHED:
-            hw_revision = reversed([usbyte(msg.payload, x) for x in range(2, 6)])
-            sw_revision = reversed([usbyte(msg.payload, x) for x in range(6, 10)])
-            # what to do with this info? it's useless, I guess
-            del hw_revision, sw_revision
-        elif msg.event == msg.EVENT_ATTACHED_VIRTUAL:
-            self.peripherals[port].virtual_ports = (usbyte(msg.payload, 2), usbyte(msg.payload, 3))
+            if port in self.peripherals:  # hub reports other device without detaching previous one
+                self._device_changed(DeviceEvent.DETACHED, port, self.peripherals.pop(port), known)
+
+            dev_type = io["type"]
+            if dev_type in PERIPHERAL_TYPES:
+                dev = PERIPHERAL_TYPES[dev_type](self, port)
+            else:
+                log.warning("Have not dedicated class for peripheral type 0x%x on port 0x%x", dev_type, port)
+                dev = Peripheral(self, port)
+
+            if "virtual_ports" in io:
+                dev.virtual_ports = tuple(io["virtual_ports"])
+
+            self.peripherals[port] = dev
+            log.info("Attached peripheral: %s", dev)
+            self._device_changed(DeviceEvent.ATTACHED, port, dev, io)
+
+    def _detach_io(self, port):
+        with self._attach_lock:
+            dev = self.peripherals.pop(port, None)
+            io = self.attached_io.pop(port, None)
+            if dev is None:
+                log.debug("Nothing to detach on port 0x%x", port)
+                return
+
+            log.info("Detached peripheral: %s", dev)
+            self._device_changed(DeviceEvent.DETACHED, port, dev, io)
+
+    def _device_changed(self, kind, port, peripheral, io):
+        generation = self.generations.get(port, 0) + 1
+        self.generations[port] = generation
+        event = DeviceEvent(kind, port, peripheral, io, generation)
+        self._bind_device(event)
+        for handler in self._device_handlers:
+            try:
+                handler(event)
+            except BaseException:
+                log.warning("%s", traceback.format_exc())
+                log.warning("Failed to handle device event: %s", event)
+
+    def _bind_device(self, event):
+        """
+        Subclasses update their fields for devices here, before application handlers see the event
+
+        :type event: DeviceEvent
+        """
+        pass
+
+    def _signal_device_change(self, msg):
+        del msg
+        with self._devices_changed:
+            self._devices_changed.notify_all()
 
     def _handle_sensor_data(self, msg):
         assert isinstance(msg, (MsgPortValueSingle, MsgPortValueCombined))
@@ -156,16 +623,253 @@ class Hub(object):
             log.warning("Notification on port with no device: %s", msg.port)
             return
 
+        if self._data_gap_start is not None:
+            self._end_data_gap()
+
         device = self.peripherals[msg.port]
         device.queue_port_data(msg)
 
+    def _end_data_gap(self):
+        started, self._data_gap_start = self._data_gap_start, None
+        if started is not None:
+            self.reconnect_stats["data_gap"] = monotonic() - started
+            log.info("Port data resumed after %.3fs", self.reconnect_stats["data_gap"])
+
+    def reconnect(self, attempts=3, backoff=0.1):
+        """
+        Connects to the same hub again and restores port modes of peripherals and subscriptions.
+        Peripherals stay the same objects, hub confirms them with attachment notifications.
+        It happens automatically when hub drops connection, see `auto_reconnect`
+
+        :param attempts: total number of tries, failure of the last one is raised
+        :param backoff: seconds to pause before the second try, doubles with each next one
+        :return: seconds it took
+        """
+        started = monotonic()
+        if self._data_gap_start is None:
+            self._data_gap_start = started
+        self._disconnecting = False
+
+        retry = RetryPolicy(attempts, backoff)
+        attempt = 1
+        while True:
+            try:
+                self.connection.connect(self.connection.hub_mac)
+                break
+            except Exception:
+                if attempt >= retry.attempts:
+                    raise
+                log.warning("Reconnect attempt %s failed: %s", attempt, traceback.format_exc())
+                retry.pause(attempt)
+                attempt += 1
+
+        self.connection.set_notify_handler(self._notify)
+        self.connection.enable_notifications()
+        self._restore_modes()
+
+        duration = monotonic() - started
+        self.reconnect_stats["reconnects"] += 1
+        self.reconnect_stats["duration"] = duration
+        log.info("Reconnected in %.3fs", duration)
+        return duration
+
+    def _reconnect_in_background(self):
+        try:
+            self.reconnect()
+        except BaseException:
+            self.reconnect_stats["failures"] += 1
+            log.warning("%s", traceback.format_exc())
+            log.warning("Failed to reconnect to hub")
+
+    def _restore_modes(self):
+        """
+        Sends port setup of peripherals again, as hub forgets it on disconnect.
+        It blocks with plain `Hub.send()` even in AsyncHub, where `reconnect()` runs in executor
+        """
+        requests = []
+        for dev in list(self.peripherals.values()):
+            if dev._combined:
+                try:
+                    dev._setup_combined(lambda msg: Hub.send(self, msg), dev._combined, dev._port_mode.upd_delta)
+                except Exception:
+                    log.warning("Failed to restore mode of %s: %s", dev, traceback.format_exc())
+            elif dev._port_mode.mode is not None:
+                requests.append((dev, dev._restore_msg()))
+
+        if Future is not None:  # different ports, so setups go together; plain futures even in AsyncHub
+            requests = [(dev, Hub.send_async(self, msg)) for dev, msg in requests]
+
+        for dev, request in requests:
+            try:
+                reply = Hub.send(self, request) if Future is None else request.result(self.timeout)
+                dev._port_mode_changed(reply)
+            except Exception:
+                log.warning("Failed to restore mode of %s: %s", dev, traceback.format_exc())
+
+    def emergency_stop(self):
+        """
+        Stops all motors right away. Stop commands skip all queues and do not wait for feedback,
+        commands to motors that are queued or wait for feedback are cancelled
+        """
+        motors = [dev for dev in self.peripherals.values() if isinstance(dev, Motor)]
+        ports = set(motor.port for motor in motors)
+        for motor in motors:
+            msg = motor._stop_msg()
+            msg.do_feedback = False
+            self._write_now(msg.bytes())
+
+        if self.scheduler is not None:
+            self.scheduler.discard(lambda data: data[2:3] == self._PORT_OUTPUT_TYPE and ord(data[3:4]) in ports)
+
+        with self._sync_lock:
+            keys = [key for key in self._pending if key[0] == MsgPortOutputFeedback.TYPE and key[1] in ports]
+            cancelled = [request for key in keys for request in self._pending.pop(key)]
+        for request in cancelled:
+            request.resolve(error=RequestCancelled(request.msg, "Emergency stop"))
+
+    _PORT_OUTPUT_TYPE = pack("<B", MsgPortOutput.TYPE)
+
     def disconnect(self):
+        self._disconnecting = True
         self.send(MsgHubAction(MsgHubAction.DISCONNECT))
+        self._frames.reset()
 
     def switch_off(self):
+        self._disconnecting = True
         self.send(MsgHubAction(MsgHubAction.SWITCH_OFF))
 
 
+class DeviceEvent(object):
+    """
+    Device attached to or detached from hub port, see `Hub.add_device_handler()`.
+    `io` is the record from `Hub.attached_io`, for detach it is the last one for detached device.
+    `generation` counts device changes on port, peripheral with older generation is not connected anymore
+    """
+    ATTACHED = "attached"
+    DETACHED = "detached"
+
+    def __init__(self, kind, port, peripheral, io, generation):
+        """
+        :type peripheral: Peripheral
+        """
+        self.kind = kind
+        self.port = port
+        self.peripheral = peripheral
+        self.io = io or {}
+        self.generation = generation
+
+    @property
+    def dev_type(self):
+        return self.io.get("type")
+
+    @property
+    def hw_revision(self):
+        return self.io.get("hw_revision")
+
+    @property
+    def sw_revision(self):
+        return self.io.get("sw_revision")
+
+    def __repr__(self):
+        return "%s %s on port 0x%x (generation %s)" % (self.peripheral, self.kind, self.port, self.generation)
+
+
+class RequestTimeout(RuntimeError):
+    """
+    Reply to request did not come in time, the request is in `request` field
+    """
+
+    def __init__(self, request, timeout):
+        super(RequestTimeout, self).__init__("No reply in %s seconds to %r" % (timeout, request))
+        self.request = request
+        self.timeout = timeout
+
+
+class RequestCancelled(RuntimeError):
+    """
+    Request was cancelled while waiting for reply, the request is in `request` field
+    """
+
+    def __init__(self, request, reason):
+        super(RequestCancelled, self).__init__("%s: %r" % (reason, request))
+        self.request = request
+
+
+class RetryPolicy(object):
+    """
+    Retries idempotent requests after timeout, see `DownstreamMsg.is_idempotent()`.
+    Pause before retry grows as `backoff * 2 ** (attempt - 1)`
+    """
+
+    def __init__(self, attempts=3, backoff=0.0):
+        """
+        :param attempts: total number of tries, including the first one
+        :param backoff: seconds to pause before the first retry
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+
+    def should_retry(self, msg, attempt):
+        return attempt < self.attempts and msg.is_idempotent()
+
+    def delay(self, attempt):
+        return self.backoff * 2 ** (attempt - 1)
+
+    def pause(self, attempt):
+        if self.backoff:
+            time.sleep(self.delay(attempt))
+
+
+class PendingRequest(object):
+    """
+    Request waiting for its turn to be sent, then for reply
+    """
+    _counter = itertools.count()
+
+    def __init__(self, msg, msgbytes, future=None):
+        """
+        :type msg: pylgbst.messages.DownstreamMsg
+        :type future: concurrent.futures.Future
+        """
+        self.msg = msg
+        self.msgbytes = msgbytes
+        self.future = future
+        self.coalesce_key = msg.coalesce_key()
+        self.superseded = []  # older requests replaced by this one, they get the same reply
+        self.resends = 0
+        self.seq = next(self._counter)
+        self.sent = False
+        self.turn = threading.Event()
+        self.done = threading.Event()
+        self.reply = None
+        self.error = None
+
+    def resolve(self, reply=None, error=None):
+        self.reply = reply
+        self.error = error
+        self.done.set()
+        self.turn.set()
+        if self.future is not None and not self.future.done() and self.future.set_running_or_notify_cancel():
+            if error is not None:
+                self.future.set_exception(error)
+            elif isinstance(reply, MsgGenericError):
+                self.future.set_exception(RuntimeError(reply.message()))
+            else:
+                self.future.set_result(reply)
+
+        for request in self.superseded:
+            request.resolve(reply, error)
+
+    def replaces(self, other):
+        """
+        :type other: PendingRequest
+        """
+        return self.coalesce_key is not None and not other.sent and other.coalesce_key == self.coalesce_key
+
+    def is_reply(self, msg):
+        return self.sent and self.msg.is_reply(msg)
+
+
 class MoveHub(Hub):
     """
     Class implementing Lego Boost's MoveHub specifics
@@ -195,13 +899,36 @@ class MoveHub(Hub):
     PORT_CURRENT = 0x3B
     PORT_VOLTAGE = 0x3C
 
+    _PORT_FIELDS = {
+        PORT_A: "motor_A",
+        PORT_B: "motor_B",
+        PORT_AB: "motor_AB",
+        PORT_C: "port_C",
+        PORT_D: "port_D",
+        PORT_LED: "led",
+        PORT_TILT_SENSOR: "tilt_sensor",
+        PORT_CURRENT: "current",
+        PORT_VOLTAGE: "voltage",
+    }
+    _EXTERNAL_PORTS = (PORT_C, PORT_D)
+    _EXTERNAL_FIELDS = ((VisionSensor, "vision_sensor"), (EncodedMotor, "motor_external"))  # by exact type
+
+    confirm_timeout = 1.0  # seconds to wait for hub to report devices taken from profile cache
+
     # noinspection PyTypeChecker
-    def __init__(self, connection=None):
-        super(MoveHub, self).__init__(connection)
-        self.info = {}
+    def __init__(self, connection=None, report_status=True, profiles=None):
+        """
+        :param report_status: request and log hub name, MAC and battery state after builtin devices appear
+        :type profiles: pylgbst.profiles.ProfileCache
+        :param profiles: if hub is in this cache, peripherals are made from it without waiting for discovery,
+                         and status is not requested. Cache is updated with what hub reports
+        """
+        self.profiles = profiles
+        self.info = {}  # hub name and MAC
+        self._started = False
+        self._provisional = {}  # port => IO record from profile cache, until hub confirms it
 
-        # shorthand fields
-        self.button = Button(self)
+        # shorthand fields, they are set when devices get attached, that may happen right after connection
         self.led = None
         self.current = None
         self.voltage = None
@@ -214,62 +941,150 @@ class MoveHub(Hub):
         self.port_C = None
         self.port_D = None
 
+        super(MoveHub, self).__init__(connection)
+        self.button = Button(self)
+        self.add_message_handler(MsgHubAttachedIO, self._update_profile)
+
+        self._startup(report_status)
+
+    def _startup(self, report_status):
+        cached = self._apply_profile()
         self._wait_for_devices()
-        self._report_status()
+        if report_status and not cached:
+            self._report_status()
+        self._wait_for_confirmation()
+        self._started = True
+        self._save_profile()
+
+    def _apply_profile(self):
+        """
+        :return: True if all builtin devices were made from cached profile
+        """
+        mac = getattr(self.connection, 'hub_mac', None)
+        profile = self.profiles.get(mac) if self.profiles is not None and mac else None
+        if profile is None:
+            return False
+
+        log.info("Using cached profile of %s", mac)
+        self.info.update(name=profile.get("name"), mac=mac.lower())
+        with self._attach_lock:
+            for port, io in sorted(profile["ports"].items()):
+                if port not in self.attached_io:  # hub has reported it already
+                    self._provisional[port] = dict(io)
+                    self._attach_io(port, self._provisional[port])
+        self._signal_device_change(None)
+        return all(self._builtin_devices())
+
+    def _save_profile(self):
+        mac = getattr(self.connection, 'hub_mac', None) or self.info.get("mac")
+        if self.profiles is None or not mac:
+            return
+
+        with self._attach_lock:
+            unconfirmed = self._unconfirmed_ports()
+            ports = dict((port, io) for port, io in self.attached_io.items() if port not in unconfirmed)
+        self.profiles.put(mac, {"name": self.info.get("name"), "ports": ports})
+
+    def _unconfirmed_ports(self):
+        """
+        :return: ports with devices from profile cache that hub has not reported yet
+        """
+        with self._attach_lock:
+            return [port for port, io in self._provisional.items() if self.attached_io.get(port) is io]
+
+    def _wait_for_confirmation(self):
+        deadline = monotonic() + self.confirm_timeout
+        with self._devices_changed:
+            while self._unconfirmed_ports():
+                time_left = deadline - monotonic()
+                if time_left <= 0:
+                    break
+                self._devices_changed.wait(time_left)
+        self._drop_unconfirmed()
 
-    def _wait_for_devices(self, get_dev_set=None):
+    def _drop_unconfirmed(self):
+        """
+        Detaches cached devices that hub has not confirmed, they were removed while hub was off
+        """
+        with self._attach_lock:
+            for port in self._unconfirmed_ports():
+                log.warning("Hub has not confirmed cached device on port 0x%x, detaching it", port)
+                self._detach_io(port)
+            self._provisional = {}
+
+    def _update_profile(self, msg):
+        if self._started:  # startup saves it once hub is ready
+            self._save_profile()
+
+    def _builtin_devices(self):
+        return (self.motor_A, self.motor_B, self.motor_AB, self.led, self.tilt_sensor,
+                self.current, self.voltage)
+
+    def _wait_for_devices(self, get_dev_set=None, timeout=10.0):
         if not get_dev_set:
-            get_dev_set = lambda: (self.motor_A, self.motor_B, self.motor_AB, self.led, self.tilt_sensor,
-                                   self.current, self.voltage)
-        for num in range(0, 100):
-            devices = get_dev_set()
-            if all(devices):
-                log.debug("All devices are present: %s", devices)
-                return
-            log.debug("Waiting for builtin devices to appear: %s", devices)
-            time.sleep(0.1)
-        log.warning("Got only these devices: %s", get_dev_set())
+            get_dev_set = self._builtin_devices
+        deadline = monotonic() + timeout
+        with self._devices_changed:
+            while not all(get_dev_set()):
+                time_left = deadline - monotonic()
+                if time_left <= 0:
+                    log.warning("Got only these devices: %s", get_dev_set())
+                    return
+                log.debug("Waiting for builtin devices to appear: %s", get_dev_set())
+                self._devices_changed.wait(time_left)
+        log.debug("All devices are present: %s", get_dev_set())
 
     def _report_status(self):
+        requests = self._status_requests()
+        if Future is None:  # no futures backport on Python 2
+            replies = self._send_together(requests)
+        else:
+            futures = [self.send_async(msg) for msg in requests]  # different replies, so they go together
+            replies = [future.result(self.timeout) for future in futures]
+        self._log_status(*replies)
+
+    @staticmethod
+    def _status_requests():
         # maybe add firmware version
-        name = self.send(MsgHubProperties(MsgHubProperties.ADVERTISE_NAME, MsgHubProperties.UPD_REQUEST))
-        mac = self.send(MsgHubProperties(MsgHubProperties.PRIMARY_MAC, MsgHubProperties.UPD_REQUEST))
-        log.info("%s on %s", name.payload, str2hex(mac.payload))
+        return [
+            MsgHubProperties(MsgHubProperties.ADVERTISE_NAME, MsgHubProperties.UPD_REQUEST),
+            MsgHubProperties(MsgHubProperties.PRIMARY_MAC, MsgHubProperties.UPD_REQUEST),
+            MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST),
+            MsgHubAlert(MsgHubAlert.LOW_VOLTAGE, MsgHubAlert.UPD_REQUEST),
+        ]
+
+    def _log_status(self, name, mac, voltage, alert):
+        self.info["name"] = bytes(name.parameters).decode("utf-8", "replace")
+        self.info["mac"] = ":".join("%02x" % x for x in bytearray(mac.parameters))
+        log.info("%s on %s", self.info["name"], self.info["mac"])
 
-        voltage = self.send(MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST))
         assert isinstance(voltage, MsgHubProperties)
         log.info("Voltage: %s%%", usbyte(voltage.parameters, 0))
 
-        voltage = self.send(MsgHubAlert(MsgHubAlert.LOW_VOLTAGE, MsgHubAlert.UPD_REQUEST))
-        assert isinstance(voltage, MsgHubAlert)
-        if not voltage.is_ok():
+        assert isinstance(alert, MsgHubAlert)
+        if not alert.is_ok():
             log.warning("Low voltage, check power source (maybe replace battery)")
 
-    # noinspection PyTypeChecker
-    def _handle_device_change(self, msg):
-        super(MoveHub, self)._handle_device_change(msg)
-        if isinstance(msg, MsgHubAttachedIO) and msg.event != MsgHubAttachedIO.EVENT_DETACHED:
-            port = msg.port
-            if port == self.PORT_A:
-                self.motor_A = self.peripherals[port]
-            elif port == self.PORT_B:
-                self.motor_B = self.peripherals[port]
-            elif port == self.PORT_AB:
-                self.motor_AB = self.peripherals[port]
-            elif port == self.PORT_C:
-                self.port_C = self.peripherals[port]
-            elif port == self.PORT_D:
-                self.port_D = self.peripherals[port]
-            elif port == self.PORT_LED:
-                self.led = self.peripherals[port]
-            elif port == self.PORT_TILT_SENSOR:
-                self.tilt_sensor = self.peripherals[port]
-            elif port == self.PORT_CURRENT:
-                self.current = self.peripherals[port]
-            elif port == self.PORT_VOLTAGE:
-                self.voltage = self.peripherals[port]
-
-            if type(self.peripherals[port]) == VisionSensor:
-                self.vision_sensor = self.peripherals[port]
-            elif type(self.peripherals[port]) == EncodedMotor and port not in (self.PORT_A, self.PORT_B, self.PORT_AB):
-                self.motor_external = self.peripherals[port]
+    def _restore_modes(self):
+        super(MoveHub, self)._restore_modes()
+        if self.button._subscribers:
+            Hub.send(self, MsgHubProperties(MsgHubProperties.BUTTON, MsgHubProperties.UPD_ENABLE))
+
+    def _bind_device(self, event):
+        if event.kind == DeviceEvent.ATTACHED:
+            if event.port in self._PORT_FIELDS:
+                setattr(self, self._PORT_FIELDS[event.port], event.peripheral)
+            if event.port in self._EXTERNAL_PORTS:
+                for dev_class, field in self._EXTERNAL_FIELDS:
+                    if type(event.peripheral) == dev_class:
+                        setattr(self, field, event.peripheral)
+            return
+
+        field = self._PORT_FIELDS.get(event.port)
+        if field and getattr(self, field) is event.peripheral:
+            setattr(self, field, None)
+        for dev_class, field in self._EXTERNAL_FIELDS:
+            if getattr(self, field) is event.peripheral:
+                # same kind of device may remain on the other external port
+                others = [self.peripherals.get(port) for port in self._EXTERNAL_PORTS]
+                setattr(self, field, next((dev for dev in others if type(dev) == dev_class), None))
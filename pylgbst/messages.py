@@ -1,47 +1,225 @@
 import logging
-from struct import pack, unpack
+import threading
+from struct import pack, Struct
 
-from pylgbst.utilities import str2hex
+from pylgbst.utilities import str2hex, monotonic
 
 log = logging.getLogger('hub')
 
 
+MSG_LEN_EXTENDED = 0x80  # flag in first length byte, means length continues in second byte
+MSG_LEN_MAX = 0x3FFF  # two bytes of 7 bits each
+
+
+def encode_msg_length(size):
+    """
+    Encodes length field for message of `size` bytes without the length field itself
+    https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#message-length-encoding
+
+    :rtype: bytes
+    """
+    if size + 1 < MSG_LEN_EXTENDED:
+        return pack("<B", size + 1)
+
+    size += 2
+    if size > MSG_LEN_MAX:
+        raise ValueError("Message is too long: %d bytes" % size)
+    return pack("<BB", (size & 0x7F) | MSG_LEN_EXTENDED, size >> 7)
+
+
+def decode_msg_length(data, offset=0):
+    """
+    Decodes length field of message at `offset`, length includes the field itself
+
+    :return: message length and size of length field, or (None, None) if data is too short to tell
+    """
+    if len(data) <= offset:
+        return None, None
+
+    first = ord(data[offset:offset + 1])
+    if not first & MSG_LEN_EXTENDED:
+        return first, 1
+
+    if len(data) <= offset + 1:
+        return None, None
+
+    return (first & 0x7F) | (ord(data[offset + 1:offset + 2]) << 7), 2
+
+
+def get_msg_type(data):
+    """
+    Reads message type byte from complete message
+
+    :return: message type or None, if data is too short to hold message header
+    """
+    _, offset = decode_msg_length(data)
+    if offset is None or len(data) < offset + 2:
+        return None
+    return ord(data[offset + 1:offset + 2])
+
+
+class FrameAssembler(object):
+    """
+    Turns stream of notifications into complete messages: message may come split across several notifications,
+    and several messages may come packed into one notification.
+    Data is dropped to get in sync again when length is impossible, or when the rest of split message
+    does not come for `stale_after` seconds
+    """
+
+    def __init__(self, max_length=1024, stale_after=0.5):
+        """
+        :param max_length: no hub sends longer messages, longer length means garbage
+        """
+        self.max_length = max_length
+        self.stale_after = stale_after
+        self._buf = b""
+        self._buf_time = 0.0
+
+    def feed(self, data):
+        """
+        :return: list of complete messages, incomplete tail is kept until more data arrives
+        """
+        if not self._buf:
+            msglen, header_len = decode_msg_length(data)
+            # the usual case, one notification holds exactly one message
+            if msglen == len(data) and msglen >= header_len + 2:
+                return [data]
+            buf = data
+        elif monotonic() - self._buf_time > self.stale_after:
+            log.warning("Dropping incomplete message that was not continued: %s", str2hex(self._buf))
+            buf = data
+        else:
+            buf = self._buf + data
+
+        frames = []
+        offset = 0
+        while offset < len(buf):
+            msglen, header_len = decode_msg_length(buf, offset)
+            if msglen is None:
+                break
+
+            if msglen < header_len + 2 or msglen > self.max_length:
+                log.warning("Dropping data with broken message length: %s", str2hex(buf[offset:]))
+                offset = len(buf)
+                break
+
+            if offset + msglen > len(buf):
+                break
+
+            frames.append(bytes(buf[offset:offset + msglen]))
+            offset += msglen
+
+        self._buf = buf[offset:]
+        if self._buf:
+            self._buf_time = monotonic()
+        return frames
+
+    def reset(self):
+        self._buf = b""
+
+
 class Message(object):
+    """
+    Messages use __slots__ to stay compact, subclasses have to declare their fields in __slots__ as well
+    """
+    __slots__ = ('_data', '_offset')
+
     TYPE = None
+    hub_id = 0x00  # not used according to official doc
 
     def __init__(self):
-        self.hub_id = 0x00  # not used according to official doc
-        self.payload = b""
+        self._data = b""
+        self._offset = 0
+
+    @property
+    def payload(self):
+        """
+        For upstream messages, it is a view of bytes not consumed by decoding yet
+        """
+        if self._offset:
+            return memoryview(self._data)[self._offset:]
+        return self._data
+
+    @payload.setter
+    def payload(self, value):
+        self._data = value
+        self._offset = 0
 
     def bytes(self):
         """
         see https://lego.github.io/lego-ble-wireless-protocol-docs/#common-message-header
         """
-        msglen = len(self.payload) + 3
-        assert msglen < 127, "TODO: handle longer messages with 2-byte len"
-        return pack("<B", msglen) + pack("<B", self.hub_id) + pack("<B", self.TYPE) + self.payload
+        payload = self.payload
+        return encode_msg_length(len(payload) + 2) + pack("<B", self.hub_id) + pack("<B", self.TYPE) + payload
+
+    def _fields(self):
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if not name.startswith('_'):
+                    yield name, getattr(self, name, None)
+
+        if hasattr(self, '__dict__'):  # subclasses declared without __slots__
+            for item in self.__dict__.items():
+                yield item
 
     def __repr__(self):
         # assert self.bytes()  # to trigger any field changes
-        data = self.__dict__
-        data = {x: (str2hex(y) if isinstance(y, bytes) else y)
-                for x, y in data.items()
-                if x not in ('hub_id',)}
+        data = dict(self._fields())
+        data['payload'] = self.payload
+        data = {x: (str2hex(y) if isinstance(y, (bytes, memoryview)) else y) for x, y in data.items()}
         return self.__class__.__name__ + "(%s)" % data
 
 
 class DownstreamMsg(Message):
+    """
+    Message with `priority` set is written right away, ahead of queued requests and writes, see `Hub.send()`
+    """
+    __slots__ = ('needs_reply', 'priority')
 
     def __init__(self):
         super(DownstreamMsg, self).__init__()
         self.needs_reply = False
+        self.priority = False
 
     def is_reply(self, msg):
         del msg
         return False
 
+    def reply_key(self):
+        """
+        Identifies what reply is awaited: requests with different keys can wait for replies at the same time,
+        the ones with equal keys are sent one after another. Key starts with expected reply type
+        """
+        return self.TYPE,
+
+    def is_idempotent(self):
+        """
+        Tells if sending request again has no other effect than getting reply again, so it is safe to retry
+        """
+        return False
+
+    def coalesce_key(self):
+        """
+        Message that is not sent yet can be replaced with newer one that has the same key, None means never.
+        It is for set-point commands, where only the latest value matters
+        """
+        return None
+
 
 class UpstreamMsg(Message):
+    """
+    Decoding reads fields with cursor over incoming data, without copying it
+
+    High-rate message classes may recycle instances through `pool`, see `enable_pool()`
+    """
+    __slots__ = ()
+
+    pool = None
+    _HEADER = Struct("<BB")
+    _BYTE = Struct("<B")
+    _SHORT = Struct("<H")
+    _LONG = Struct("<I")
+    _FLOAT = Struct("<f")
 
     def __init__(self):
         super(UpstreamMsg, self).__init__()
@@ -51,33 +229,90 @@ class UpstreamMsg(Message):
         """
         see https://lego.github.io/lego-ble-wireless-protocol-docs/#common-message-header
         """
-        msg = cls()
-        msg.payload = data
-        msglen = msg._byte()
-        assert msglen < 127, "TODO: handle longer messages with 2-byte len"
-        hub_id = msg._byte()
-        assert hub_id == 0
-        msg_type = msg._byte()
+        pool = cls.pool
+        msg = pool.acquire() if pool is not None and pool.msg_class is cls else cls()
+        msg_type = msg._header(data)
         assert cls.TYPE == msg_type, "Message type does not match: %x!=%x" % (cls.TYPE, msg_type)
-        assert isinstance(msg.payload, (bytes, bytearray))
         return msg
 
-    def __shift(self, vtype, vlen):
-        val = self.payload[0:vlen]
-        self.payload = self.payload[vlen:]
-        return unpack("<" + vtype, val)[0]
+    @classmethod
+    def enable_pool(cls, size=64):
+        """
+        Makes decoding reuse instances returned with `release()`, to reduce allocations for high-rate messages.
+
+        Ownership rule: decoded message has one holder, whoever passes it to another thread calls `hold()` first,
+        and every holder calls `release()` when done. Message returns into pool after the last release.
+        Message handlers that keep message after handling must call `retain()`, so it never returns into pool.
+        """
+        if '_pool_state' not in cls.__dict__.get('__slots__', ()):
+            raise TypeError("Class %s does not support pooling" % cls.__name__)
+        cls.pool = MessagePool(cls, size)
+
+    @classmethod
+    def disable_pool(cls):
+        cls.pool = None
+
+    def hold(self):
+        """
+        Adds one more holder of the message, each holder has to call `release()`
+        """
+        if self.pool is not None:
+            self.pool.hold(self)
+
+    def retain(self):
+        """
+        Marks message as kept by someone, so it will not return into pool
+        """
+        if self.pool is not None:
+            self.pool.retain(self)
+
+    def release(self):
+        """
+        Drops one holder of the message, the last one returns it into pool, if pooling is enabled.
+        Message must not be used after that.
+        """
+        if self.pool is not None:
+            self.pool.release(self)
+
+    def _header(self, data):
+        self._data = data
+        msglen, self._offset = decode_msg_length(data)
+        assert msglen == len(data), "Message length %d does not match data length %d" % (msglen, len(data))
+        hub_id, msg_type = self._unpack(self._HEADER)
+        assert hub_id == 0
+        return msg_type
+
+    def _unpack(self, fmt):
+        """
+        :type fmt: Struct
+        :rtype: tuple
+        """
+        vals = fmt.unpack_from(self._data, self._offset)
+        self._offset += fmt.size
+        return vals
+
+    def _remaining(self):
+        return len(self._data) - self._offset
 
     def _byte(self):
-        return self.__shift("B", 1)
+        return self._unpack(self._BYTE)[0]
 
     def _short(self):
-        return self.__shift("H", 2)
+        return self._unpack(self._SHORT)[0]
 
     def _long(self):
-        return self.__shift("I", 4)
+        return self._unpack(self._LONG)[0]
 
     def _float(self):
-        return self.__shift("f", 4)
+        return self._unpack(self._FLOAT)[0]
+
+    def _string(self):
+        """
+        Reads zero-terminated string, up to the end of the message
+        """
+        val = self.payload.tobytes()
+        self._offset = len(self._data)
+        return val.split(b"\00", 1)[0].decode('ascii')
 
     def _bits_list(self, val):
         res = []
@@ -89,10 +324,56 @@ class UpstreamMsg(Message):
         return res
 
 
+class MessagePool(object):
+    """
+    Bounded free-list of message instances, see `UpstreamMsg.enable_pool()`
+    Message `_pool_state` is either number of its holders, or one of FREE and RETAINED
+    """
+    FREE = -1
+    RETAINED = -2
+
+    def __init__(self, msg_class, size):
+        self.msg_class = msg_class
+        self.size = size
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            msg = self._free.pop() if self._free else None
+
+        if msg is None:
+            msg = self.msg_class()
+        msg._pool_state = 1
+        return msg
+
+    def hold(self, msg):
+        with self._lock:
+            if msg._pool_state > 0:
+                msg._pool_state += 1
+
+    def retain(self, msg):
+        with self._lock:
+            if msg._pool_state > 0:
+                msg._pool_state = self.RETAINED
+
+    def release(self, msg):
+        with self._lock:
+            if msg._pool_state <= 0:
+                return
+
+            msg._pool_state -= 1
+            if not msg._pool_state and type(msg) is self.msg_class and len(self._free) < self.size:
+                msg._pool_state = self.FREE
+                self._free.append(msg)
+
+
 class MsgHubProperties(DownstreamMsg, UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#hub-properties
     """
+    __slots__ = ('property', 'operation', 'parameters')
+
     TYPE = 0x01
 
     ADVERTISE_NAME = 0x01
@@ -131,24 +412,33 @@ class MsgHubProperties(DownstreamMsg, UpstreamMsg):
         self.payload = pack("<B", self.property) + pack("<B", self.operation) + self.parameters
         return super(MsgHubProperties, self).bytes()
 
+    _FIELDS = Struct("<BB")
+
     @classmethod
     def decode(cls, data):
         msg = super(MsgHubProperties, cls).decode(data)
         assert isinstance(msg, MsgHubProperties)
-        msg.property = msg._byte()
-        msg.operation = msg._byte()
-        msg.parameters = msg.payload
+        msg.property, msg.operation = msg._unpack(cls._FIELDS)
+        msg.parameters = msg.payload.tobytes()
         return msg
 
     def is_reply(self, msg):
         return isinstance(msg, MsgHubProperties) \
                and msg.operation == self.UPSTREAM_UPDATE and msg.property == self.property
 
+    def reply_key(self):
+        return MsgHubProperties.TYPE, self.property
+
+    def is_idempotent(self):
+        return self.operation in (self.UPD_REQUEST, self.UPD_ENABLE)
+
 
 class MsgHubAction(DownstreamMsg, UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#hub-actions
     """
+    __slots__ = ('action',)
+
     TYPE = 0x02
 
     SWITCH_OFF = 0x01
@@ -170,11 +460,12 @@ class MsgHubAction(DownstreamMsg, UpstreamMsg):
     def bytes(self):
         self.payload = pack("<B", self.action)
         self.needs_reply = self.action in (self.DISCONNECT, self.SWITCH_OFF)
+        self.priority = self.priority or self.action == self.SWITCH_OFF_IMMEDIATELY
         return super(MsgHubAction, self).bytes()
 
     def is_reply(self, msg):
         if not isinstance(msg, MsgHubAction):
-            raise TypeError("Unexpected message type: %s" % (msg.__class__,))
+            return False
         if self.action == self.DISCONNECT and msg.action == self.UPSTREAM_DISCONNECT:
             return True
 
@@ -193,6 +484,8 @@ class MsgHubAlert(DownstreamMsg, UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#hub-alerts
     """
+    __slots__ = ('atype', 'operation', 'status')
+
     TYPE = 0x03
 
     LOW_VOLTAGE = 0x01
@@ -228,13 +521,13 @@ class MsgHubAlert(DownstreamMsg, UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgHubAlert, cls).decode(data)
         assert isinstance(msg, MsgHubAlert)
-        msg.atype = msg._byte()
-        msg.operation = msg._byte()
-        msg.status = msg._byte()
+        msg.atype, msg.operation, msg.status = msg._unpack(cls._FIELDS)
 
         assert msg.operation == cls.UPSTREAM_UPDATE
         return msg
 
+    _FIELDS = Struct("<BBB")
+
     def is_ok(self):
         return not self.status
 
@@ -242,11 +535,19 @@ class MsgHubAlert(DownstreamMsg, UpstreamMsg):
         return isinstance(msg, MsgHubAlert) \
                and msg.operation == self.UPSTREAM_UPDATE and msg.atype == self.atype
 
+    def reply_key(self):
+        return MsgHubAlert.TYPE, self.atype
+
+    def is_idempotent(self):
+        return self.operation == self.UPD_REQUEST
+
 
 class MsgHubAttachedIO(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#hub-attached-i-o
     """
+    __slots__ = ('port', 'event')
+
     TYPE = 0x04
 
     EVENT_DETACHED = 0x00
@@ -269,6 +570,8 @@ class MsgHubAttachedIO(UpstreamMsg):
     DEV_MOTOR_INTERNAL_TACHO = 0x0027
     DEV_TILT_INTERNAL = 0x0028
 
+    _FIELDS = Struct("<BB")
+
     def __init__(self):
         super(MsgHubAttachedIO, self).__init__()
         self.port = None
@@ -278,8 +581,7 @@ class MsgHubAttachedIO(UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgHubAttachedIO, cls).decode(data)
         assert isinstance(msg, MsgHubAttachedIO)
-        msg.port = msg._byte()
-        msg.event = msg._byte()
+        msg.port, msg.event = msg._unpack(cls._FIELDS)
         return msg
 
 
@@ -287,6 +589,8 @@ class MsgGenericError(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#generic-error-messages
     """
+    __slots__ = ('cmd', 'err')
+
     TYPE = 0x05
 
     ERR_ACK = 0x01  # ACK
@@ -309,6 +613,8 @@ class MsgGenericError(UpstreamMsg):
         ERR_INTERNAL: "Internal ERROR",
     }
 
+    _FIELDS = Struct("<BB")
+
     def __init__(self):
         super(MsgGenericError, self).__init__()
         self.cmd = None
@@ -318,8 +624,7 @@ class MsgGenericError(UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgGenericError, cls).decode(data)
         assert isinstance(msg, MsgGenericError)
-        msg.cmd = msg._byte()
-        msg.err = msg._byte()
+        msg.cmd, msg.err = msg._unpack(cls._FIELDS)
         return msg
 
     def message(self):
@@ -331,6 +636,8 @@ class MsgPortInfoRequest(DownstreamMsg):
     This is sync request for value on port
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-information-request
     """
+    __slots__ = ('port', 'info_type')
+
     TYPE = 0x21
 
     INFO_PORT_VALUE = 0x00
@@ -348,19 +655,26 @@ class MsgPortInfoRequest(DownstreamMsg):
         return super(MsgPortInfoRequest, self).bytes()
 
     def is_reply(self, msg):
-        if msg.port != self.port:
-            return False
-
         if self.info_type == self.INFO_PORT_VALUE:
-            return isinstance(msg, (MsgPortValueSingle, MsgPortValueCombined))
+            return isinstance(msg, (MsgPortValueSingle, MsgPortValueCombined)) and msg.port == self.port
         else:
-            return isinstance(msg, (MsgPortInfo,))
+            return isinstance(msg, MsgPortInfo) and msg.port == self.port
+
+    def reply_key(self):
+        if self.info_type == self.INFO_PORT_VALUE:
+            return MsgPortValueSingle.TYPE, self.port
+        return MsgPortInfo.TYPE, self.port
+
+    def is_idempotent(self):
+        return True
 
 
 class MsgPortModeInfoRequest(DownstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-mode-information-request
     """
+    __slots__ = ('port', 'mode', 'info_type')
+
     TYPE = 0x22
 
     INFO_NAME = 0x00
@@ -403,11 +717,19 @@ class MsgPortModeInfoRequest(DownstreamMsg):
 
         return True
 
+    def reply_key(self):
+        return MsgPortModeInfo.TYPE, self.port, self.mode, self.info_type
+
+    def is_idempotent(self):
+        return True
+
 
 class MsgPortInputFmtSetupSingle(DownstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-input-format-setup-single
     """
+    __slots__ = ('port', 'mode', 'updates_enabled', 'update_delta')
+
     TYPE = 0x41
 
     def __init__(self, port, mode, delta=1, update_enable=0):
@@ -420,31 +742,61 @@ class MsgPortInputFmtSetupSingle(DownstreamMsg):
         self.needs_reply = True
 
     def is_reply(self, msg):
-        if isinstance(msg, MsgPortInputFmtSingle) and msg.port == self.port:
-            return True
+        return isinstance(msg, MsgPortInputFmtSingle) and msg.port == self.port
+
+    def reply_key(self):
+        return MsgPortInputFmtSingle.TYPE, self.port
+
+    def is_idempotent(self):
+        return True
 
 
 class MsgPortInputFmtSetupCombined(DownstreamMsg):
     """
+    Combined mode is set up as: lock device, set single mode for each of the modes, set mode/dataset combination,
+    unlock with updates enabled. Only unlocking gets MsgPortInputFmtCombined as reply
+
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-input-format-setup-combinedmode
     """
+    __slots__ = ('port', 'subcommand')
+
     TYPE = 0x42
 
-    def __init__(self, port, mode, delta=1, update_enable=0):
+    SC_SET_COMBINATION = 0x01
+    SC_LOCK = 0x02
+    SC_UNLOCK_ENABLED = 0x03
+    SC_UNLOCK_DISABLED = 0x04
+    SC_RESET = 0x06
+
+    def __init__(self, port, subcommand, datasets=(), combination_index=0):
+        """
+        :param datasets: list of (mode, dataset) pairs for SC_SET_COMBINATION, up to 16 of them
+        """
         super(MsgPortInputFmtSetupCombined, self).__init__()
         self.port = port
-        self.payload = pack("<B", port) + pack("<B", mode) + pack("<I", delta) + pack("<B", update_enable)
-        self.needs_reply = True
+        self.subcommand = subcommand
+        self.payload = pack("<B", port) + pack("<B", subcommand)
+        if subcommand == self.SC_SET_COMBINATION:
+            assert 0 < len(datasets) <= 16, "Combination should have 1 to 16 mode/dataset pairs"
+            self.payload += pack("<B", combination_index)
+            for mode, dataset in datasets:
+                self.payload += pack("<B", (mode << 4) | dataset)
+        self.needs_reply = subcommand in (self.SC_UNLOCK_ENABLED, self.SC_UNLOCK_DISABLED)
 
     def is_reply(self, msg):
-        if isinstance(msg, MsgPortInputFmtCombined) and msg.port == self.port:
-            return True
+        return isinstance(msg, MsgPortInputFmtCombined) and msg.port == self.port
+
+    def reply_key(self):
+        return MsgPortInputFmtCombined.TYPE, self.port
 
 
 class MsgPortInfo(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-information
     """
+    __slots__ = ('port', 'info_type', 'capabilities', 'total_modes', 'input_modes', 'output_modes',
+                 'possible_mode_combinations')
+
     TYPE = 0x43
 
     CAP_OUTPUT = 0b00000001
@@ -452,6 +804,9 @@ class MsgPortInfo(UpstreamMsg):
     CAP_COMBINABLE = 0b00000100
     CAP_SYNCHRONIZABLE = 0b00001000
 
+    _FIELDS = Struct("<BB")
+    _MODE_INFO = Struct("<BBHH")
+
     def __init__(self):
         super(MsgPortInfo, self).__init__()
         self.port = None
@@ -466,15 +821,13 @@ class MsgPortInfo(UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgPortInfo, cls).decode(data)
         assert isinstance(msg, MsgPortInfo)
-        msg.port = msg._byte()
-        msg.info_type = msg._byte()
+        msg.port, msg.info_type = msg._unpack(cls._FIELDS)
         if msg.info_type == MsgPortInfoRequest.INFO_MODE_INFO:
-            msg.capabilities = msg._byte()
-            msg.total_modes = msg._byte()
-            msg.input_modes = msg._bits_list(msg._short())
-            msg.output_modes = msg._bits_list(msg._short())
+            msg.capabilities, msg.total_modes, inputs, outputs = msg._unpack(cls._MODE_INFO)
+            msg.input_modes = msg._bits_list(inputs)
+            msg.output_modes = msg._bits_list(outputs)
         else:
-            while msg.payload:
+            while msg._remaining():
                 # https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#pos-m
                 val = msg._short()
                 msg.possible_mode_combinations.append(msg._bits_list(val))
@@ -503,6 +856,8 @@ class MsgPortModeInfo(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-mode-information
     """
+    __slots__ = ('port', 'mode', 'info_type', 'value')
+
     TYPE = 0x44
 
     MAPPING_FLAGS = {
@@ -523,6 +878,19 @@ class MsgPortModeInfo(UpstreamMsg):
         0b11: "FLOAT",
     }
 
+    # struct format chars for dataset types, values are signed
+    DATASET_FORMATS = {
+        "8 bit": "b",
+        "16 bit": "h",
+        "32 bit": "i",
+        "FLOAT": "f",
+    }
+
+    _FIELDS = Struct("<BBB")
+    _RANGE = Struct("<ff")
+    _MAPPING = Struct("<BB")
+    _VALUE_FORMAT = Struct("<BBBB")
+
     def __init__(self):
         super(MsgPortModeInfo, self).__init__()
         self.port = None
@@ -534,23 +902,22 @@ class MsgPortModeInfo(UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgPortModeInfo, cls).decode(data)
         assert isinstance(msg, MsgPortModeInfo)
-        msg.port = msg._byte()
-        msg.mode = msg._byte()
-        msg.info_type = msg._byte()
+        msg.port, msg.mode, msg.info_type = msg._unpack(cls._FIELDS)
         msg.value = msg._value()
         return msg
 
     def _value(self):
         info = MsgPortModeInfoRequest
         if self.info_type == info.INFO_NAME:
-            return self.payload[:self.payload.index(b"\00")].decode('ascii')
+            return self._string()
         elif self.info_type in (info.INFO_RAW_RANGE, info.INFO_PCT_RANGE, info.INFO_SI_RANGE):
-            return [self._float(), self._float()]
+            return list(self._unpack(self._RANGE))
         elif self.info_type == info.INFO_UNITS:
-            return self.payload[:self.payload.index(b"\00")].decode('ascii')
+            return self._string()
         elif self.info_type == info.INFO_MAPPING:
-            inp = self._bits_list(self._byte())
-            outp = self._bits_list(self._byte())
+            inp, outp = self._unpack(self._MAPPING)
+            inp = self._bits_list(inp)
+            outp = self._bits_list(outp)
             return {
                 "input": [self.MAPPING_FLAGS[x] for x in inp],
                 "output": [self.MAPPING_FLAGS[x] for x in outp],
@@ -558,25 +925,29 @@ class MsgPortModeInfo(UpstreamMsg):
         elif self.info_type == info.INFO_MOTOR_BIAS:
             return self._byte()
         elif self.info_type == info.INFO_VALUE_FORMAT:
+            datasets, dataset_type, total_figures, decimals = self._unpack(self._VALUE_FORMAT)
             return {
-                "datasets": self._byte(),
-                "type": self.DATASET_TYPES[self._byte()],
-                "total_figures": self._byte(),
-                "decimals": self._byte(),
+                "datasets": datasets,
+                "type": self.DATASET_TYPES[dataset_type],
+                "total_figures": total_figures,
+                "decimals": decimals,
             }
         else:
-            return self.payload  # FIXME: will probably fail here
+            return self.payload.tobytes()  # FIXME: will probably fail here
 
 
 class MsgPortValueSingle(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-value-single
     """
+    __slots__ = ('port', '_pool_state')
+
     TYPE = 0x45
 
     def __init__(self):
         super(MsgPortValueSingle, self).__init__()
         self.port = None
+        self._pool_state = 1
 
     @classmethod
     def decode(cls, data):
@@ -588,19 +959,27 @@ class MsgPortValueSingle(UpstreamMsg):
 
 class MsgPortValueCombined(UpstreamMsg):
     """
+    Values in payload follow the order of mode/dataset pairs set in combination, see `Peripheral.subscribe_combined`
+
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-value-combinedmode
     """
+    __slots__ = ('port', 'pointer', '_pool_state')
+
     TYPE = 0x46
 
+    _FIELDS = Struct("<BH")
+
     def __init__(self):
         super(MsgPortValueCombined, self).__init__()
         self.port = None
+        self.pointer = None  # bit N set means value of N-th mode/dataset pair is present
+        self._pool_state = 1
 
     @classmethod
     def decode(cls, data):
         msg = super(MsgPortValueCombined, cls).decode(data)
         assert isinstance(msg, MsgPortValueCombined)
-        msg.port = msg._byte()
+        msg.port, msg.pointer = msg._unpack(cls._FIELDS)
         return msg
 
 
@@ -608,8 +987,12 @@ class MsgPortInputFmtSingle(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-input-format-single
     """
+    __slots__ = ('port', 'mode', 'upd_delta', 'upd_enabled')
+
     TYPE = 0x47
 
+    _FIELDS = Struct("<BBI")
+
     def __init__(self, port=None, mode=None, upd_enabled=None, upd_delta=None):
         super(MsgPortInputFmtSingle, self).__init__()
         self.port = port
@@ -621,31 +1004,34 @@ class MsgPortInputFmtSingle(UpstreamMsg):
     def decode(cls, data):
         msg = super(MsgPortInputFmtSingle, cls).decode(data)
         assert isinstance(msg, MsgPortInputFmtSingle)
-        msg.port = msg._byte()
-        msg.mode = msg._byte()
-        msg.upd_delta = msg._long()
-        if len(msg.payload):
+        msg.port, msg.mode, msg.upd_delta = msg._unpack(cls._FIELDS)
+        if msg._remaining():
             msg.upd_enabled = msg._byte()
 
         return msg
 
 
-class MsgPortInputFmtCombined(UpstreamMsg):  # TODO
+class MsgPortInputFmtCombined(UpstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-input-format-combinedmode
     """
+    __slots__ = ('port', 'combined_control', 'pointer')
+
     TYPE = 0x48
 
+    _FIELDS = Struct("<BBH")
+
     def __init__(self):
         super(MsgPortInputFmtCombined, self).__init__()
         self.port = None
         self.combined_control = None
+        self.pointer = None  # bit N set means N-th mode/dataset pair of combination is reported
 
     @classmethod
     def decode(cls, data):
         msg = super(MsgPortInputFmtCombined, cls).decode(data)
-        assert isinstance(msg, MsgPortInputFmtSingle)
-        msg.port = msg._byte()
+        assert isinstance(msg, MsgPortInputFmtCombined)
+        msg.port, msg.combined_control, msg.pointer = msg._unpack(cls._FIELDS)
         return msg
 
 
@@ -653,6 +1039,8 @@ class MsgVirtualPortSetup(DownstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#virtual-port-setup
     """
+    __slots__ = ()
+
     TYPE = 0x61
 
     CMD_DISCONNECT = 0x00
@@ -673,6 +1061,8 @@ class MsgPortOutput(DownstreamMsg):
     """
     https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-output-command
     """
+    __slots__ = ('port', 'is_buffered', 'do_feedback', 'subcommand', 'params')
+
     TYPE = 0x81
 
     SC_NO_BUFFER = 0b00000001
@@ -681,6 +1071,17 @@ class MsgPortOutput(DownstreamMsg):
     WRITE_DIRECT = 0x50
     WRITE_DIRECT_MODE_DATA = 0x51
 
+    # start speed for single and grouped motors, it only sets new value to keep;
+    # start power goes as WRITE_DIRECT_MODE_DATA and is keyed by its mode byte
+    SET_POINT_SUBCOMMANDS = (0x07, 0x08)
+
+    # length, hub id, type, port, startup and completion flags, subcommand
+    _FRAME_HEADER = Struct("<BBBBBB")
+
+    # encoded frames of commands seen before, commands like stop and fixed colors repeat a lot
+    FRAME_CACHE_SIZE = 1024
+    _frames = {}
+
     def __init__(self, port, subcommand, params):
         super(MsgPortOutput, self).__init__()
         self.port = port
@@ -698,43 +1099,113 @@ class MsgPortOutput(DownstreamMsg):
             startup_completion_flags |= self.SC_FEEDBACK
             self.needs_reply = True
 
-        self.payload = pack("<B", self.port) + pack("<B", startup_completion_flags) \
-                       + pack("<B", self.subcommand) + self.params
+        key = (self.port, startup_completion_flags, self.subcommand, self.params)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._encode(startup_completion_flags)
+            if len(self._frames) >= self.FRAME_CACHE_SIZE:
+                self._frames.clear()  # simplest way to stay bounded with commands that never repeat
+            self._frames[key] = frame
+
+        self.payload = frame[-len(self.params) - 3:]
+        return frame
+
+    def _encode(self, startup_completion_flags):
+        msglen = len(self.params) + self._FRAME_HEADER.size
+        if msglen < MSG_LEN_EXTENDED:
+            return self._FRAME_HEADER.pack(msglen, self.hub_id, self.TYPE, self.port, startup_completion_flags,
+                                           self.subcommand) + self.params
+
+        self.payload = pack("<BBB", self.port, startup_completion_flags, self.subcommand) + self.params
         return super(MsgPortOutput, self).bytes()
 
     def is_reply(self, msg):
-        return isinstance(msg, MsgPortOutputFeedback) and msg.port == self.port \
-               and (msg.is_completed() or self.is_buffered)
+        if not isinstance(msg, MsgPortOutputFeedback) or self.port not in msg.statuses:
+            return False
+        # discarded means other command replaced this one, idle means there is nothing running anymore
+        return self.is_buffered or msg.is_completed(self.port) or msg.is_discarded(self.port) \
+               or msg.is_idle(self.port)
+
+    def reply_key(self):
+        return MsgPortOutputFeedback.TYPE, self.port
+
+    def coalesce_key(self):
+        if self.subcommand == self.WRITE_DIRECT_MODE_DATA and self.params:
+            return self.TYPE, self.port, self.subcommand, self.params[:1]  # the same mode
+        if self.subcommand in self.SET_POINT_SUBCOMMANDS:
+            return self.TYPE, self.port, self.subcommand
+        return None
 
 
 class MsgPortOutputFeedback(UpstreamMsg):
+    """
+    Hub may pack feedback for several ports into one message, `statuses` has all of them,
+    `port` and `status` are from the first one
+
+    https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#port-output-command-feedback
+    """
+    __slots__ = ('port', 'status', 'statuses')
+
     TYPE = 0x82
 
+    IN_PROGRESS = 0b0001
+    COMPLETED = 0b0010
+    DISCARDED = 0b0100
+    IDLE = 0b1000
+
+    _FIELDS = Struct("<BB")
+
     def __init__(self):
         super(MsgPortOutputFeedback, self).__init__()
         self.port = None
         self.status = None
+        self.statuses = {}
 
     @classmethod
     def decode(cls, data):
         msg = super(MsgPortOutputFeedback, cls).decode(data)
         assert isinstance(msg, MsgPortOutputFeedback)
-        assert len(msg.payload) == 2, "TODO: implement multi-port feedback message"
-        msg.port = msg._byte()
-        msg.status = msg._byte()
+        assert msg._remaining() >= 2 and not msg._remaining() % 2, "Broken feedback message: %r" % msg
+        msg.port, msg.status = msg._unpack(cls._FIELDS)
+        msg.statuses = {msg.port: msg.status}
+        while msg._remaining():
+            port, status = msg._unpack(cls._FIELDS)
+            msg.statuses[port] = status
         return msg
 
-    def is_in_progress(self):
-        return self.status & 0b0001
+    def _get_status(self, port):
+        return self.status if port is None else self.statuses.get(port, 0)
+
+    def is_in_progress(self, port=None):
+        return self._get_status(port) & self.IN_PROGRESS
 
-    def is_completed(self):
-        return self.status & 0b0010
+    def is_completed(self, port=None):
+        return self._get_status(port) & self.COMPLETED
 
-    def is_discarded(self):
-        return self.status & 0b0100
+    def is_discarded(self, port=None):
+        return self._get_status(port) & self.DISCARDED
 
-    def is_idle(self):
-        return self.status & 0b1000
+    def is_idle(self, port=None):
+        return self._get_status(port) & self.IDLE
+
+
+class MsgUnknown(UpstreamMsg):
+    """
+    Fallback for message types that have no registered decoder, keeps the raw payload
+    """
+    __slots__ = ('msg_type',)
+
+    TYPE = None
+
+    def __init__(self):
+        super(MsgUnknown, self).__init__()
+        self.msg_type = None
+
+    @classmethod
+    def decode(cls, data):
+        msg = cls()
+        msg.msg_type = msg._header(data)
+        return msg
 
 
 UPSTREAM_MSGS = (
@@ -743,3 +1214,27 @@ UPSTREAM_MSGS = (
     MsgPortValueSingle, MsgPortValueCombined, MsgPortInputFmtSingle, MsgPortInputFmtCombined,
     MsgPortOutputFeedback
 )
+
+# message type byte -> decoding class, filled from UPSTREAM_MSGS and by register_upstream_msg()
+UPSTREAM_DECODERS = [MsgUnknown] * 256
+
+
+def register_upstream_msg(msg_class, msg_type=None):
+    """
+    Registers class to decode upstream messages of given type, by default it is taken from class TYPE.
+    Allows to handle message types that library does not know about, or to override built-in decoders.
+
+    :type msg_class: type
+    :type msg_type: int
+    """
+    if msg_type is None:
+        msg_type = msg_class.TYPE
+
+    if not isinstance(msg_type, int) or not 0 <= msg_type <= 0xFF:
+        raise ValueError("Message type has to be a byte value, got: %r" % (msg_type,))
+
+    UPSTREAM_DECODERS[msg_type] = msg_class
+
+
+for _msg_class in UPSTREAM_MSGS:
+    register_upstream_msg(_msg_class)
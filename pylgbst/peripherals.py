@@ -1,12 +1,13 @@
 import logging
 import math
 import traceback
-from struct import pack, unpack
-from threading import Thread
+from struct import pack, unpack, Struct
 
+from pylgbst.dispatcher import shared_port_data_pool, DEFAULT_POLICY
 from pylgbst.messages import MsgHubProperties, MsgPortOutput, MsgPortInputFmtSetupSingle, MsgPortInfoRequest, \
-    MsgPortModeInfoRequest, MsgPortInfo, MsgPortModeInfo, MsgPortInputFmtSingle
-from pylgbst.utilities import queue, str2hex, usbyte, ushort, usint
+    MsgPortModeInfoRequest, MsgPortInfo, MsgPortModeInfo, MsgPortInputFmtSingle, MsgPortValueSingle, Message, \
+    MsgPortInputFmtSetupCombined, MsgPortInputFmtCombined, MsgPortValueCombined
+from pylgbst.utilities import str2hex, usbyte, ushort, usint, monotonic
 
 log = logging.getLogger('peripherals')
 
@@ -45,7 +46,7 @@ COLORS = {
 class Peripheral(object):
     """
     :type parent: pylgbst.hub.Hub
-    :type _incoming_port_data: queue.Queue
+    :type _incoming_port_data: pylgbst.dispatcher.PortMailbox
     :type _port_mode: MsgPortInputFmtSingle
     """
 
@@ -63,12 +64,15 @@ class Peripheral(object):
 
         self._subscribers = set()
         self._port_mode = MsgPortInputFmtSingle(self.port, None, False, 1)
+        self._combined = ()  # (mode, dataset) pairs of active combined mode
+        self._value_formats = {}  # mode => INFO_VALUE_FORMAT
+        self._combined_layouts = {}  # (combination, pointer) => (modes, Struct)
+        self._latest = {}  # mode => (monotonic time, decoded values) of the last value received
 
-        self._incoming_port_data = queue.Queue(1)  # limit 1 means we drop data if we can't handle it fast enough
-        thr = Thread(target=self._queue_reader)
-        thr.setDaemon(True)
-        thr.setName("Port data queue: %s" % self)
-        thr.start()
+        self._incoming_port_data = None  # hub without port data threads hands data over in its own loop
+        if parent.port_data_threads:
+            pool = parent.port_data_pool or shared_port_data_pool()
+            self._incoming_port_data = pool.mailbox(self._dispatch_port_data, discard=self._discard_port_data)
 
     def __repr__(self):
         msg = "%s on port 0x%x" % (self.__class__.__name__, self.port)
@@ -77,6 +81,14 @@ class Peripheral(object):
         return msg
 
     def set_port_mode(self, mode, send_updates=None, update_delta=None):
+        msg = self._port_mode_msg(mode, send_updates, update_delta)
+        if msg is not None:
+            self._port_mode_changed(self.hub.send(msg))
+
+    def _port_mode_msg(self, mode, send_updates, update_delta):
+        """
+        :return: setup message to send, None if port is already in target mode
+        """
         assert not self.virtual_ports, "TODO: support combined mode for sensors"
 
         if send_updates is None:
@@ -87,40 +99,174 @@ class Peripheral(object):
             update_delta = self._port_mode.upd_delta
             log.debug("Implied update delta=%s", update_delta)
 
-        if self._port_mode.mode == mode \
+        if not self._combined \
+                and self._port_mode.mode == mode \
                 and self._port_mode.upd_enabled == send_updates \
                 and self._port_mode.upd_delta == update_delta:
             log.debug("Already in target mode, no need to switch")
-            return
+            return None
         else:
-            msg = MsgPortInputFmtSetupSingle(self.port, mode, update_delta, send_updates)
-            resp = self.hub.send(msg)
+            return MsgPortInputFmtSetupSingle(self.port, mode, update_delta, send_updates)
+
+    def _restore_msg(self):
+        """
+        :return: setup message that puts port into current mode again, like after reconnect
+        """
+        mode = self._port_mode
+        return MsgPortInputFmtSetupSingle(self.port, mode.mode, mode.upd_delta, mode.upd_enabled)
+
+    def _port_mode_changed(self, resp):
+        assert isinstance(resp, MsgPortInputFmtSingle)
+        self._port_mode = resp
+        self._combined = ()
+
+    def set_combined_mode(self, datasets, update_delta=1):
+        """
+        :param datasets: list of (mode, dataset) pairs, values come in this order
+        """
+        self._setup_combined(self.hub.send, datasets, update_delta)
+
+    def _setup_combined(self, send, datasets, update_delta):
+        """
+        :param send: blocking callable(msg) returning reply
+        """
+        setup = MsgPortInputFmtSetupCombined
+        send(setup(self.port, setup.SC_LOCK))
+        for mode in self._modes_of(datasets):
+            resp = send(MsgPortInputFmtSetupSingle(self.port, mode, update_delta, False))
             assert isinstance(resp, MsgPortInputFmtSingle)
             self._port_mode = resp
+        send(setup(self.port, setup.SC_SET_COMBINATION, datasets))
+        resp = send(setup(self.port, setup.SC_UNLOCK_ENABLED))
+        assert isinstance(resp, MsgPortInputFmtCombined)
+        self._combined = tuple(datasets)
+
+    @staticmethod
+    def _modes_of(datasets):
+        modes = []
+        for mode, _ in datasets:
+            if mode not in modes:
+                modes.append(mode)
+        return modes
+
+    def _get_value_format(self, mode):
+        if mode not in self._value_formats:
+            info = MsgPortModeInfoRequest.INFO_VALUE_FORMAT
+            resp = self.hub.send(MsgPortModeInfoRequest(self.port, mode, info))
+            assert isinstance(resp, MsgPortModeInfo)
+            self._value_formats[mode] = resp.value
+        return self._value_formats[mode]
 
     def _send_output(self, msg):
         assert isinstance(msg, MsgPortOutput)
         msg.is_buffered = self.is_buffered  # TODO: support buffering
-        self.hub.send(msg)
+        return self.hub.send(msg)
+
+    def _send_output_async(self, msg):
+        """
+        :rtype: concurrent.futures.Future
+        """
+        assert isinstance(msg, MsgPortOutput)
+        msg.is_buffered = self.is_buffered
+        return self.hub.send_async(msg)
+
+    def get_sensor_data(self, mode, max_age=None):
+        """
+        :param max_age: seconds, value of this mode received not longer ago is returned without asking hub,
+                        like when port is subscribed to that mode
+        """
+        if max_age is not None:
+            latest = self._latest.get(mode)
+            if latest is not None and monotonic() - latest[0] <= max_age:
+                return latest[1]
 
-    def get_sensor_data(self, mode):
         self.set_port_mode(mode)
         msg = MsgPortInfoRequest(self.port, MsgPortInfoRequest.INFO_PORT_VALUE)
         resp = self.hub.send(msg)
-        return self._decode_port_data(resp)
+        decoded = self._decode_port_data(resp)
+        self._latest[mode] = (monotonic(), decoded)
+        return decoded
 
-    def subscribe(self, callback, mode=0x00, granularity=1):
-        if self._port_mode.mode != mode and self._subscribers:
+    def subscribe(self, callback, mode=0x00, granularity=1, policy=None):
+        """
+        :param policy: what to do when values come faster than subscribers handle them, see `pylgbst.dispatcher`
+                       for `FifoPolicy`, `ConflatePolicy`, `BlockPolicy` and `SamplePolicy`.
+                       All subscribers of port share it, as they share port mode
+        """
+        if (self._combined or self._port_mode.mode != mode) and self._subscribers:
             raise ValueError("Port is in active mode %r, unsubscribe all subscribers first" % self._port_mode)
+        self._use_policy(policy)
         self.set_port_mode(mode, True, granularity)
         if callback:
             self._subscribers.add(callback)
 
+    def subscribe_combined(self, callback, modes, granularity=1, policy=None):
+        """
+        Gets values of several modes in single notification, callback receives dict of mode => tuple of values
+
+        :param modes: list of modes to get all their datasets, or of (mode, dataset) pairs
+        :param policy: see `subscribe()`
+        """
+        datasets = []
+        for mode in modes:
+            if isinstance(mode, tuple):
+                datasets.append(mode)
+            else:
+                datasets.extend((mode, x) for x in range(self._get_value_format(mode)['datasets']))
+
+        for mode in self._modes_of(datasets):
+            self._get_value_format(mode)  # fetch it now, not in port data thread
+
+        if tuple(datasets) != self._combined:
+            if self._subscribers:
+                raise ValueError("Port is in active mode %r, unsubscribe all subscribers first" % self._port_mode)
+            self._use_policy(policy)
+            self.set_combined_mode(datasets, granularity)
+        else:
+            self._use_policy(policy)
+
+        if callback:
+            self._subscribers.add(callback)
+
+    def _use_policy(self, policy):
+        mailbox = self._incoming_port_data
+        if policy is None or mailbox is None:  # hub without port data threads has no mailbox
+            return
+
+        if self._subscribers and policy != mailbox.policy:
+            raise ValueError("Port data has policy %r, unsubscribe all subscribers first" % mailbox.policy)
+        mailbox.policy = policy
+
+    def port_data_stats(self):
+        """
+        :return: dict of values delivered to subscribers, dropped and conflated by policy, None for hubs without
+                 port data threads
+        """
+        return self._incoming_port_data.stats() if self._incoming_port_data is not None else None
+
+    def stream(self, mode=0x00, granularity=1, maxsize=16):
+        """
+        Async iterator of decoded values, for peripherals of `pylgbst.aio.AsyncHub`.
+        Keeps last `maxsize` values when consumer is slow, see `pylgbst.aio.PortStream`
+        """
+        from pylgbst.aio import PortStream  # needs Python 3
+        return PortStream(self, mode, granularity, maxsize)
+
     def unsubscribe(self, callback=None):
         if callback in self._subscribers:
             self._subscribers.remove(callback)
 
-        if not self._port_mode.upd_enabled:
+        if not self._subscribers and self._incoming_port_data is not None:
+            self._incoming_port_data.policy = DEFAULT_POLICY
+
+        if self._combined:
+            if not self._subscribers:
+                msg = MsgPortInputFmtSetupSingle(self.port, self._port_mode.mode, self._port_mode.upd_delta, False)
+                resp = self.hub.send(msg)
+                assert isinstance(resp, MsgPortInputFmtSingle)
+                self._port_mode = resp
+                self._combined = ()
+        elif not self._port_mode.upd_enabled:
             log.warning("Attempt to unsubscribe while port value updates are off: %s", self)
         elif not self._subscribers:
             self.set_port_mode(self._port_mode.mode, False)
@@ -131,10 +277,21 @@ class Peripheral(object):
         return args
 
     def queue_port_data(self, msg):
-        try:
-            self._incoming_port_data.put_nowait(msg)
-        except queue.Full:
-            log.debug("Dropped port data: %r", msg)
+        """
+        :param msg: port value message or raw bytes of MsgPortValueSingle, the latter is decoded in worker thread
+        """
+        if isinstance(msg, Message):
+            msg.hold()
+        if self._incoming_port_data is None:
+            self._dispatch_port_data(msg)
+            return
+        self._incoming_port_data.put(msg)
+
+    @staticmethod
+    def _discard_port_data(msg):
+        log.debug("Dropped port data: %r", msg)
+        if isinstance(msg, Message):
+            msg.release()
 
     def _decode_port_data(self, msg):
         """
@@ -143,22 +300,48 @@ class Peripheral(object):
         log.warning("Unhandled port data: %r", msg)
         return ()
 
+    def _decode_combined_data(self, msg):
+        """
+        :type msg: MsgPortValueCombined
+        :rtype: dict[int,tuple]
+        """
+        key = (self._combined, msg.pointer)
+        layout = self._combined_layouts.get(key)
+        if layout is None:
+            datasets = [pair for bit, pair in enumerate(self._combined) if msg.pointer & (1 << bit)]
+            fmt = "".join(MsgPortModeInfo.DATASET_FORMATS[self._value_formats[mode]['type']] for mode, _ in datasets)
+            layout = (tuple(mode for mode, _ in datasets), Struct("<" + fmt))
+            self._combined_layouts[key] = layout
+
+        modes, fields = layout
+        values = {}
+        for mode, value in zip(modes, fields.unpack(msg.payload)):
+            values.setdefault(mode, []).append(value)
+        return dict((mode, tuple(vals)) for mode, vals in values.items())
+
     def _handle_port_data(self, msg):
         """
         :type msg: pylgbst.messages.MsgPortValueSingle
         """
+        if isinstance(msg, MsgPortValueCombined):
+            self._notify_subscribers(self._decode_combined_data(msg))
+            return
+
         decoded = self._decode_port_data(msg)
         assert isinstance(decoded, (tuple, list)), "Unexpected data type: %s" % type(decoded)
+        self._latest[self._port_mode.mode] = (monotonic(), decoded)
         self._notify_subscribers(*decoded)
 
-    def _queue_reader(self):
-        while True:
-            msg = self._incoming_port_data.get()
-            try:
-                self._handle_port_data(msg)
-            except BaseException:
-                log.warning("%s", traceback.format_exc())
-                log.warning("Failed to handle port data by %s: %r", self, msg)
+    def _dispatch_port_data(self, msg):
+        if not isinstance(msg, Message):
+            msg = MsgPortValueSingle.decode(msg)
+        try:
+            self._handle_port_data(msg)
+        except BaseException:
+            log.warning("%s", traceback.format_exc())
+            log.warning("Failed to handle port data by %s: %r", self, msg)
+        finally:
+            msg.release()
 
     def describe_possible_modes(self):
         mode_info = self.hub.send(MsgPortInfoRequest(self.port, MsgPortInfoRequest.INFO_MODE_INFO))
@@ -211,14 +394,46 @@ class LEDRGB(Peripheral):
     MODE_INDEX = 0x00
     MODE_RGB = 0x01
 
+    _RGB = Struct("<BBBB")
+    _index_payloads = {}  # fixed colors repeat a lot, no need to pack them each time
+
     def __init__(self, parent, port):
         super(LEDRGB, self).__init__(parent, port)
 
-    def set_color(self, color):
+    def set_color(self, color, priority=False):
+        """
+        :param priority: send it ahead of other commands, for alarm indication
+        """
+        mode, msg = self._color_msg(color, priority)
+        self.set_port_mode(mode)
+        return self._send_output(msg)
+
+    def set_color_async(self, color, priority=False):
+        """
+        Same as `set_color()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        mode, msg = self._color_msg(color, priority)
+        mode_msg = self._port_mode_msg(mode, None, None)
+        if mode_msg is not None:
+            # hub handles commands in order, so setup sent first applies before color
+            mode_msg.priority = priority
+            self.hub.send_async(mode_msg).add_done_callback(self._port_mode_sent)
+        return self._send_output_async(msg)
+
+    def _port_mode_sent(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._port_mode_changed(future.result())
+
+    def _color_msg(self, color, priority=False):
+        """
+        :return: port mode the color needs and output message to set it
+        """
         if isinstance(color, (list, tuple)):
             assert len(color) == 3, "RGB color has to have 3 values"
-            self.set_port_mode(self.MODE_RGB)
-            payload = pack("<B", self.MODE_RGB) + pack("<B", color[0]) + pack("<B", color[1]) + pack("<B", color[2])
+            mode = self.MODE_RGB
+            payload = self._RGB.pack(self.MODE_RGB, color[0], color[1], color[2])
         else:
             if color == COLOR_NONE:
                 color = COLOR_BLACK
@@ -226,11 +441,14 @@ class LEDRGB(Peripheral):
             if color not in COLORS:
                 raise ValueError("Color %s is not in list of available colors" % color)
 
-            self.set_port_mode(self.MODE_INDEX)
-            payload = pack("<B", self.MODE_INDEX) + pack("<B", color)
+            mode = self.MODE_INDEX
+            payload = self._index_payloads.get(color)
+            if payload is None:
+                payload = self._index_payloads[color] = pack("<BB", self.MODE_INDEX, color)
 
         msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, payload)
-        self._send_output(msg)
+        msg.priority = priority
+        return mode, msg
 
     def _decode_port_data(self, msg):
         if len(msg.payload) == 3:
@@ -253,6 +471,12 @@ class Motor(Peripheral):
     END_STATE_HOLD = 126
     END_STATE_FLOAT = 0
 
+    # parameter layouts of sub-commands, second variant is for combined ports
+    _START_POWER = Struct("<Bb"), Struct("<Bbb")
+    _ACC_DEC_TIME = Struct("<HB")
+    _START_SPEED = Struct("<bBB"), Struct("<bbBB")
+    _TIMED = Struct("<HbBBB"), Struct("<HbbBBB")
+
     def _speed_abs(self, relative):
         if relative == Motor.END_STATE_BRAKE \
             or relative == Motor.END_STATE_HOLD:
@@ -274,19 +498,29 @@ class Motor(Peripheral):
     def _write_direct_mode(self, subcmd, params):
         params = pack("<B", subcmd) + params
         msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, params)
-        self._send_output(msg)
+        return self._send_output(msg)
 
-    def _send_cmd(self, subcmd, params):
+    def _cmd_msg(self, subcmd, params):
         if self.virtual_ports:
             subcmd += 1  # de-facto rule
 
-        msg = MsgPortOutput(self.port, subcmd, params)
-        self._send_output(msg)
+        return MsgPortOutput(self.port, subcmd, params)
 
     def start_power(self, power_primary=1.0, power_secondary=None):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-startpower-power
         """
+        return self._send_output(self._start_power_msg(power_primary, power_secondary))
+
+    def start_power_async(self, power_primary=1.0, power_secondary=None):
+        """
+        Same as `start_power()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._send_output_async(self._start_power_msg(power_primary, power_secondary))
+
+    def _start_power_msg(self, power_primary, power_secondary):
         if power_secondary is None:
             power_secondary = power_primary
 
@@ -295,72 +529,105 @@ class Motor(Peripheral):
         else:
             cmd = self.SUBCMD_START_POWER
 
-        params = b""
-        params += pack("<b", self._speed_abs(power_primary))
         if self.virtual_ports:
-            params += pack("<b", self._speed_abs(power_secondary))
+            params = self._START_POWER[1].pack(cmd, self._speed_abs(power_primary), self._speed_abs(power_secondary))
+        else:
+            params = self._START_POWER[0].pack(cmd, self._speed_abs(power_primary))
 
-        self._write_direct_mode(cmd, params)
+        msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, params)
+        msg.priority = power_primary in self._STOP_POWERS and power_secondary in self._STOP_POWERS
+        return msg
+
+    _STOP_POWERS = (0, END_STATE_BRAKE, END_STATE_HOLD)
 
     def stop(self):
-        self.timed(0)
+        """
+        Goes ahead of other commands, see `DownstreamMsg.priority`
+        """
+        return self._send_output(self._stop_msg())
+
+    def stop_async(self):
+        """
+        :rtype: concurrent.futures.Future
+        """
+        return self._send_output_async(self._stop_msg())
+
+    def _stop_msg(self):
+        msg = self._timed_msg(0, 1.0, None, 1.0, self.END_STATE_BRAKE, 0b11)
+        msg.priority = True
+        return msg
 
     def set_acc_profile(self, seconds, profile_no=0x00):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-setacctime-time-profileno-0x05
         """
-        params = b""
-        params += pack("<H", int(seconds * 1000))
-        params += pack("<B", profile_no)
-
-        self._send_cmd(self.SUBCMD_SET_ACC_TIME, params)
+        params = self._ACC_DEC_TIME.pack(int(seconds * 1000), profile_no)
+        return self._send_output(self._cmd_msg(self.SUBCMD_SET_ACC_TIME, params))
 
     def set_dec_profile(self, seconds, profile_no=0x00):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-setdectime-time-profileno-0x06
         """
-        params = b""
-        params += pack("<H", int(seconds * 1000))
-        params += pack("<B", profile_no)
-
-        self._send_cmd(self.SUBCMD_SET_DEC_TIME, params)
+        params = self._ACC_DEC_TIME.pack(int(seconds * 1000), profile_no)
+        return self._send_output(self._cmd_msg(self.SUBCMD_SET_DEC_TIME, params))
 
     def start_speed(self, speed_primary=1.0, speed_secondary=None, max_power=1.0, use_profile=0b11):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-startspeed-speed-maxpower-useprofile-0x07
         """
+        return self._send_output(self._start_speed_msg(speed_primary, speed_secondary, max_power, use_profile))
+
+    def start_speed_async(self, speed_primary=1.0, speed_secondary=None, max_power=1.0, use_profile=0b11):
+        """
+        Same as `start_speed()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._send_output_async(self._start_speed_msg(speed_primary, speed_secondary, max_power, use_profile))
+
+    def _start_speed_msg(self, speed_primary, speed_secondary, max_power, use_profile):
         if speed_secondary is None:
             speed_secondary = speed_primary
 
-        params = b""
-        params += pack("<b", self._speed_abs(speed_primary))
         if self.virtual_ports:
-            params += pack("<b", self._speed_abs(speed_secondary))
-
-        params += pack("<B", int(100 * max_power))
-        params += pack("<B", use_profile)
+            params = self._START_SPEED[1].pack(self._speed_abs(speed_primary), self._speed_abs(speed_secondary),
+                                               int(100 * max_power), use_profile)
+        else:
+            params = self._START_SPEED[0].pack(self._speed_abs(speed_primary), int(100 * max_power), use_profile)
 
-        self._send_cmd(self.SUBCMD_START_SPEED, params)
+        return self._cmd_msg(self.SUBCMD_START_SPEED, params)
 
     def timed(self, seconds, speed_primary=1.0, speed_secondary=None, max_power=1.0, end_state=END_STATE_BRAKE,
               use_profile=0b11):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-startspeedfortime-time-speed-maxpower-endstate-useprofile-0x09
         """
+        msg = self._timed_msg(seconds, speed_primary, speed_secondary, max_power, end_state, use_profile)
+        return self._send_output(msg)
+
+    def timed_async(self, seconds, speed_primary=1.0, speed_secondary=None, max_power=1.0, end_state=END_STATE_BRAKE,
+                    use_profile=0b11):
+        """
+        Same as `timed()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        msg = self._timed_msg(seconds, speed_primary, speed_secondary, max_power, end_state, use_profile)
+        return self._send_output_async(msg)
+
+    def _timed_msg(self, seconds, speed_primary, speed_secondary, max_power, end_state, use_profile):
         if speed_secondary is None:
             speed_secondary = speed_primary
 
-        params = b""
-        params += pack("<H", int(seconds * 1000))
-        params += pack("<b", self._speed_abs(speed_primary))
         if self.virtual_ports:
-            params += pack("<b", self._speed_abs(speed_secondary))
-
-        params += pack("<B", int(100 * max_power))
-        params += pack("<B", end_state)
-        params += pack("<B", use_profile)
+            params = self._TIMED[1].pack(int(seconds * 1000), self._speed_abs(speed_primary),
+                                         self._speed_abs(speed_secondary), int(100 * max_power), end_state,
+                                         use_profile)
+        else:
+            params = self._TIMED[0].pack(int(seconds * 1000), self._speed_abs(speed_primary), int(100 * max_power),
+                                         end_state, use_profile)
 
-        self._send_cmd(self.SUBCMD_START_SPEED_FOR_TIME, params)
+        return self._cmd_msg(self.SUBCMD_START_SPEED_FOR_TIME, params)
 
 
 class EncodedMotor(Motor):
@@ -375,6 +642,10 @@ class EncodedMotor(Motor):
     SENSOR_ANGLE = 0x02
     SENSOR_TEST = 0x03  # exists, but neither input nor output mode
 
+    _ANGLED = Struct("<IbBBB"), Struct("<IbbBBB")
+    _GOTO_POSITION = Struct("<ibBBB"), Struct("<iibBBB")
+    _PRESET_ENCODER = Struct("<Bi"), Struct("<ii")
+
     def angled(self, degrees, speed_primary=1.0, speed_secondary=None, max_power=1.0, end_state=Motor.END_STATE_BRAKE,
                use_profile=0b11):
         """
@@ -382,6 +653,20 @@ class EncodedMotor(Motor):
         :type degrees: int
         :type speed_primary: float
         """
+        msg = self._angled_msg(degrees, speed_primary, speed_secondary, max_power, end_state, use_profile)
+        return self._send_output(msg)
+
+    def angled_async(self, degrees, speed_primary=1.0, speed_secondary=None, max_power=1.0,
+                     end_state=Motor.END_STATE_BRAKE, use_profile=0b11):
+        """
+        Same as `angled()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        msg = self._angled_msg(degrees, speed_primary, speed_secondary, max_power, end_state, use_profile)
+        return self._send_output_async(msg)
+
+    def _angled_msg(self, degrees, speed_primary, speed_secondary, max_power, end_state, use_profile):
         if speed_secondary is None:
             speed_secondary = speed_primary
 
@@ -391,38 +676,45 @@ class EncodedMotor(Motor):
             speed_primary = -speed_primary
             speed_secondary = -speed_secondary
 
-        params = b""
-        params += pack("<I", degrees)
-        params += pack("<b", self._speed_abs(speed_primary))
         if self.virtual_ports:
-            params += pack("<b", self._speed_abs(speed_secondary))
-
-        params += pack("<B", int(100 * max_power))
-        params += pack("<B", end_state)
-        params += pack("<B", use_profile)
+            params = self._ANGLED[1].pack(degrees, self._speed_abs(speed_primary), self._speed_abs(speed_secondary),
+                                          int(100 * max_power), end_state, use_profile)
+        else:
+            params = self._ANGLED[0].pack(degrees, self._speed_abs(speed_primary), int(100 * max_power), end_state,
+                                          use_profile)
 
-        self._send_cmd(self.SUBCMD_START_SPEED_FOR_DEGREES, params)
+        return self._cmd_msg(self.SUBCMD_START_SPEED_FOR_DEGREES, params)
 
     def goto_position(self, degrees_primary, degrees_secondary=None, speed=1.0, max_power=1.0,
                       end_state=Motor.END_STATE_BRAKE, use_profile=0b11):
         """
         https://lego.github.io/lego-ble-wireless-protocol-docs/index.html#output-sub-command-gotoabsoluteposition-abspos-speed-maxpower-endstate-useprofile-0x0d
         """
+        msg = self._goto_position_msg(degrees_primary, degrees_secondary, speed, max_power, end_state, use_profile)
+        return self._send_output(msg)
+
+    def goto_position_async(self, degrees_primary, degrees_secondary=None, speed=1.0, max_power=1.0,
+                            end_state=Motor.END_STATE_BRAKE, use_profile=0b11):
+        """
+        Same as `goto_position()`, but does not wait for command feedback
+
+        :rtype: concurrent.futures.Future
+        """
+        msg = self._goto_position_msg(degrees_primary, degrees_secondary, speed, max_power, end_state, use_profile)
+        return self._send_output_async(msg)
+
+    def _goto_position_msg(self, degrees_primary, degrees_secondary, speed, max_power, end_state, use_profile):
         if degrees_secondary is None:
             degrees_secondary = degrees_primary
 
-        params = b""
-        params += pack("<i", degrees_primary)
         if self.virtual_ports:
-            params += pack("<i", degrees_secondary)
-
-        params += pack("<b", self._speed_abs(speed))
-
-        params += pack("<B", int(100 * max_power))
-        params += pack("<B", end_state)
-        params += pack("<B", use_profile)
+            params = self._GOTO_POSITION[1].pack(degrees_primary, degrees_secondary, self._speed_abs(speed),
+                                                 int(100 * max_power), end_state, use_profile)
+        else:
+            params = self._GOTO_POSITION[0].pack(degrees_primary, self._speed_abs(speed), int(100 * max_power),
+                                                 end_state, use_profile)
 
-        self._send_cmd(self.SUBCMD_GOTO_ABSOLUTE_POSITION, params)
+        return self._cmd_msg(self.SUBCMD_GOTO_ABSOLUTE_POSITION, params)
 
     def _decode_port_data(self, msg):
         data = msg.payload
@@ -436,8 +728,8 @@ class EncodedMotor(Motor):
             log.debug("Got motor sensor data while in unexpected mode: %r", self._port_mode)
             return ()
 
-    def subscribe(self, callback, mode=SENSOR_ANGLE, granularity=1):
-        super(EncodedMotor, self).subscribe(callback, mode, granularity)
+    def subscribe(self, callback, mode=SENSOR_ANGLE, granularity=1, policy=None):
+        super(EncodedMotor, self).subscribe(callback, mode, granularity, policy)
 
     def preset_encoder(self, degrees=0, degrees_secondary=None, only_combined=False):
         """
@@ -448,10 +740,11 @@ class EncodedMotor(Motor):
             degrees_secondary = degrees
 
         if self.virtual_ports and not only_combined:
-            self._send_cmd(self.SUBCMD_PRESET_ENCODER, pack("<i", degrees) + pack("<i", degrees_secondary))
+            msg = self._cmd_msg(self.SUBCMD_PRESET_ENCODER, self._PRESET_ENCODER[1].pack(degrees, degrees_secondary))
         else:
-            params = pack("<i", degrees)
-            self._write_direct_mode(self.SENSOR_ANGLE, params)
+            params = self._PRESET_ENCODER[0].pack(self.SENSOR_ANGLE, degrees)
+            msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, params)
+        return self._send_output(msg)
 
 
 class TiltSensor(Peripheral):
@@ -494,8 +787,8 @@ class TiltSensor(Peripheral):
         TRI_FRONT: "FRONT",
     }
 
-    def subscribe(self, callback, mode=MODE_3AXIS_SIMPLE, granularity=1):
-        super(TiltSensor, self).subscribe(callback, mode, granularity)
+    def subscribe(self, callback, mode=MODE_3AXIS_SIMPLE, granularity=1, policy=None):
+        super(TiltSensor, self).subscribe(callback, mode, granularity, policy)
 
     def _decode_port_data(self, msg):
         data = msg.payload
@@ -550,8 +843,8 @@ class VisionSensor(Peripheral):
     def __init__(self, parent, port):
         super(VisionSensor, self).__init__(parent, port)
 
-    def subscribe(self, callback, mode=COLOR_DISTANCE_FLOAT, granularity=1):
-        super(VisionSensor, self).subscribe(callback, mode, granularity)
+    def subscribe(self, callback, mode=COLOR_DISTANCE_FLOAT, granularity=1, policy=None):
+        super(VisionSensor, self).subscribe(callback, mode, granularity, policy)
 
     def _decode_port_data(self, msg):
         data = msg.payload
@@ -589,7 +882,8 @@ class VisionSensor(Peripheral):
         elif self._port_mode.mode == self.CALIBRATE:
             return [ushort(data, x * 2) for x in range(8)]
         else:
-            log.debug("Unhandled VisionSensor data in mode %s: %s", self._port_mode.mode, str2hex(data))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Unhandled VisionSensor data in mode %s: %s", self._port_mode.mode, str2hex(data))
             return ()
 
     def set_color(self, color):
@@ -600,7 +894,7 @@ class VisionSensor(Peripheral):
             raise ValueError("Color %s is not in list of available colors" % color)
 
         self.set_port_mode(self.SET_COLOR)
-        payload = pack("<B", self.SET_COLOR) + pack("<B", color)
+        payload = pack("<BB", self.SET_COLOR, color)
 
         msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, payload)
         self._send_output(msg)
@@ -608,7 +902,7 @@ class VisionSensor(Peripheral):
     def set_ir_tx(self, level=1.0):
         assert 0 <= level <= 1.0
         self.set_port_mode(self.SET_IR_TX)
-        payload = pack("<B", self.SET_IR_TX) + pack("<H", int(level * 65535))
+        payload = pack("<BH", self.SET_IR_TX, int(level * 65535))
 
         msg = MsgPortOutput(self.port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, payload)
         self._send_output(msg)
@@ -0,0 +1,81 @@
+"""
+On-disk cache of what hubs have attached, so reconnecting hub is usable without waiting for discovery,
+see `MoveHub(profiles=...)`
+"""
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger('profiles')
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".pylgbst", "profiles.json")
+
+_replace = getattr(os, 'replace', os.rename)  # Python 2 has no os.replace, rename is atomic on POSIX anyway
+
+
+class ProfileCache(object):
+    """
+    JSON file with hub profiles keyed by lowercase MAC address.
+    Profile is a dict with hub `name` and `ports`: port number => attached IO record, see `Hub.attached_io`
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._profiles = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as fhd:
+                return json.load(fhd)
+        except ValueError:
+            log.warning("Ignoring broken profile cache: %s", self.path)
+            return {}
+
+    def get(self, mac):
+        """
+        :return: profile dict with int port numbers, or None if hub is not known
+        """
+        with self._lock:
+            profile = self._profiles.get(mac.lower())
+        if profile is None:
+            return None
+
+        profile = dict(profile)
+        profile['ports'] = dict((int(port), io) for port, io in profile['ports'].items())
+        return profile
+
+    def put(self, mac, profile):
+        """
+        Stores profile, file is written only if profile has changed
+        """
+        profile = dict(profile)
+        profile['ports'] = dict((str(port), io) for port, io in profile['ports'].items())
+        # JSON round-trip makes tuples into lists, so the comparison is fair
+        profile = json.loads(json.dumps(profile))
+
+        with self._lock:
+            if self._profiles.get(mac.lower()) == profile:
+                return
+            self._profiles[mac.lower()] = profile
+            self._save()
+
+    def forget(self, mac):
+        with self._lock:
+            if self._profiles.pop(mac.lower(), None) is not None:
+                self._save()
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fhd:
+            json.dump(self._profiles, fhd, indent=2, sort_keys=True)
+        _replace(tmp_path, self.path)
+        log.debug("Saved hub profiles into %s", self.path)
@@ -0,0 +1,159 @@
+"""
+Flow control for writes into hub, see `Hub.enable_write_scheduler()`
+"""
+import logging
+import time
+import traceback
+from collections import deque
+from threading import Thread, Condition
+
+from pylgbst.utilities import monotonic
+
+log = logging.getLogger('scheduler')
+
+
+class WriteScheduler(object):
+    """
+    Queue of outgoing messages with own writer thread that keeps pause between writes.
+    Message still waiting in queue is replaced by newer one with the same coalescing key,
+    see `DownstreamMsg.coalesce_key()`.
+
+    Pause starts from `1 / rate` and doubles each time hub reports buffer overflow, up to `max_interval`.
+    After `recover_after` writes without overflow it halves back towards `1 / rate`
+    """
+
+    def __init__(self, writer, rate=None, max_interval=0.5, recover_after=20, resends=3):
+        """
+        :param writer: callable(data) doing the actual write
+        :param rate: max writes per second, None means no limit until overflow happens
+        :param resends: how many times to resend request that hub dropped because of overflow
+        """
+        self._writer = writer
+        self.min_interval = 1.0 / rate if rate else 0.0
+        self.max_interval = max_interval
+        self.recover_after = recover_after
+        self.resends = resends
+        self.interval = self.min_interval
+
+        self._queue = deque()  # entries are [key, data]
+        self._by_key = {}  # coalescing key => entry in queue
+        self._cond = Condition()
+        self._running = True
+        self._since_overflow = 0
+
+        self.written = 0
+        self.coalesced = 0
+        self.overflows = 0
+
+        self._thread = Thread(target=self._loop)
+        self._thread.setDaemon(True)
+        self._thread.setName("Write scheduler")
+        self._thread.start()
+
+    def submit(self, data, key=None):
+        with self._cond:
+            entry = self._by_key.get(key) if key is not None else None
+            if entry is not None:
+                entry[1] = data
+                self.coalesced += 1
+                return
+
+            entry = [key, data]
+            self._queue.append(entry)
+            if key is not None:
+                self._by_key[key] = entry
+            self._cond.notify()
+
+    def discard(self, predicate):
+        """
+        Drops queued writes for which `predicate(data)` is true
+
+        :return: number of dropped writes
+        """
+        with self._cond:
+            kept = deque(entry for entry in self._queue if not predicate(entry[1]))
+            dropped = len(self._queue) - len(kept)
+            self._queue = kept
+            self._by_key = dict((entry[0], entry) for entry in kept if entry[0] is not None)
+            return dropped
+
+    def overflow(self):
+        """
+        Called when hub reports that its buffer overflowed
+        """
+        with self._cond:
+            self.overflows += 1
+            self._since_overflow = 0
+            self.interval = min(self.max_interval, max(2 * self.interval, 0.005))
+            log.warning("Hub buffer overflow, pause between writes is %.3fs now", self.interval)
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "overflows": self.overflows,
+            "interval": self.interval,
+        }
+
+    def stop(self, timeout=1.0):
+        """
+        Stops the thread after it writes messages already in queue
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _wait_for_data(self):
+        """
+        :return: False if scheduler stopped and queue is empty
+        """
+        with self._cond:
+            while not self._queue:
+                if not self._running:
+                    return False
+                self._cond.wait()
+            return True
+
+    def _pop(self):
+        """
+        :return: None if queued writes were discarded during pause
+        """
+        with self._cond:
+            if not self._queue:
+                return None
+
+            key, data = self._queue.popleft()
+            if key is not None:
+                del self._by_key[key]
+
+            self._since_overflow += 1
+            if self._since_overflow >= self.recover_after and self.interval > self.min_interval:
+                self._since_overflow = 0
+                self.interval = max(self.min_interval, self.interval / 2)
+            return data
+
+    def _loop(self):
+        last_write = None
+        while self._wait_for_data():
+            if last_write is not None:
+                pause = last_write + self.interval - monotonic()
+                if pause > 0:
+                    time.sleep(pause)  # newer messages may replace queued ones meanwhile
+
+            data = self._pop()
+            if data is None:
+                continue
+
+            try:
+                self._writer(data)
+            except BaseException:
+                log.warning("%s", traceback.format_exc())
+                log.warning("Failed to write: %r", data)
+            last_write = monotonic()
+            self.written += 1
@@ -0,0 +1,68 @@
+"""
+Wire tracing that is cheap enough to keep enabled in production, see `Hub.enable_trace()`
+"""
+import itertools
+from struct import Struct
+
+from pylgbst.utilities import str2hex, monotonic
+
+
+class TraceBuffer(object):
+    """
+    Fixed-size ring of binary records (monotonic timestamp, direction, handle, raw bytes).
+    Recording only copies bytes into preallocated buffer, all the formatting happens in `dump()`.
+    Data longer than `max_data` is truncated, record keeps its original length
+    """
+    IN = 0x01
+    OUT = 0x02
+
+    DIRECTIONS = {
+        IN: "<<",
+        OUT: ">>",
+    }
+
+    def __init__(self, records=4096, max_data=64):
+        self.records = records
+        self.max_data = max_data
+        # timestamp, direction, handle, original data length, data truncated or zero-padded to max_data
+        self._slot = Struct("<dBHH%ds" % max_data)
+        self._buf = bytearray(records * self._slot.size)
+        self._counter = itertools.count()  # taking next number is atomic, so writers need no lock
+        self._written = 0
+
+    def record(self, direction, handle, data):
+        num = next(self._counter)
+        self._slot.pack_into(self._buf, (num % self.records) * self._slot.size,
+                             monotonic(), direction, handle, len(data), bytes(data))
+        self._written = num + 1
+
+    def clear(self):
+        self._counter = itertools.count()
+        self._written = 0
+
+    def __len__(self):
+        return min(self._written, self.records)
+
+    def entries(self):
+        """
+        :return: list of (timestamp, direction, handle, data, original_len), oldest first
+        """
+        written = self._written
+        buf = bytes(self._buf)
+
+        result = []
+        for num in range(max(0, written - self.records), written):
+            offset = (num % self.records) * self._slot.size
+            timestamp, direction, handle, length, data = self._slot.unpack_from(buf, offset)
+            result.append((timestamp, direction, handle, data[:length], length))
+        return result
+
+    def dump(self, stream):
+        """
+        Writes human-readable trace, one record per line
+        """
+        for timestamp, direction, handle, data, length in self.entries():
+            line = "%.6f %s 0x%02x %s" % (timestamp, self.DIRECTIONS[direction], handle, str2hex(data).decode())
+            if length > len(data):
+                line += "... (%d bytes)" % length
+            stream.write(line + "\n")
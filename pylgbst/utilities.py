@@ -5,6 +5,7 @@ This module offers some utilities, in a way they are work in both Python 2 and 3
 import binascii
 import logging
 import sys
+import time
 from struct import unpack
 
 log = logging.getLogger(__name__)
@@ -16,6 +17,13 @@ else:
 
 queue = queue  # just to use it
 
+try:
+    from concurrent.futures import Future
+except ImportError:  # Python 2 has it only with `futures` backport package installed
+    Future = None
+
+monotonic = getattr(time, 'monotonic', time.time)  # Python 2 has no monotonic clock
+
 
 def check_unpack(seq, index, pattern, size):
     """Check that we got size bytes, if so, unpack using pattern"""
@@ -39,7 +47,9 @@ def usint(seq, index):
 def str2hex(data):  # we need it for python 2+3 compatibility
     # if sys.version_info[0] == 3:
     # data = bytes(data, 'ascii')
-    if not isinstance(data, (bytes, bytearray)):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif not isinstance(data, (bytes, bytearray)):
         data = bytes(data, "ascii")
     hexed = binascii.hexlify(data)
     return hexed
@@ -19,5 +19,7 @@ setup(
         "gattlib": ["gattlib"],
         "pygatt": ["pygatt", "pexpect"],
         "bluepy": ["bluepy"],
+        "bulk": ["numpy"],
+        "async:python_version<'3'": ["futures"],
     },
 )
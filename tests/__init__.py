@@ -1,6 +1,7 @@
 import sys
 import time
 from binascii import unhexlify
+from threading import Thread
 
 from pylgbst.comms import Connection
 from pylgbst.hub import MoveHub, Hub
@@ -42,7 +43,8 @@ class ConnectionMock(Connection):
 
     def set_notify_handler(self, handler):
         self.notification_handler = handler
-        self.thr.start()
+        if self.thr.ident is None:  # handler is set again after reconnect
+            self.thr.start()
 
     def notifier(self):
         while self.running or self.notifications:
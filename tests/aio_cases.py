@@ -0,0 +1,163 @@
+"""
+AsyncHub cases, coroutine syntax makes this module Python 3 only, see `test_aio`
+"""
+import asyncio
+import unittest
+
+from pylgbst.aio import AsyncHub, AsyncMoveHub
+from pylgbst.hub import RequestTimeout
+from pylgbst.messages import MsgHubProperties, MsgPortOutputFeedback, MsgPortInputFmtSingle
+from pylgbst.peripherals import EncodedMotor, Voltage, LEDRGB, COLOR_RED
+from tests import ConnectionMock
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncHubTest(unittest.TestCase):
+    def test_send(self):
+        async def scenario():
+            conn = ConnectionMock().connect()
+            hub = await AsyncHub.create(conn)
+            conn.notification_delayed('060001060600', 0.05)
+            resp = await hub.send(MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST))
+            self.assertIsInstance(resp, MsgHubProperties)
+
+            with self.assertRaises(RequestTimeout):
+                await hub.send(MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST), 0.05)
+            await asyncio.sleep(0)  # let timed out future's callback drop pending request
+            self.assertEqual({}, hub._pending)
+            conn.wait_notifications_handled()
+
+        run(scenario())
+
+    def test_motors_together(self):
+        async def scenario():
+            conn = ConnectionMock().connect()
+            hub = await AsyncHub.create(conn)
+            conn.notifications.append('0f0004000126000000001000000010')
+            conn.notifications.append('0f0004010126000000001000000010')
+            await asyncio.sleep(0.1)
+            self.assertIsInstance(hub.peripherals[0x00], EncodedMotor)
+
+            conn.notification_delayed('070082000a010a', 0.05)
+            replies = await asyncio.gather(hub.peripherals[0x00].angled_async(90),
+                                           hub.peripherals[0x01].timed_async(0.5))
+            self.assertEqual([MsgPortOutputFeedback] * 2, [type(x) for x in replies])
+            self.assertEqual(3, len(conn.writes))
+            conn.wait_notifications_handled()
+
+        run(scenario())
+
+    def test_led(self):
+        async def scenario():
+            conn = ConnectionMock().connect()
+            hub = await AsyncHub.create(conn)
+            led = LEDRGB(hub, 0x32)
+            hub.peripherals[0x32] = led
+
+            conn.notification_delayed("0a004732000100000000", 0.05)
+            conn.notification_delayed("050082320a", 0.1)
+            reply = await led.set_color_async(COLOR_RED)
+            self.assertTrue(reply.is_completed())
+            self.assertEqual(b"0a004132000100000000", conn.writes[1][1])
+            self.assertEqual(b"0800813211510009", conn.writes[2][1])
+            self.assertEqual(LEDRGB.MODE_INDEX, led._port_mode.mode)
+            conn.wait_notifications_handled()
+
+        run(scenario())
+
+    def test_stream(self):
+        async def scenario():
+            conn = ConnectionMock().connect()
+            hub = await AsyncHub.create(conn)
+            voltage = Voltage(hub, 0x3c)
+            hub.peripherals[0x3c] = voltage
+
+            stream = voltage.stream(maxsize=2)
+            conn.notification_delayed("0a00473c000100000001", 0.05)
+            await stream.open()
+            self.assertEqual(b"0a00413c000100000001", conn.writes[1][1])
+
+            for _ in range(3):
+                conn.notifications.append("0600453c9907")
+            await asyncio.sleep(0.1)
+
+            values = []
+            async for value in stream:
+                values.append(value)
+                if len(values) == 2:
+                    conn.notification_delayed("0a00473c000100000000", 0.05)
+                    await stream.aclose()
+            self.assertEqual([4.79630105317236] * 2, values)
+            self.assertEqual(1, stream.dropped)
+            self.assertEqual(b"0a00413c000100000000", conn.writes[2][1])
+            conn.wait_notifications_handled()
+
+        run(scenario())
+
+    def test_move_hub(self):
+        async def scenario():
+            conn = ConnectionMock()
+            for notification in ('0f00 04 00 0127000100000001000000', '0f00 04 01 0127000100000001000000',
+                                 '0900 04 10 0227003738', '0f00 04 32 0117000100000001000000',
+                                 '0f00 04 3a 0128000000000100000001', '0f00 04 3b 0115000200000002000000',
+                                 '0f00 04 3c 0114000200000002000000'):
+                conn.notifications.append(notification)
+
+            conn.notification_delayed('12000101064c45474f204d6f766520487562', 0.3)
+            conn.notification_delayed('0b00010d06001653a0d1d4', 0.3)
+            conn.notification_delayed('060001060600', 0.3)
+            conn.notification_delayed('0600030104ff', 0.3)
+            hub = await AsyncMoveHub.create(conn.connect())
+            self.assertIsInstance(hub.motor_AB, EncodedMotor)
+            self.assertEqual(5, len(conn.writes))  # status requests went together
+            conn.wait_notifications_handled()
+
+        run(scenario())
+
+    def test_reconnect(self):
+        async def scenario():
+            conn = ConnectionMock()
+            for notification in ('0f00 04 00 0127000100000001000000', '0f00 04 01 0127000100000001000000',
+                                 '0900 04 10 0227003738', '0f00 04 32 0117000100000001000000',
+                                 '0f00 04 3a 0128000000000100000001', '0f00 04 3b 0115000200000002000000',
+                                 '0f00 04 3c 0114000200000002000000'):
+                conn.notifications.append(notification)
+            hub = await AsyncMoveHub.create(conn.connect(), report_status=False)
+            pressed = []
+
+            def callback(state):
+                pressed.append(state)
+
+            hub.button._subscribers.add(callback)
+            hub.motor_A._combined = ((1, 0), (2, 0))
+            hub.voltage._port_mode = MsgPortInputFmtSingle(0x3c, 0x00, True, 1)
+
+            # restore blocks in executor thread, replies are handled in the loop meanwhile
+            conn.notification_delayed('0a00 47 00 01 01000000 00', 0.1)
+            conn.notification_delayed('0a00 47 00 02 01000000 00', 0.2)
+            conn.notification_delayed('0700 48 00 81 0300', 0.3)
+            conn.notification_delayed('0a00 47 3c 00 01000000 01', 0.4)
+            conn.notification_delayed('060001020600', 0.5)
+            await asyncio.get_event_loop().run_in_executor(None, hub.reconnect)
+
+            writes = [data for _, data in conn.writes]
+            self.assertIn(b"0800420001001020", writes)
+            self.assertIn(b"0a00413c000100000001", writes)
+            self.assertEqual(b"0500010202", writes[-1])
+            self.assertEqual(((1, 0), (2, 0)), hub.motor_A._combined)
+            self.assertTrue(hub.voltage._port_mode.upd_enabled)
+            self.assertEqual([False], pressed)
+
+            conn.notification_delayed('04000230', 0.05)
+            await hub.switch_off()
+            self.assertTrue(hub._disconnecting)
+            conn.wait_notifications_handled()
+
+        run(scenario())
@@ -0,0 +1,4 @@
+import sys
+
+if sys.version_info >= (3, 5):  # async syntax would fail to compile on Python 2
+    from tests.aio_cases import AsyncHubTest  # noqa: F401
@@ -0,0 +1,45 @@
+import unittest
+from binascii import unhexlify
+
+from pylgbst.peripherals import EncodedMotor, VisionSensor, Voltage, TiltSensor
+
+try:
+    import numpy
+    from pylgbst.bulk import decode_port_values, split_frames
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "needs numpy, pip install pylgbst[bulk]")
+class BulkTest(unittest.TestCase):
+    def test_split_frames(self):
+        data = unhexlify("0600453c9907" "810100453c" + "00" * 124 + "050082030a" "0800")
+        offsets, lengths, headers = split_frames(data)
+        self.assertEqual([0, 6, 135], list(offsets))
+        self.assertEqual([6, 129, 5], list(lengths))
+        self.assertEqual([1, 2, 1], list(headers))
+
+    def test_decode_port_values(self):
+        data = unhexlify("08004502ff0aff00" "0600453c9907" "08004502030a0004" "08004501feffffff" "0700453afd0140"
+                         "0500820300" "0500453c99")
+        values = decode_port_values(data, {
+            0x01: (EncodedMotor, EncodedMotor.SENSOR_ANGLE),
+            0x02: (VisionSensor, VisionSensor.COLOR_DISTANCE_FLOAT),
+            0x3a: (TiltSensor, TiltSensor.MODE_3AXIS_ACCEL),
+            0x3c: (Voltage, Voltage.VOLTAGE_L),
+        })
+
+        vision = values[(0x45, 0x02, VisionSensor.COLOR_DISTANCE_FLOAT)]
+        self.assertEqual([0, 2], list(vision['frame']))
+        self.assertEqual([255, 3], list(vision['color']))
+        self.assertEqual([10.0, 10.25], list(vision['distance']))
+
+        voltage = values[(0x45, 0x3c, Voltage.VOLTAGE_L)]
+        self.assertEqual([1], list(voltage['frame']))  # last one is too short
+        self.assertTrue(numpy.allclose([9600.0 * 0x0799 / 3893.0 / 1000.0], voltage['volts']))
+
+        self.assertEqual([-2], list(values[(0x45, 0x01, EncodedMotor.SENSOR_ANGLE)]['angle']))
+        self.assertEqual([(4, -3, 1, 64)], values[(0x45, 0x3a, TiltSensor.MODE_3AXIS_ACCEL)].tolist())
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, decode_port_values, unhexlify("0600453c9907"), {0x3c: (Voltage, 0x10)})
@@ -1,10 +1,22 @@
+import os
+import shutil
+import tempfile
+import threading
 import time
 import unittest
+from io import StringIO
+from threading import Thread, Event
 
-from pylgbst.hub import Hub, MoveHub
-from pylgbst.messages import MsgHubAction, MsgHubAlert, MsgHubProperties
-from pylgbst.peripherals import VisionSensor
-from pylgbst.utilities import usbyte
+from pylgbst.dispatcher import PortDataPool, FifoPolicy, ConflatePolicy, BlockPolicy, SamplePolicy
+from pylgbst.hub import Hub, MoveHub, RequestTimeout, RetryPolicy, RequestCancelled
+from pylgbst.messages import MsgHubAction, MsgHubAlert, MsgHubProperties, MsgUnknown, UpstreamMsg, \
+    UPSTREAM_DECODERS, register_upstream_msg, MsgPortValueSingle, MsgPortOutput, MsgPortInfoRequest, MsgPortInfo, \
+    MsgPortOutputFeedback
+from pylgbst.peripherals import VisionSensor, Voltage, EncodedMotor
+from pylgbst.profiles import ProfileCache
+from pylgbst.scheduler import WriteScheduler
+from pylgbst.utilities import usbyte, Future
+from pylgbst.trace import TraceBuffer
 from tests import ConnectionMock
 
 
@@ -75,6 +87,479 @@ class HubTest(unittest.TestCase):
         time.sleep(0.2)
         conn.wait_notifications_handled()
 
+    def test_unknown_msg(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        vals = []
+        hub.add_message_handler(MsgUnknown, vals.append)
+        conn.notifications.append("050077abcd")
+        conn.wait_notifications_handled()
+
+        self.assertEqual(1, len(vals))
+        self.assertEqual(0x77, vals[0].msg_type)
+        self.assertEqual(b"\xab\xcd", vals[0].payload)
+
+    def test_register_upstream_msg(self):
+        class MsgCustom(UpstreamMsg):
+            TYPE = 0x78
+
+        register_upstream_msg(MsgCustom)
+        try:
+            conn = ConnectionMock().connect()
+            hub = Hub(conn)
+            vals = []
+            hub.add_message_handler(MsgCustom, vals.append)
+            conn.notifications.append("05007801ff")
+            conn.wait_notifications_handled()
+            self.assertEqual(1, len(vals))
+            self.assertEqual(b"\x01\xff", vals[0].payload)
+        finally:
+            register_upstream_msg(MsgUnknown, 0x78)
+
+        self.assertRaises(ValueError, register_upstream_msg, MsgCustom, 0x100)
+        self.assertIs(MsgUnknown, UPSTREAM_DECODERS[0x78])
+
+    def test_message_handlers(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        generic = []
+        props = []
+
+        def broken(msg):
+            raise ValueError("handler failure")
+
+        hub.add_message_handler(UpstreamMsg, generic.append)
+        hub.add_message_handler(MsgHubProperties, broken)
+        hub.add_message_handler(MsgHubProperties, props.append)
+        conn.notifications.append("060001060600")
+        conn.notifications.append("0600030104ff")
+        time.sleep(0.1)
+        self.assertEqual([MsgHubProperties, MsgHubAlert], [type(x) for x in generic])
+        self.assertEqual(1, len(props))  # broken handler did not stop the next one
+
+        hub.remove_message_handler(UpstreamMsg, generic.append)
+        hub.remove_message_handler(MsgHubProperties, props.append)
+        hub.remove_message_handler(MsgHubProperties, props.append)  # not registered anymore
+        conn.notifications.append("060001060600")
+        conn.wait_notifications_handled()
+        self.assertEqual(2, len(generic))
+        self.assertEqual(1, len(props))
+
+    def test_pooled_msg_retained(self):
+        MsgPortValueSingle.enable_pool()
+        try:
+            conn = ConnectionMock().connect()
+            hub = Hub(conn)
+            hub.peripherals[0x3c] = Voltage(hub, 0x3c)
+
+            kept = []
+
+            def handler(msg):
+                if not kept:
+                    msg.retain()
+                    kept.append(msg)
+
+            hub.add_message_handler(MsgPortValueSingle, handler)
+            conn.notifications.append("0600453c9907")
+            for _ in range(10):
+                conn.notifications.append("0600453b0100")
+            conn.wait_notifications_handled()
+            time.sleep(0.1)
+
+            self.assertEqual(0x3c, kept[0].port)
+            self.assertEqual(b"\x99\x07", kept[0].payload.tobytes())
+        finally:
+            MsgPortValueSingle.disable_pool()
+
+    def test_port_value_raw_routing(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        queued = []
+        hub.peripherals[0x3c] = Voltage(hub, 0x3c)
+        hub.peripherals[0x3c].queue_port_data = queued.append
+
+        conn.notifications.append("0600453c9907")
+        time.sleep(0.1)
+        self.assertEqual([b"\x06\x00\x45\x3c\x99\x07"], queued)
+
+        msgs = []
+        hub.add_message_handler(MsgPortValueSingle, msgs.append)
+        conn.notifications.append("0600453c9907")
+        conn.wait_notifications_handled()
+        self.assertEqual(2, len(queued))
+        self.assertIsInstance(queued[1], MsgPortValueSingle)
+        self.assertEqual([0x3c], [msg.port for msg in msgs])
+
+    def test_pipelined_requests(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        replies = []
+
+        def motor_cmd(port):
+            replies.append(hub.send(MsgPortOutput(port, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64")))
+
+        threads = [Thread(target=motor_cmd, args=(port,)) for port in (0x00, 0x01, 0x00)]
+        for thr in threads:
+            thr.start()
+            time.sleep(0.05)
+
+        # independent ports are in flight together, second command to port A waits for the first one
+        self.assertEqual([b"0800810011510064", b"0800810111510064"], [x[1] for x in conn.writes[1:]])
+
+        conn.notifications.append("070082000a010a")  # feedback for both ports in one message
+        time.sleep(0.1)
+        self.assertEqual(2, len(replies))
+        self.assertEqual(b"0800810011510064", conn.writes[3][1])
+
+        conn.notifications.append("050082000a")
+        for thr in threads:
+            thr.join(1)
+        self.assertEqual(3, len(replies))
+        conn.wait_notifications_handled()
+
+    def test_error_goes_to_failed_request(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        results = {}
+
+        def send(name, msg):
+            try:
+                results[name] = hub.send(msg)
+            except RuntimeError as exc:
+                results[name] = exc
+
+        Thread(target=send, args=("props", MsgHubProperties(MsgHubProperties.VOLTAGE_PERC,
+                                                            MsgHubProperties.UPD_REQUEST))).start()
+        Thread(target=send, args=("info", MsgPortInfoRequest(0x01, MsgPortInfoRequest.INFO_MODE_INFO))).start()
+        time.sleep(0.1)
+        conn.notifications.append("0500050106")  # invalid use of hub properties command
+        conn.notifications.append("0b00430101070201000000")
+        time.sleep(0.2)
+        conn.wait_notifications_handled()
+
+        self.assertIsInstance(results["props"], RuntimeError)
+        self.assertIsInstance(results["info"], MsgPortInfo)
+
+    def test_request_timeout(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        hub.timeout = 0.1
+        msg = MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST)
+        with self.assertRaises(RequestTimeout) as ctx:
+            hub.send(msg)
+        self.assertIs(msg, ctx.exception.request)
+        self.assertEqual({}, hub._pending)
+
+        # retried only if idempotent
+        conn.notification_delayed('060001060600', 0.15)
+        resp = hub.send(msg, retry=RetryPolicy(attempts=2))
+        self.assertIsInstance(resp, MsgHubProperties)
+        self.assertEqual(4, len(conn.writes))
+
+        cmd = MsgPortOutput(0x00, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64")
+        self.assertRaises(RequestTimeout, hub.send, cmd, 0.05, RetryPolicy(attempts=2))
+        self.assertEqual(5, len(conn.writes))
+        conn.wait_notifications_handled()
+
+    def test_cancel_requests(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        errors = []
+
+        def send():
+            try:
+                hub.send(MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST))
+            except RequestCancelled as exc:
+                errors.append(exc)
+
+        threads = [Thread(target=send) for _ in range(2)]
+        for thr in threads:
+            thr.start()
+        time.sleep(0.1)
+        conn.notifications.append("04000231")  # hub disconnects
+        for thr in threads:
+            thr.join(1)
+        self.assertEqual(2, len(errors))
+        self.assertEqual({}, hub._pending)
+        conn.wait_notifications_handled()
+
+    def test_send_together(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        hub.timeout = 1
+        # replies come together, before requests would be sent one by one
+        conn.notification_delayed('060001060600', 0.1)
+        conn.notification_delayed('0600030104ff', 0.1)
+        replies = hub._send_together([MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST),
+                                      MsgHubAlert(MsgHubAlert.LOW_VOLTAGE, MsgHubAlert.UPD_REQUEST)])
+        self.assertEqual([MsgHubProperties, MsgHubAlert], [type(x) for x in replies])
+        self.assertEqual(3, len(conn.writes))
+
+        hub.timeout = 0.1
+        conn.notification_delayed('060001060600', 0.05)
+        self.assertRaises(RequestTimeout, hub._send_together,
+                          [MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST),
+                           MsgHubAlert(MsgHubAlert.LOW_VOLTAGE, MsgHubAlert.UPD_REQUEST)])
+        self.assertEqual({}, hub._pending)
+        conn.wait_notifications_handled()
+
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_send_async(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+
+        first = hub.send_async(MsgPortOutput(0x00, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64"))
+        second = hub.send_async(MsgPortOutput(0x01, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64"))
+        queued = hub.send_async(MsgPortOutput(0x00, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x32"))
+        self.assertEqual(3, len(conn.writes))  # third one waits for port A to reply
+        self.assertTrue(queued.cancel())
+        self.assertEqual(1, len(hub._pending[(MsgPortOutputFeedback.TYPE, 0x00)]))
+
+        conn.notifications.append("070082000a010a")
+        self.assertIsInstance(first.result(1), MsgPortOutputFeedback)
+        self.assertIsInstance(second.result(1), MsgPortOutputFeedback)
+        self.assertEqual({}, hub._pending)
+        self.assertEqual(3, len(conn.writes))  # cancelled command was never sent
+
+        self.assertIsNone(hub.send_async(MsgHubAction(MsgHubAction.UPSTREAM_BOOT_MODE)).result(0))
+
+        failed = hub.send_async(MsgHubProperties(MsgHubProperties.VOLTAGE_PERC, MsgHubProperties.UPD_REQUEST))
+        conn.notifications.append("0500050106")
+        self.assertRaises(RuntimeError, failed.result, 1)
+        conn.wait_notifications_handled()
+
+    def test_trace(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        trace = hub.enable_trace(records=3, max_data=4)
+        hub.send(MsgHubAction(MsgHubAction.UPSTREAM_BOOT_MODE))
+        conn.notifications.append("0600453c9907")
+        conn.notifications.append("0500056105")
+        conn.notifications.append("04000232")
+        conn.wait_notifications_handled()
+
+        entries = trace.entries()
+        self.assertEqual(3, len(entries))
+        self.assertEqual([TraceBuffer.IN] * 3, [x[1] for x in entries])
+        self.assertEqual((b"\x06\x00\x45\x3c", 6), entries[0][3:])
+        self.assertEqual((b"\x04\x00\x02\x32", 4), entries[2][3:])
+        self.assertTrue(entries[0][0] <= entries[1][0] <= entries[2][0])
+
+        out = StringIO()
+        hub.dump_trace(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].endswith(" << 0x0e 0600453c... (6 bytes)"), lines[0])
+        self.assertTrue(lines[2].endswith(" << 0x0e 04000232"), lines[2])
+
+        hub.disable_trace()
+        self.assertRaises(RuntimeError, hub.dump_trace, out)
+
+    def test_dispatcher(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        dispatcher = hub.enable_dispatcher(size=2)
+        release = Event()
+        vals = []
+
+        def slow_handler(msg):
+            release.wait(1)
+            vals.append(msg)
+
+        hub.add_message_handler(MsgHubProperties, slow_handler)
+        conn.notifications.append("060001060600")
+        time.sleep(0.05)
+        for _ in range(3):
+            conn.notifications.append("060001060600")
+        time.sleep(0.1)
+        self.assertEqual(2, dispatcher.depth)  # first one is in slow handler, last two wait
+        self.assertEqual(1, dispatcher.dropped)
+
+        release.set()
+        hub.disable_dispatcher()
+        self.assertIsNone(hub.dispatcher)
+        self.assertEqual(3, len(vals))
+        self.assertEqual(3, dispatcher.dispatched)
+        self.assertTrue(dispatcher.max_lag >= dispatcher.lag > 0)
+
+        conn.notifications.append("060001060600")  # handled in connection thread again
+        conn.wait_notifications_handled()
+        self.assertEqual(4, len(vals))
+
+    def test_port_data_pool(self):
+        pool = PortDataPool(workers=2)
+        gate = Event()
+        handled = []
+
+        def handler(item):
+            gate.wait()
+            handled.append(item)
+
+        first, second = pool.mailbox(handler, FifoPolicy(3)), pool.mailbox(handler, FifoPolicy(3))
+        first.put(("first", 0))
+        second.put(("second", 0))
+        time.sleep(0.05)  # both workers are busy now
+        for num in range(1, 5):
+            first.put(("first", num))
+            second.put(("second", num))
+        gate.set()
+        time.sleep(0.1)
+
+        self.assertEqual([0, 1, 2, 3], [num for port, num in handled if port == "first"])  # in order, the last dropped
+        self.assertEqual([0, 1, 2, 3], [num for port, num in handled if port == "second"])
+        self.assertEqual({"workers": 2, "ready": 0, "handled": 8, "dropped": 2}, pool.stats())
+
+        # peripherals do not start threads of their own
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        hub.port_data_pool = pool
+        threads = threading.active_count()
+        conn.notifications.append('0f0004020125000000001000000010')
+        conn.notifications.append('0f0004030126000000001000000010')
+        conn.notifications.append('08004502ff0aff00')
+        time.sleep(0.1)
+        conn.wait_notifications_handled()
+        self.assertLessEqual(threading.active_count(), threads)  # notifier of mock has ended
+        self.assertEqual(9, pool.stats()["handled"])
+
+    def test_backpressure_policies(self):
+        pool = PortDataPool(workers=1)
+        gate = Event()
+        handled = []
+
+        def handler(item):
+            gate.wait()
+            handled.append(item)
+
+        def feed(policy, count=6):
+            del handled[:]
+            gate.clear()
+            discarded = []
+            mailbox = pool.mailbox(handler, policy, discarded.append)
+            mailbox.put(0)
+            time.sleep(0.05)  # worker is busy with the first item
+            for num in range(1, count):
+                mailbox.put(num)
+            gate.set()
+            time.sleep(0.05)
+            return mailbox.stats(), discarded
+
+        stats, discarded = feed(ConflatePolicy())
+        self.assertEqual([0, 5], handled)  # freshest only
+        self.assertEqual([1, 2, 3, 4], discarded)
+        self.assertEqual({"waiting": 0, "delivered": 2, "dropped": 0, "conflated": 4}, stats)
+
+        stats, discarded = feed(FifoPolicy(3))
+        self.assertEqual([0, 1, 2, 3], handled)
+        self.assertEqual([4, 5], discarded)
+        self.assertEqual({"waiting": 0, "delivered": 4, "dropped": 2, "conflated": 0}, stats)
+
+        stats, discarded = feed(SamplePolicy(2, size=8))
+        self.assertEqual([0, 2, 4], handled)
+        self.assertEqual({"waiting": 0, "delivered": 3, "dropped": 3, "conflated": 0}, stats)
+
+        # producer waits instead of losing data
+        gate.set()
+        del handled[:]
+        mailbox = pool.mailbox(lambda item: (time.sleep(0.005), handled.append(item)), BlockPolicy(2))
+        for num in range(20):
+            mailbox.put(num)
+        time.sleep(0.05)
+        self.assertEqual(list(range(20)), handled)
+        self.assertEqual(0, mailbox.stats()["dropped"])
+
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_write_scheduler(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        scheduler = hub.enable_write_scheduler(rate=20)
+
+        for power in (b"\x10", b"\x20", b"\x30"):
+            msg = MsgPortOutput(0x00, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00" + power)
+            msg.do_feedback = False
+            hub.send(msg)
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual([b"0800810001510010", b"0800810001510030"], [x[1] for x in conn.writes[1:]])
+        self.assertEqual(1, scheduler.coalesced)
+
+        # the second command waits for the first one to finish, so the third one takes its place
+        futures = [hub.send_async(MsgPortOutput(0x00, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00" + power))
+                   for power in (b"\x10", b"\x20", b"\x30")]
+        time.sleep(0.1)
+        conn.notifications.append("050082000a")
+        self.assertTrue(futures[0].result(1).is_completed())
+        time.sleep(0.1)
+        conn.notifications.append("050082000a")
+        self.assertIs(futures[1].result(1), futures[2].result(1))
+        self.assertEqual([b"0800810011510010", b"0800810011510030"], [x[1] for x in conn.writes[3:]])
+
+        # overflowed command is sent again, with longer pause
+        future = hub.send_async(MsgPortOutput(0x01, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x10"))
+        time.sleep(0.1)
+        conn.notifications.append("0500058103")
+        time.sleep(0.2)
+        conn.notifications.append("050082010a")
+        self.assertTrue(future.result(1).is_completed())
+        self.assertEqual([b"0800810111510010"] * 2, [x[1] for x in conn.writes[5:]])
+        self.assertEqual(1, scheduler.overflows)
+        self.assertEqual(0.1, scheduler.interval)
+
+        hub.disable_write_scheduler()
+        conn.wait_notifications_handled()
+
+    def test_write_scheduler_discard(self):
+        writes = []
+        scheduler = WriteScheduler(writes.append, rate=10)
+        scheduler.submit(b"first")
+        time.sleep(0.02)
+        scheduler.submit(b"second")
+        time.sleep(0.02)  # writer thread took it and pauses now
+        self.assertEqual(1, scheduler.discard(lambda data: True))
+        time.sleep(0.15)
+        self.assertTrue(scheduler._thread.is_alive())
+
+        scheduler.submit(b"third")
+        time.sleep(0.15)
+        self.assertEqual([b"first", b"third"], writes)
+        scheduler.stop()
+
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_priority_stop(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        conn.notifications.append('0f0004000126000000001000000010')
+        conn.notifications.append('0f0004010126000000001000000010')
+        time.sleep(0.1)
+        motor_a, motor_b = hub.peripherals[0x00], hub.peripherals[0x01]
+        hub.enable_write_scheduler(rate=5)
+
+        running = motor_a.start_speed_async(0.5)
+        queued = motor_a.angled_async(90)
+        time.sleep(0.05)
+        stop = motor_a.stop_async()  # does not wait for running command and write queue
+        self.assertEqual([b"090081001107326403", b"0c0081001109000064647f03"], [x[1] for x in conn.writes[1:]])
+
+        conn.notifications.append("0500820004")
+        self.assertTrue(running.result(1).is_discarded())
+        conn.notifications.append("050082000a")
+        self.assertTrue(stop.result(1).is_completed())
+        time.sleep(0.25)
+        self.assertEqual(b"0e008100110b5a00000064647f03", conn.writes[3][1])
+        conn.notifications.append("050082000a")
+        self.assertTrue(queued.result(1).is_completed())
+
+        futures = [motor_a.start_speed_async(0.5), motor_a.angled_async(90), motor_b.start_speed_async(0.5)]
+        hub.emergency_stop()
+        self.assertEqual([b"0c0081000109000064647f03", b"0c0081010109000064647f03"],
+                         sorted(x[1] for x in conn.writes[-2:]))
+        for future in futures:
+            self.assertRaises(RequestCancelled, future.result, 1)
+        self.assertEqual({}, hub._pending)
+        self.assertEqual(0, hub.scheduler.depth)
+
+        hub.disable_write_scheduler()
+        conn.wait_notifications_handled()
+
     def test_disconnect_off(self):
         conn = ConnectionMock().connect()
         hub = Hub(conn)
@@ -87,6 +572,40 @@ class HubTest(unittest.TestCase):
         conn.notification_delayed("04000230", 0.1)
         hub.switch_off()
         self.assertEqual(b"04000201", conn.writes[1][1])
+        self.assertTrue(hub._disconnecting)  # no reconnect when hub drops connection after it
+
+    def test_reconnect(self):
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        conn.notifications.append('0f0004020125000000001000000010')
+        time.sleep(0.1)
+        sensor = hub.peripherals[0x02]
+        conn.notification_delayed('0a00 47 02 01 01000000 01', 0.05)
+        sensor.set_port_mode(VisionSensor.DISTANCE_INCHES, True, 1)
+
+        # hub drops connection, then announces the same device and confirms restored mode
+        conn.notification_delayed('04000231', 0.05)
+        conn.notification_delayed('0f0004020125000000001000000010', 0.15)
+        conn.notification_delayed('0a00 47 02 01 01000000 01', 0.2)
+        conn.notification_delayed('0500 45 02 07', 0.3)
+        time.sleep(0.4)
+        conn.wait_notifications_handled()
+
+        self.assertIs(sensor, hub.peripherals[0x02])
+        setups = [data for _, data in conn.writes if data == b"0a004102010100000001"]
+        self.assertEqual(2, len(setups))
+        self.assertEqual(1, hub.reconnect_stats["reconnects"])
+        self.assertLess(hub.reconnect_stats["duration"], 0.5)
+        self.assertGreater(hub.reconnect_stats["data_gap"], 0.2)
+
+        # no reconnect after disconnect we asked for
+        conn = ConnectionMock().connect()
+        hub = Hub(conn)
+        conn.notification_delayed("04000231", 0.1)
+        hub.disconnect()
+        time.sleep(0.1)
+        conn.wait_notifications_handled()
+        self.assertEqual(0, hub.reconnect_stats["reconnects"])
 
     def test_sensor(self):
         conn = ConnectionMock().connect()
@@ -120,6 +639,11 @@ class HubTest(unittest.TestCase):
 
 
 class MoveHubTest(unittest.TestCase):
+    BUILTIN_DEVICES = ['0f00 04 00 0127000100000001000000', '0f00 04 01 0127000100000001000000',
+                       '0900 04 10 0227003738', '0f00 04 32 0117000100000001000000',
+                       '0f00 04 3a 0128000000000100000001', '0f00 04 3b 0115000200000002000000',
+                       '0f00 04 3c 0114000200000002000000']
+
     def test_capabilities(self):
         conn = ConnectionMock()
         conn.notifications.append('0f00 04 02 0125000000001000000010')
@@ -143,3 +667,99 @@ class MoveHubTest(unittest.TestCase):
         self.assertEqual(b"0500010d05", conn.writes[2][1])
         self.assertEqual(b"0500010605", conn.writes[3][1])
         self.assertEqual(b"0500030103", conn.writes[4][1])
+
+    def test_startup_without_polling(self):
+        conn = ConnectionMock()
+        conn.notifications.extend(self.BUILTIN_DEVICES[:-1])
+        conn.notification_delayed(self.BUILTIN_DEVICES[-1], 0.15)
+
+        start = time.time()
+        hub = MoveHub(conn.connect(), report_status=False)
+        self.assertLess(time.time() - start, 0.25)  # no extra poll interval after the last device
+        self.assertIsNotNone(hub.voltage)
+        self.assertEqual(1, len(conn.writes))
+        conn.wait_notifications_handled()
+
+        # status requests go together, so replies are waited once
+        conn = ConnectionMock()
+        conn.notifications.extend(self.BUILTIN_DEVICES)
+        for reply in ('12000101064c45474f204d6f766520487562', '0b00010d06001653a0d1d4', '060001060600',
+                      '0600030104ff'):
+            conn.notification_delayed(reply, 0.2)
+        start = time.time()
+        MoveHub(conn.connect())
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual(5, len(conn.writes))
+        conn.wait_notifications_handled()
+
+    def test_profile_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "profiles.json")
+
+        # first connection discovers devices and learns MAC from status
+        conn = ConnectionMock()
+        conn.notifications.extend(self.BUILTIN_DEVICES)
+        for reply in ('12000101064c45474f204d6f766520487562', '0b00010d06001653a0d1d4', '060001060600',
+                      '0600030104ff'):
+            conn.notification_delayed(reply, 0.1)
+        MoveHub(conn.connect(), profiles=ProfileCache(path))
+        conn.wait_notifications_handled()
+
+        profile = ProfileCache(path).get("00:16:53:A0:D1:D4")
+        self.assertEqual("LEGO Move Hub", profile["name"])
+        self.assertEqual([0x00, 0x01, 0x10, 0x32, 0x3a, 0x3b, 0x3c], sorted(profile["ports"]))
+        self.assertEqual([0x37, 0x38], profile["ports"][0x10]["virtual_ports"])
+
+        # reconnect is ready without waiting for status, hub confirms cached devices and peripherals stay the same
+        conn = ConnectionMock()
+        conn.hub_mac = "00:16:53:A0:D1:D4"
+        for notification in self.BUILTIN_DEVICES:
+            conn.notification_delayed(notification, 0.05)
+        start = time.time()
+        hub = MoveHub(conn.connect(), profiles=ProfileCache(path))
+        self.assertLess(time.time() - start, 0.2)
+        self.assertIsInstance(hub.motor_AB, EncodedMotor)
+        self.assertEqual((0x37, 0x38), hub.motor_AB.virtual_ports)
+        self.assertEqual("LEGO Move Hub", hub.info["name"])
+        self.assertEqual(1, len(conn.writes))
+        self.assertEqual(1, hub.generations[0x00])
+
+        conn.notifications.append('0f00 04 02 0125000000001000000010')
+        conn.wait_notifications_handled()
+        self.assertIsInstance(hub.vision_sensor, VisionSensor)
+        self.assertIn(0x02, ProfileCache(path).get("00:16:53:a0:d1:d4")["ports"])
+
+        # sensor unplugged while hub was off is not reported, so cached one gets detached
+        conn = ConnectionMock()
+        conn.hub_mac = "00:16:53:A0:D1:D4"
+        conn.notifications.extend(self.BUILTIN_DEVICES)
+        hub = MoveHub(conn.connect(), profiles=ProfileCache(path))
+        self.assertIsNone(hub.vision_sensor)
+        self.assertNotIn(0x02, hub.peripherals)
+        self.assertEqual(2, hub.generations[0x02])
+        self.assertNotIn(0x02, ProfileCache(path).get("00:16:53:a0:d1:d4")["ports"])
+        conn.wait_notifications_handled()
+
+    def test_hot_plug(self):
+        conn = ConnectionMock()
+        conn.notifications.extend(self.BUILTIN_DEVICES)
+        hub = MoveHub(conn.connect(), report_status=False)
+        events = []
+        hub.add_device_handler(events.append)
+
+        conn.notifications.append('0f00 04 02 0126000000001000000010')  # motor into C
+        conn.notifications.append('0f00 04 03 0125000000001000000010')  # sensor into D
+        conn.notifications.append('0500 04 02 00')
+        conn.notifications.append('0f00 04 02 0125000000001000000010')  # swapped for another sensor
+        conn.notifications.append('0500 04 02 00')
+        conn.wait_notifications_handled()
+
+        self.assertEqual(["attached", "attached", "detached", "attached", "detached"], [x.kind for x in events])
+        self.assertEqual(0x26, events[0].dev_type)
+        self.assertEqual([0x10, 0x00, 0x00, 0x00], events[0].hw_revision)
+        self.assertEqual([1, 2, 3, 4], [x.generation for x in events if x.port == 0x02])
+        self.assertIsNone(hub.motor_external)
+        self.assertIsNone(hub.port_C)
+        self.assertIs(hub.peripherals[0x03], hub.vision_sensor)  # sensor on other port takes the field back
+        self.assertEqual({0x02: 4, 0x03: 1}, dict((port, hub.generations[port]) for port in (0x02, 0x03)))
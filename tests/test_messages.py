@@ -0,0 +1,169 @@
+import time
+import unittest
+from binascii import unhexlify
+
+from pylgbst.messages import MsgPortModeInfo, MsgPortModeInfoRequest, MsgPortInfo, MsgPortInputFmtSingle, \
+    MsgHubProperties, MsgPortValueSingle, MsgPortOutput, FrameAssembler, decode_msg_length, get_msg_type, \
+    encode_msg_length, MSG_LEN_MAX, MsgPortOutputFeedback, \
+    MsgPortInputFmtCombined, MsgPortValueCombined
+from pylgbst.utilities import str2hex
+
+
+def decode(msg_class, hexstr):
+    return msg_class.decode(unhexlify(hexstr.replace(' ', '')))
+
+
+class MessagesTest(unittest.TestCase):
+    def test_payload_tail(self):
+        msg = decode(MsgHubProperties, '12000101064c45474f204d6f766520487562')
+        self.assertEqual(MsgHubProperties.ADVERTISE_NAME, msg.property)
+        self.assertEqual(b"LEGO Move Hub", msg.parameters)
+        self.assertIsInstance(msg.payload, memoryview)
+        self.assertEqual(b"LEGO Move Hub", msg.payload.tobytes())
+
+    def test_port_mode_info(self):
+        msg = decode(MsgPortModeInfo, '1200 44 02 00 00 434f4c4f5200000000000000')
+        self.assertEqual((0x02, 0, MsgPortModeInfoRequest.INFO_NAME), (msg.port, msg.mode, msg.info_type))
+        self.assertEqual("COLOR", msg.value)
+
+        msg = decode(MsgPortModeInfo, '0e00 44 02 00 01 00000000 00002041')
+        self.assertEqual([0.0, 10.0], msg.value)
+
+        msg = decode(MsgPortModeInfo, '0a00 44 02 08 80 04000300')
+        self.assertEqual({"datasets": 4, "type": "8 bit", "total_figures": 3, "decimals": 0}, msg.value)
+
+    def test_port_info(self):
+        msg = decode(MsgPortInfo, '0b00 43 02 01 07 0b 5f06 a000')
+        self.assertTrue(msg.is_combinable())
+        self.assertEqual(11, msg.total_modes)
+        self.assertEqual([0, 1, 2, 3, 4, 6, 9, 10], msg.input_modes)
+
+        msg = decode(MsgPortInfo, '0900 43 02 02 4f00 0000')
+        self.assertEqual([[0, 1, 2, 3, 6], []], msg.possible_mode_combinations)
+
+    def test_input_fmt(self):
+        msg = decode(MsgPortInputFmtSingle, '0a004702080100000001')
+        self.assertEqual((2, 8, 1, 1), (msg.port, msg.mode, msg.upd_delta, msg.upd_enabled))
+
+    def test_pool(self):
+        self.assertRaises(TypeError, MsgPortInfo.enable_pool)
+
+        MsgPortValueSingle.enable_pool(2)
+        try:
+            msg1 = decode(MsgPortValueSingle, '08004502ff0aff00')
+            msg1.release()
+            msg2 = decode(MsgPortValueSingle, '0600453ba400')
+            self.assertIs(msg1, msg2)
+            self.assertEqual(0x3b, msg2.port)
+            self.assertEqual(b"\xa4\x00", msg2.payload.tobytes())
+
+            msg2.retain()
+            msg2.release()
+            msg3 = decode(MsgPortValueSingle, '0600453ba400')
+            self.assertIsNot(msg2, msg3)
+        finally:
+            MsgPortValueSingle.disable_pool()
+
+        msg4 = decode(MsgPortValueSingle, '0600453ba400')
+        msg4.release()
+        self.assertIsNot(msg4, decode(MsgPortValueSingle, '0600453ba400'))
+
+    def test_long_msg(self):
+        msg = MsgPortOutput(0x01, MsgPortOutput.WRITE_DIRECT, b"\x01" * 200)
+        data = msg.bytes()
+        self.assertEqual(207, len(data))
+        self.assertEqual(b"cf01", str2hex(data[:2]))
+        self.assertEqual((207, 2), decode_msg_length(data))
+        self.assertEqual(MsgPortOutput.TYPE, get_msg_type(data))
+
+        msg = decode(MsgPortModeInfo, '8501 00 44 02 00 00 ' + '41' * 125 + '00')
+        self.assertEqual(133, decode_msg_length(msg._data)[0])
+        self.assertEqual("A" * 125, msg.value)
+
+    def test_msg_length_bounds(self):
+        self.assertEqual(b"7f", str2hex(encode_msg_length(126)))
+        self.assertEqual(b"8101", str2hex(encode_msg_length(127)))  # 128 bytes can't have 1-byte length
+        self.assertEqual((127, 1), decode_msg_length(unhexlify("7f")))
+        self.assertEqual((129, 2), decode_msg_length(unhexlify("8101")))
+        self.assertEqual((128, 2), decode_msg_length(unhexlify("8001")))
+
+        self.assertEqual(b"ff7f", str2hex(encode_msg_length(MSG_LEN_MAX - 2)))
+        self.assertEqual((MSG_LEN_MAX, 2), decode_msg_length(unhexlify("ff7f")))
+        self.assertRaises(ValueError, encode_msg_length, MSG_LEN_MAX - 1)
+
+        self.assertEqual((None, None), decode_msg_length(b""))
+        self.assertEqual((None, None), decode_msg_length(unhexlify("81")))
+        self.assertIsNone(get_msg_type(b"\x02\x00"))
+
+    def test_frame_assembler(self):
+        asm = FrameAssembler()
+        frame = unhexlify('08004502ff0aff00')
+        self.assertIs(frame, asm.feed(frame)[0])
+
+        # split across notifications
+        self.assertEqual([], asm.feed(frame[:3]))
+        self.assertEqual([], asm.feed(frame[3:5]))
+        self.assertEqual([frame], asm.feed(frame[5:]))
+
+        # several in one notification, with partial one at the end
+        feedback = unhexlify('050082030a')
+        self.assertEqual([frame, feedback], asm.feed(frame + feedback + frame[:1]))
+        self.assertEqual([frame], asm.feed(frame[1:]))
+
+        # extended length split right after first length byte
+        long_frame = MsgPortOutput(0x01, MsgPortOutput.WRITE_DIRECT, b"\x01" * 200).bytes()
+        self.assertEqual([], asm.feed(long_frame[:1]))
+        self.assertEqual([], asm.feed(long_frame[1:100]))
+        self.assertEqual([long_frame, feedback], asm.feed(long_frame[100:] + feedback))
+
+        # too short to be a message
+        self.assertEqual([], asm.feed(b"\x01"))
+        self.assertEqual([], asm.feed(b"\x02\x00"))
+        self.assertEqual([frame], asm.feed(frame))
+
+        asm.feed(frame[:3])
+        asm.reset()
+        self.assertEqual([feedback], asm.feed(feedback))
+
+        # garbage length byte does not hold back next messages
+        self.assertEqual([], asm.feed(unhexlify('ff7f00')))
+        self.assertEqual([frame], asm.feed(frame))
+
+        # partial message that was not continued is dropped
+        asm = FrameAssembler(stale_after=0.01)
+        self.assertEqual([], asm.feed(frame[:3]))
+        time.sleep(0.02)
+        self.assertEqual([feedback], asm.feed(feedback))
+
+    def test_port_output_frames(self):
+        msg = MsgPortOutput(0x03, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64")
+        frame = msg.bytes()
+        self.assertEqual(b"0800810311510064", str2hex(frame))
+        self.assertEqual(b"0311510064", str2hex(msg.payload))
+        self.assertTrue(msg.needs_reply)
+
+        again = MsgPortOutput(0x03, MsgPortOutput.WRITE_DIRECT_MODE_DATA, b"\x00\x64")
+        self.assertIs(frame, again.bytes())
+
+        again.do_feedback = False
+        self.assertEqual(b"0800810301510064", str2hex(again.bytes()))
+
+    def test_output_feedback_multi_port(self):
+        msg = decode(MsgPortOutputFeedback, "0900 82 00 0a 01 0a 03 01")
+        self.assertEqual(0x00, msg.port)
+        self.assertEqual({0x00: 0x0a, 0x01: 0x0a, 0x03: 0x01}, msg.statuses)
+        self.assertTrue(msg.is_completed(0x01))
+        self.assertFalse(msg.is_completed(0x03))
+        self.assertTrue(msg.is_in_progress(0x03))
+
+        self.assertTrue(MsgPortOutput(0x01, MsgPortOutput.WRITE_DIRECT, b"").is_reply(msg))
+        self.assertFalse(MsgPortOutput(0x03, MsgPortOutput.WRITE_DIRECT, b"").is_reply(msg))
+        self.assertFalse(MsgPortOutput(0x02, MsgPortOutput.WRITE_DIRECT, b"").is_reply(msg))
+
+    def test_combined_mode_msgs(self):
+        msg = decode(MsgPortInputFmtCombined, "0700 48 02 81 0300")
+        self.assertEqual((0x02, 0x81, 0b11), (msg.port, msg.combined_control, msg.pointer))
+
+        msg = decode(MsgPortValueCombined, "0b00 46 02 0300 fb 78563412")
+        self.assertEqual((0x02, 0b11), (msg.port, msg.pointer))
+        self.assertEqual(b"\xfb\x78\x56\x34\x12", msg.payload.tobytes())
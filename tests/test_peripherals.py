@@ -1,10 +1,13 @@
 import logging
 import time
 import unittest
+from threading import Thread
 
+from pylgbst.dispatcher import ConflatePolicy, FifoPolicy, DEFAULT_POLICY
 from pylgbst.hub import MoveHub
 from pylgbst.peripherals import LEDRGB, TiltSensor, COLOR_RED, Button, Current, Voltage, VisionSensor, \
     EncodedMotor
+from pylgbst.utilities import Future
 from tests import HubMock
 
 
@@ -55,6 +58,26 @@ class PeripheralsTest(unittest.TestCase):
         self.assertEqual(b"0a004132010100000000", hub.writes.pop(1)[1])
         self.assertEqual(b"0a008132115101204060", hub.writes.pop(1)[1])
 
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_led_async(self):
+        hub = HubMock()
+        hub.led = LEDRGB(hub, MoveHub.PORT_LED)
+        hub.peripherals[MoveHub.PORT_LED] = hub.led
+
+        # port setup and color go together, without waiting for setup reply
+        future = hub.led.set_color_async((32, 64, 96))
+        self.assertEqual(b"0a004132010100000000", hub.writes[1][1])
+        self.assertEqual(b"0a008132115101204060", hub.writes[2][1])
+
+        hub.connection.notifications.append("0a004732010100000000")
+        hub.connection.notifications.append("050082320a")
+        self.assertTrue(future.result(1).is_completed())
+        self.assertEqual(LEDRGB.MODE_RGB, hub.led._port_mode.mode)
+
+        hub.led.set_color_async((0, 0, 0)).cancel()
+        self.assertEqual(4, len(hub.writes))  # already in RGB mode, no setup
+        hub.connection.wait_notifications_handled()
+
     def test_current(self):
         hub = HubMock()
         time.sleep(0.1)
@@ -105,6 +128,52 @@ class PeripheralsTest(unittest.TestCase):
         self.assertEqual(b"0a00413c000100000001", hub.writes[1][1])
         self.assertEqual(b"0a00413c000100000000", hub.writes[2][1])
 
+    def test_cached_value(self):
+        hub = HubMock()
+        voltage = Voltage(hub, MoveHub.PORT_VOLTAGE)
+        hub.peripherals[MoveHub.PORT_VOLTAGE] = voltage
+
+        hub.connection.notification_delayed("0a00473c000100000001", 0.05)
+        voltage.subscribe(None)
+        hub.connection.notifications.append("0600453c9907")
+        time.sleep(0.1)
+
+        writes = len(hub.writes)
+        self.assertEqual((4.79630105317236,), voltage.get_sensor_data(Voltage.VOLTAGE_L, max_age=1.0))
+        self.assertEqual(writes, len(hub.writes))
+
+        # too old, so it is requested
+        time.sleep(0.1)
+        hub.connection.notification_delayed("0600453c0008", 0.05)
+        self.assertNotEqual((4.79630105317236,), voltage.get_sensor_data(Voltage.VOLTAGE_L, max_age=0.05))
+        self.assertEqual(b"0500213c00", hub.writes[-1][1])
+        hub.connection.wait_notifications_handled()
+
+    def test_subscription_policy(self):
+        hub = HubMock()
+        voltage = Voltage(hub, MoveHub.PORT_VOLTAGE)
+        hub.peripherals[MoveHub.PORT_VOLTAGE] = voltage
+        vals = []
+
+        def callback(value):
+            vals.append(value)
+
+        hub.connection.notification_delayed("0a00473c000100000001", 0.05)
+        voltage.subscribe(callback, Voltage.VOLTAGE_L, policy=ConflatePolicy())
+        voltage.subscribe(callback, Voltage.VOLTAGE_L, policy=ConflatePolicy())  # equal policy is fine
+        with self.assertRaises(ValueError):
+            voltage.subscribe(None, Voltage.VOLTAGE_L, policy=FifoPolicy(16))
+
+        hub.connection.notifications.append("0600453c9907")
+        time.sleep(0.1)
+        self.assertEqual([4.79630105317236], vals)
+        self.assertEqual({"waiting": 0, "delivered": 1, "dropped": 0, "conflated": 0}, voltage.port_data_stats())
+
+        hub.connection.notification_delayed("0a00473c000100000000", 0.05)
+        voltage.unsubscribe(callback)
+        self.assertIs(DEFAULT_POLICY, voltage._incoming_port_data.policy)
+        hub.connection.wait_notifications_handled()
+
     def test_tilt_sensor(self):
         hub = HubMock()
         sensor = TiltSensor(hub, MoveHub.PORT_TILT_SENSOR)
@@ -195,6 +264,111 @@ class PeripheralsTest(unittest.TestCase):
 
         hub.connection.wait_notifications_handled()
 
+    def test_motor_feedback_for_several_ports(self):
+        hub = HubMock()
+        motors = [EncodedMotor(hub, MoveHub.PORT_B), EncodedMotor(hub, MoveHub.PORT_D)]
+        replies = []
+        threads = [Thread(target=lambda motor=motor: replies.append(motor.set_acc_profile(1.0))) for motor in motors]
+        for thr in threads:
+            thr.start()
+
+        hub.connection.notification_delayed('070082010a030a', 0.1)  # feedback for two ports at once
+        for thr in threads:
+            thr.join(1)
+        self.assertEqual(2, len(replies))
+        self.assertTrue(all(reply.is_completed(0x01) and reply.is_completed(0x03) for reply in replies))
+        hub.connection.wait_notifications_handled()
+
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_motor_async(self):
+        hub = HubMock()
+        motor_a = EncodedMotor(hub, MoveHub.PORT_A)
+        motor_b = EncodedMotor(hub, MoveHub.PORT_B)
+
+        futures = [motor_a.angled_async(90), motor_b.timed_async(0.5)]
+        self.assertEqual(b"0e008100110b5a00000064647f03", hub.writes[1][1])
+        self.assertEqual(b"0c0081011109f40164647f03", hub.writes[2][1])
+        self.assertFalse(any(future.done() for future in futures))
+
+        hub.connection.notifications.append('070082000a010a')
+        for future in futures:
+            self.assertTrue(future.result(1).is_completed())
+
+        hub.connection.notifications.append('050082010a')
+        self.assertTrue(motor_b.stop_async().result(1).is_completed(0x01))
+        hub.connection.wait_notifications_handled()
+
+    @unittest.skipIf(Future is None, "needs futures, pip install futures on Python 2")
+    def test_motor_set_points_coalesced(self):
+        hub = HubMock()
+        hub.enable_write_scheduler()
+        motor = EncodedMotor(hub, MoveHub.PORT_A)
+
+        # the first command waits for feedback, newer speeds and powers replace the queued ones
+        futures = [motor.start_speed_async(speed) for speed in (0.1, 0.2, 0.3)]
+        futures += [motor.start_power_async(power) for power in (0.4, 0.5)]
+        time.sleep(0.1)
+        for _ in range(3):
+            hub.connection.notifications.append('050082000a')
+            time.sleep(0.1)
+
+        self.assertIs(futures[1].result(1), futures[2].result(1))
+        self.assertIs(futures[3].result(1), futures[4].result(1))
+        self.assertEqual([b"090081001107", b"090081001107", b"080081001151"], [x[1][:12] for x in hub.writes[1:]])
+        self.assertEqual(b"1e", hub.writes[2][1][12:14])  # speed 0.3
+        self.assertEqual(b"0032", hub.writes[3][1][12:])  # power 0.5
+        hub.connection.wait_notifications_handled()
+
+    def test_motor_combined(self):
+        hub = HubMock()
+        motor = EncodedMotor(hub, MoveHub.PORT_AB)
+        motor.virtual_ports = (MoveHub.PORT_A, MoveHub.PORT_B)
+        hub.peripherals[MoveHub.PORT_AB] = motor
+
+        hub.connection.notification_delayed('050082100a', 0.1)
+        motor.start_power(1.0, -0.5)
+        self.assertEqual(b"0900811011510364ce", hub.writes.pop(1)[1])
+
+        hub.connection.notification_delayed('050082100a', 0.1)
+        motor.angled(180, 1.0, 0.5)
+        self.assertEqual(b"0f008110110cb40000006432647f03", hub.writes.pop(1)[1])
+
+        hub.connection.notification_delayed('050082100a', 0.1)
+        motor.goto_position(10, 20)
+        self.assertEqual(b"12008110110e0a0000001400000064647f03", hub.writes.pop(1)[1])
+
+        hub.connection.wait_notifications_handled()
+
+    def test_combined_mode(self):
+        hub = HubMock()
+        motor = EncodedMotor(hub, MoveHub.PORT_C)
+        hub.peripherals[MoveHub.PORT_C] = motor
+
+        vals = []
+
+        def callback(values):
+            vals.append(values)
+
+        hub.connection.notification_delayed('0a00 44 02 01 80 01000400', 0.1)  # speed, 1 x 8 bit
+        hub.connection.notification_delayed('0a00 44 02 02 80 01020400', 0.2)  # position, 1 x 32 bit
+        hub.connection.notification_delayed('0a00 47 02 01 01000000 00', 0.3)
+        hub.connection.notification_delayed('0a00 47 02 02 01000000 00', 0.4)
+        hub.connection.notification_delayed('0700 48 02 81 0300', 0.5)
+        motor.subscribe_combined(callback, [EncodedMotor.SENSOR_SPEED, EncodedMotor.SENSOR_ANGLE])
+        self.assertEqual(b"0500420202", hub.writes[3][1])
+        self.assertEqual(b"0500420203", hub.writes[-1][1])
+        self.assertEqual(b"0800420201001020", hub.writes[-2][1])
+
+        hub.connection.notification_delayed("0b00 46 02 0300 fb 78563412", 0.1)
+        hub.connection.notification_delayed("0700 46 02 0100 05", 0.2)
+        time.sleep(0.3)
+        self.assertEqual([{1: (-5,), 2: (0x12345678,)}, {1: (5,)}], vals)
+
+        hub.connection.notification_delayed('0a00 47 02 02 01000000 00', 0.1)
+        motor.unsubscribe(callback)
+        self.assertEqual(b"0a004102020100000000", hub.writes[-1][1])
+        hub.connection.wait_notifications_handled()
+
     def test_motor_sensor(self):
         hub = HubMock()
         motor = EncodedMotor(hub, MoveHub.PORT_C)